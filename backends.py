@@ -0,0 +1,489 @@
+"""Generation backends that write the companion's replies.
+
+A backend turns the prompt built by VirtualCompanion into a reply:
+
+    openai    the OpenAI API, or any OpenAI-compatible API at OPENAI_API_BASE
+    local     an OpenAI-compatible server on this machine (llama.cpp, vLLM,
+              Ollama, ...) at LOCAL_API_BASE, which needs no API key
+    template  the basic response templates, answering without any latency
+
+COMPANION_BACKEND picks the backend (default openai). If
+COMPANION_HEDGE_BACKEND names a second one, requests are hedged: when the
+first backend has not answered within the 95th percentile of its recent
+latencies, or has failed before that, the same prompt goes to the second
+one as well and whichever answers first is used.
+
+Every backend has request_data(messages), which returns the request body,
+and generate(), generate_async(), stream() and stream_async(), which are
+passed the companion, that body and the request priority. The template
+backend returns TemplateReply strings, so its replies are not taken for a
+model's, e.g. when it wins a hedged request.
+"""
+import os
+import queue
+import threading
+import time
+import weakref
+from collections import deque
+
+import environment
+import gpt_client
+import request_scheduler
+from request_scheduler import INTERACTIVE
+
+# Recent latencies needed before the hedge delay follows them
+HEDGE_MIN_SAMPLES = 20
+
+
+class TemplateReply(str):
+    """Reply text written by the basic response templates"""
+    __slots__ = ()
+
+
+class OpenAIBackend:
+    """Chat completions of an OpenAI-compatible HTTP API"""
+
+    name = "openai"
+    requires_api_key = True
+    cacheable = True
+    instant = False  # True for a backend that answers on the calling thread without waiting
+
+    def __init__(self, base_url=None, model=None, max_tokens=None, temperature=None, api_key=None, scheduler=None):
+        self.base_url = base_url  # None for the API at OPENAI_API_BASE
+        self.api_key = api_key
+        self.model = model or os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
+        self.max_tokens = max_tokens or int(os.getenv("GPT_MAX_TOKENS", 150))
+        self.temperature = temperature if temperature is not None else float(os.getenv("GPT_TEMPERATURE", 0.7))
+        self.scheduler = scheduler
+        self._client = None
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def request_data(self, messages):
+        """Returns the request body for the chat completions endpoint"""
+        return {
+            "model": self.model,
+            "messages": messages,
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature
+        }
+
+    def generate(self, companion, data, priority=INTERACTIVE):
+        client = self.client()
+        return self.get_scheduler().call(
+            lambda: client.chat(data, api_key=self._api_key(companion)), priority, companion._request_tokens(data)
+        )
+
+    async def generate_async(self, companion, data, priority=INTERACTIVE, client=None):
+        client = self.async_client(client)
+        return await self.get_scheduler().call_async(
+            lambda: client.chat(data), priority, companion._request_tokens(data)
+        )
+
+    def stream(self, companion, data, priority=INTERACTIVE):
+        scheduler = self.get_scheduler()
+        # The stream holds its scheduler slot until the last chunk
+        scheduler.acquire(priority, companion._request_tokens(data))
+        try:
+            yield from self.client().chat_stream(data, api_key=self._api_key(companion))
+        finally:
+            scheduler.release()
+
+    async def stream_async(self, companion, data, priority=INTERACTIVE, client=None):
+        client = self.async_client(client)
+        scheduler = self.get_scheduler()
+        await scheduler.acquire_async(priority, companion._request_tokens(data))
+        try:
+            async for chunk in client.chat_stream(data):
+                yield chunk
+        finally:
+            scheduler.release()
+
+    def client(self):
+        """Returns the pooled client, the process-wide one for OPENAI_API_BASE"""
+        if self.base_url is None:
+            return gpt_client.get_client()
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = gpt_client.GPTClient(api_key=self.api_key, base_url=self.base_url)
+        return self._client
+
+    def async_client(self, client=None):
+        """Returns the async client for the running event loop. A client
+        passed by the caller is used for OPENAI_API_BASE only."""
+        import asyncio  # Here, so sync callers start without it
+        if self.base_url is None:
+            return client or gpt_client.get_async_client()
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            client = self._async_clients[loop] = gpt_client.AsyncGPTClient(api_key=self.api_key, base_url=self.base_url)
+        return client
+
+    def get_scheduler(self):
+        return self.scheduler or request_scheduler.get_scheduler()
+
+    def _api_key(self, companion):
+        return companion.api_key
+
+
+class LocalBackend(OpenAIBackend):
+    """An OpenAI-compatible server on this machine, e.g. llama.cpp, vLLM or Ollama"""
+
+    name = "local"
+    requires_api_key = False
+
+    def __init__(self, base_url=None, model=None, max_tokens=None, temperature=None):
+        super().__init__(
+            base_url=base_url or os.getenv("LOCAL_API_BASE", "http://127.0.0.1:8080/v1"),
+            model=model or os.getenv("LOCAL_MODEL", "local"),
+            max_tokens=max_tokens,
+            temperature=temperature,
+            api_key=os.getenv("LOCAL_API_KEY", "local"),
+            # Not bound by the rate limits of the API, only by what the machine can run at once
+            scheduler=request_scheduler.RequestScheduler(0, 0, int(os.getenv("LOCAL_MAX_CONCURRENCY", 4)))
+        )
+
+    def _api_key(self, companion):
+        return self.api_key
+
+
+class TemplateBackend:
+    """The basic response templates, answering instantly"""
+
+    name = "template"
+    requires_api_key = False
+    cacheable = False
+    # It works on the companion's own state, so it must not run beside the turn in another thread
+    instant = True
+
+    def request_data(self, messages):
+        return {"model": self.name, "messages": messages}
+
+    def generate(self, companion, data, priority=INTERACTIVE):
+        message = ""
+        for item in reversed(data["messages"]):
+            if item["role"] == "user":
+                message = item["content"]
+                break
+        return TemplateReply(companion._basic_response(message))
+
+    async def generate_async(self, companion, data, priority=INTERACTIVE, client=None):
+        return self.generate(companion, data, priority)
+
+    def stream(self, companion, data, priority=INTERACTIVE):
+        yield self.generate(companion, data, priority)
+
+    async def stream_async(self, companion, data, priority=INTERACTIVE, client=None):
+        yield self.generate(companion, data, priority)
+
+
+class _StreamEnd:
+    pass
+
+
+class HedgedBackend:
+    """Sends a request to a second backend as well when the first is slow.
+
+    The hedge goes out once the primary has taken longer than the 95th
+    percentile of its recent latencies (HEDGE_DELAY seconds, default 2,
+    until enough have been seen), or as soon as it fails, and the first
+    reply wins. For streams the race is to the first chunk. An instant
+    secondary, such as the templates, answers on the calling thread. The
+    loser is cancelled; a blocking call that already runs in the pool
+    cannot be interrupted, so it finishes in the background unheeded.
+    """
+
+    def __init__(self, primary, secondary, quantile=0.95, initial_delay=None, window=200):
+        self.primary = primary
+        self.secondary = secondary
+        self.name = f"{primary.name}+{secondary.name}"
+        self.requires_api_key = primary.requires_api_key
+        self.cacheable = primary.cacheable
+        self.instant = primary.instant
+        self.quantile = quantile
+        self.initial_delay = initial_delay or float(os.getenv("HEDGE_DELAY", 2.0))
+        self.latencies = deque(maxlen=window)  # Recent latencies of the primary
+        self._executor = None
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "hedged": 0, "hedge_wins": 0}
+
+    def request_data(self, messages):
+        return self.primary.request_data(messages)
+
+    def hedge_delay(self):
+        """Returns how long to wait for the primary before hedging"""
+        latencies = sorted(self.latencies)
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return self.initial_delay
+        return latencies[min(len(latencies) - 1, int(len(latencies) * self.quantile))]
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats["hedge_delay"] = self.hedge_delay()
+        return stats
+
+    def generate(self, companion, data, priority=INTERACTIVE):
+        from concurrent.futures import FIRST_COMPLETED, wait
+        if self.primary.instant:
+            return self.primary.generate(companion, data, priority)
+        started = time.perf_counter()
+        self._count("requests")
+        primary = self._pool().submit(self.primary.generate, companion, data, priority)
+        # The primary's latency counts even when the hedge wins
+        primary.add_done_callback(lambda future: future.exception() or self._record(time.perf_counter() - started))
+        wait((primary,), timeout=self.hedge_delay())
+        if primary.done() and primary.exception() is None:
+            return primary.result()
+
+        self._count("hedged")
+        hedge_data = self.secondary.request_data(data["messages"])
+        if self.secondary.instant:
+            try:
+                response = self.secondary.generate(companion, hedge_data, priority)
+            except Exception:
+                # Wait for the primary after all, which raises its own error if it failed
+                return primary.result()
+            self._count("hedge_wins")
+            primary.cancel()
+            return response
+
+        hedge = self._pool().submit(self.secondary.generate, companion, hedge_data, priority)
+        pending = {primary, hedge}
+        error = None
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in sorted(done, key=lambda future: future is not primary):
+                    if future.exception() is not None:
+                        error = future.exception()
+                        continue
+                    if future is hedge:
+                        self._count("hedge_wins")
+                    return future.result()
+            raise error
+        finally:
+            # A loser still waiting for a pool thread never starts
+            for future in pending:
+                future.cancel()
+
+    async def generate_async(self, companion, data, priority=INTERACTIVE, client=None):
+        import asyncio
+        started = time.perf_counter()
+        self._count("requests")
+        primary = asyncio.ensure_future(self.primary.generate_async(companion, data, priority, client))
+        done, _ = await asyncio.wait({primary}, timeout=self.hedge_delay())
+        if done and primary.exception() is None:
+            self._record(time.perf_counter() - started)
+            return primary.result()
+
+        self._count("hedged")
+        hedge = asyncio.ensure_future(self.secondary.generate_async(
+            companion, self.secondary.request_data(data["messages"]), priority, client
+        ))
+        pending = {primary, hedge}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in sorted(done, key=lambda task: task is not primary):
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    if task is hedge:
+                        self._count("hedge_wins")
+                    # A cancelled primary took at least this long
+                    self._record(time.perf_counter() - started)
+                    return task.result()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stream(self, companion, data, priority=INTERACTIVE):
+        if self.primary.instant:
+            yield from self.primary.stream(companion, data, priority)
+            return
+        started = time.perf_counter()
+        self._count("requests")
+        events = queue.Queue()
+        stopped = [False, False]
+
+        def pump(index, backend, backend_data):
+            # Runs a backend's stream in a worker thread until the other one wins
+            try:
+                for chunk in backend.stream(companion, backend_data, priority):
+                    if stopped[index]:
+                        break
+                    events.put((index, chunk, None))
+            except Exception as e:
+                events.put((index, _StreamEnd, e))
+            else:
+                events.put((index, _StreamEnd, None))
+
+        self._pool().submit(pump, 0, self.primary, data)
+        deadline = started + self.hedge_delay()
+        hedged = False
+        running = 1
+        winner = None
+        error = None
+        try:
+            while True:
+                timeout = None
+                if winner is None and not hedged:
+                    timeout = max(0.0, deadline - time.perf_counter())
+                try:
+                    index, chunk, chunk_error = events.get(timeout=timeout)
+                except queue.Empty:
+                    index = chunk = chunk_error = None
+                if winner is None and not hedged and (index is None or chunk_error is not None):
+                    # The primary is slow to start or failed: race it against the hedge
+                    self._count("hedged")
+                    hedged = True
+                    hedge_data = self.secondary.request_data(data["messages"])
+                    if self.secondary.instant:
+                        stopped[0] = True
+                        if index is None:
+                            self._record(time.perf_counter() - started)
+                        self._count("hedge_wins")
+                        yield from self.secondary.stream(companion, hedge_data, priority)
+                        return
+                    running += 1
+                    self._pool().submit(pump, 1, self.secondary, hedge_data)
+                    if index is None:
+                        continue
+                if winner is None:
+                    if chunk is _StreamEnd:
+                        # A stream that failed or ended empty before the other started
+                        running -= 1
+                        error = chunk_error or error
+                        if running > 0:
+                            continue
+                        if error is not None:
+                            raise error
+                        return
+                    winner = index
+                    stopped[1 - index] = True
+                    self._record(time.perf_counter() - started)
+                    if index == 1:
+                        self._count("hedge_wins")
+                if index != winner:
+                    continue
+                if chunk is _StreamEnd:
+                    if chunk_error is not None:
+                        raise chunk_error
+                    return
+                yield chunk
+        finally:
+            stopped[0] = stopped[1] = True
+
+    async def stream_async(self, companion, data, priority=INTERACTIVE, client=None):
+        import asyncio
+        started = time.perf_counter()
+        self._count("requests")
+        streams = [self.primary.stream_async(companion, data, priority, client)]
+        firsts = [asyncio.ensure_future(_first_chunk(streams[0]))]
+        done, _ = await asyncio.wait(firsts, timeout=self.hedge_delay())
+        if not done or firsts[0].exception() is not None:
+            self._count("hedged")
+            streams.append(self.secondary.stream_async(
+                companion, self.secondary.request_data(data["messages"]), priority, client
+            ))
+            firsts.append(asyncio.ensure_future(_first_chunk(streams[1])))
+
+        winner = None
+        error = None
+        pending = set(firsts)
+        try:
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for index, task in enumerate(firsts):
+                    if task not in done:
+                        continue
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    winner = index
+                    break
+        finally:
+            # Stop the loser before closing its stream
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            for index, stream in enumerate(streams):
+                if index != winner:
+                    await stream.aclose()
+        if winner is None:
+            raise error
+        self._record(time.perf_counter() - started)
+        if winner == 1:
+            self._count("hedge_wins")
+
+        first = firsts[winner].result()
+        if first is _StreamEnd:
+            return
+        yield first
+        async for chunk in streams[winner]:
+            yield chunk
+
+    def _pool(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    from concurrent.futures import ThreadPoolExecutor  # Here, so basic mode starts without it
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=int(os.getenv("HEDGE_THREADS", 32)), thread_name_prefix="hedge"
+                    )
+        return self._executor
+
+    def _record(self, latency):
+        with self._lock:
+            self.latencies.append(latency)
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+
+async def _first_chunk(stream):
+    try:
+        return await stream.__anext__()
+    except StopAsyncIteration:
+        return _StreamEnd
+
+
+BACKENDS = {"openai": OpenAIBackend, "local": LocalBackend, "template": TemplateBackend}
+
+
+def create_backend(name):
+    """Returns a new backend of the given name"""
+    if name not in BACKENDS:
+        raise Exception(f"Unknown backend {name!r}, expected one of: {', '.join(BACKENDS)}")
+    return BACKENDS[name]()
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """Returns the process-wide backend configured by COMPANION_BACKEND and
+    COMPANION_HEDGE_BACKEND"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                environment.load()
+                backend = create_backend(os.getenv("COMPANION_BACKEND", "openai"))
+                hedge = os.getenv("COMPANION_HEDGE_BACKEND")
+                if hedge:
+                    backend = HedgedBackend(backend, create_backend(hedge))
+                _backend = backend
+    return _backend
+
+
+def set_backend(backend):
+    """Replaces the process-wide backend"""
+    global _backend
+    _backend = backend
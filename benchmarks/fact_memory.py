@@ -0,0 +1,61 @@
+"""Measures retrieval from the long-term fact memory of one session:
+
+    python -m benchmarks.fact_memory --facts 10000
+
+Facts are made of random words of a fixed vocabulary, so common words hit
+thousands of them, as words like "work" or "family" would in a long
+conversation. Queries are messages of 5 to 40 words.
+"""
+import argparse
+import os
+import random
+import timeit
+
+os.environ["OPENAI_API_KEY"] = ""
+
+from fact_memory import FactStore
+from virtual_companion import IMPORTANT_INFO_KEYWORDS
+
+
+def make_vocabulary(size, rng):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    return ["".join(rng.choice(letters) for _ in range(rng.randint(3, 9))) for _ in range(size)]
+
+
+def make_text(vocabulary, length, rng):
+    # Zipf-like: a few words are in many facts, most in few
+    return " ".join(vocabulary[min(int(rng.paretovariate(1.0)) - 1, len(vocabulary) - 1)] for _ in range(length))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fact memory retrieval speed")
+    parser.add_argument("--facts", type=int, default=10000, help="Facts in the store")
+    parser.add_argument("--vocabulary", type=int, default=5000, help="Distinct words of the facts")
+    parser.add_argument("--queries", type=int, default=1000, help="Messages to retrieve facts for")
+    args = parser.parse_args()
+
+    rng = random.Random(7)
+    vocabulary = make_vocabulary(args.vocabulary, rng)
+    rng.shuffle(vocabulary)
+    categories = list(IMPORTANT_INFO_KEYWORDS)
+    store = FactStore(limit=args.facts)
+    add_time = timeit.timeit(
+        lambda: store.add(make_text(vocabulary, rng.randint(4, 16), rng), rng.choice(categories), store.appended),
+        number=args.facts
+    )
+    print(f"{len(store)} facts, {len(store.index)} index terms, added in {add_time / args.facts * 1e6:.2f} us each")
+
+    queries = [make_text(vocabulary, rng.randint(5, 40), rng) for _ in range(args.queries)]
+    times = []
+    found = 0
+    for query in queries:
+        times.append(min(timeit.repeat(lambda: store.retrieve(query, store.appended), number=10, repeat=3)) / 10)
+        found += len(store.retrieve(query, store.appended))
+    times.sort()
+    print(f"retrieve: median {times[len(times) // 2] * 1e6:.1f} us, "
+          f"p99 {times[int(len(times) * 0.99)] * 1e6:.1f} us, max {times[-1] * 1e6:.1f} us, "
+          f"{found / len(queries):.1f} facts per query")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""Load test for the chat gateway against the local fake OpenAI endpoint.
+
+Starts fake_openai.py and gateway.py as subprocesses, opens many concurrent
+sessions and reports throughput, reply latency and how many sessions one
+core of the gateway can hold at the simulated message rate:
+
+    python -m benchmarks.gateway_load --sessions 2000 --messages 5 --think-time 2
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MESSAGES = [
+    "hi",
+    "I like music and movies, what about you?",
+    "How are you today?",
+    "I had a terrible day at work, my boss was annoying",
+    "ok",
+    "Tell me something about travel",
+]
+
+
+async def run_session(host, port, messages, think_time, latencies):
+    reader, writer = await asyncio.open_connection(host, port, limit=1024 * 1024)
+    try:
+        writer.write(f"{random.randint(13, 60)} {random.choice(['formal', 'friendly', 'romantic', 'playful'])}\n".encode())
+        json.loads(await reader.readline())
+        for _ in range(messages):
+            await asyncio.sleep(random.uniform(0, 2 * think_time))
+            started = time.perf_counter()
+            writer.write((random.choice(MESSAGES) + "\n").encode())
+            reply = json.loads(await reader.readline())
+            if reply["type"] != "reply":
+                raise RuntimeError(reply["text"])
+            latencies.append(time.perf_counter() - started)
+        writer.write(b"exit\n")
+    finally:
+        writer.close()
+
+
+async def run_load(host, port, sessions, messages, think_time, ramp_up):
+    latencies = []
+    tasks = []
+    for i in range(sessions):
+        tasks.append(asyncio.create_task(run_session(host, port, messages, think_time, latencies)))
+        if ramp_up:
+            await asyncio.sleep(ramp_up / sessions)
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    errors = [r for r in results if isinstance(r, Exception)]
+    return latencies, errors
+
+
+def wait_for_port(host, port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Nothing is listening on {host}:{port}")
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure sessions per core of the chat gateway")
+    parser.add_argument("--sessions", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=5, help="Messages per session")
+    parser.add_argument("--think-time", type=float, default=1.0, help="Average pause between messages")
+    parser.add_argument("--ramp-up", type=float, default=2.0, help="Seconds over which sessions connect")
+    parser.add_argument("--api-latency", type=float, default=0.5, help="Latency of the fake API")
+    parser.add_argument("--basic", action="store_true", help="Run the gateway in basic mode (no API)")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--api-port", type=int, default=8099)
+    args = parser.parse_args()
+
+    host = "127.0.0.1"
+    env = dict(os.environ, OPENAI_API_BASE=f"http://{host}:{args.api_port}/v1", PYTHONPATH=ROOT)
+    if args.basic:
+        env["OPENAI_API_KEY"] = ""
+    else:
+        env.setdefault("OPENAI_API_KEY", "test")
+
+    fake_api = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "fake_openai.py"), "--port", str(args.api_port),
+         "--latency", str(args.api_latency)],
+        env=env, stdout=subprocess.DEVNULL
+    )
+    gateway = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "gateway.py"), "--port", str(args.port)],
+        env=env, stdout=subprocess.DEVNULL
+    )
+    try:
+        wait_for_port(host, args.api_port)
+        wait_for_port(host, args.port)
+        started = time.perf_counter()
+        latencies, errors = asyncio.run(
+            run_load(host, args.port, args.sessions, args.messages, args.think_time, args.ramp_up)
+        )
+        wall = time.perf_counter() - started
+    finally:
+        # Children's CPU time is only accounted once they have been reaped
+        cpu_before = os.times()
+        gateway.terminate()
+        gateway.wait()
+        cpu_after = os.times()
+        fake_api.terminate()
+        fake_api.wait()
+
+    gateway_cpu = (cpu_after.children_user - cpu_before.children_user) + \
+                  (cpu_after.children_system - cpu_before.children_system)
+    cores_used = gateway_cpu / wall if wall else 0.0
+    print(f"Sessions:             {args.sessions} ({len(errors)} failed)")
+    print(f"Turns:                {len(latencies)} in {wall:.2f}s ({len(latencies) / wall:.1f} turns/s)")
+    print(f"Reply latency:        p50 {percentile(latencies, 0.5) * 1000:.1f} ms, "
+          f"p99 {percentile(latencies, 0.99) * 1000:.1f} ms")
+    print(f"Gateway CPU:          {gateway_cpu:.2f}s ({cores_used:.2f} cores)")
+    if cores_used:
+        print(f"Sessions per core:    {args.sessions / cores_used:.0f} at this message rate")
+    if errors:
+        print(f"First error:          {errors[0]!r}")
+
+
+if __name__ == "__main__":
+    main()
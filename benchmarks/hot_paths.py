@@ -0,0 +1,292 @@
+"""Microbenchmarks of the VirtualCompanion hot paths.
+
+Times respond() in basic mode and in GPT mode against an in-process fake
+backend, plus the per-turn steps it is made of, over synthetic messages of
+several lengths for every age bracket and communication style. Each result
+has the time per call (best and median of several rounds) and the bytes
+allocated per call. The "import" results are the time a fresh interpreter
+takes to import the entry modules, as reported by python -X importtime,
+and list the heavy optional modules that import pulled in. Results are written as JSON and can be compared with
+an earlier run, e.g. of another revision:
+
+    python -m benchmarks.hot_paths --output before.json
+    python -m benchmarks.hot_paths --output after.json --compare before.json
+
+--compare exits with status 1 if any benchmark got slower than --threshold.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import timeit
+import tracemalloc
+
+os.environ["OPENAI_API_KEY"] = ""
+
+import gpt_client
+import templates
+from virtual_companion import VirtualCompanion
+
+AGES = {"teen": 15, "student": 18, "young_adult": 22, "adult": 40}
+# Entry modules timed by the import benchmark
+IMPORT_MODULES = ("virtual_companion", "session_store", "gateway")
+# Modules that only the backends, the stores or the console need
+LAZY_MODULES = ("requests", "asyncio", "ssl", "sqlite3", "concurrent.futures", "dotenv", "colorama")
+STYLES = templates.STYLES
+LENGTHS = {"short": 20, "medium": 200, "long": 1000}
+
+FILLER = (
+    "yesterday we walked along the river and talked about everything that happened "
+    "during the week while the neighbours were building a new fence and their children "
+    "played outside until it got dark so we went home made some tea and watched the rain"
+).split()
+
+PHRASES = [
+    "i like it", "this is great", "that was terrible", "how are you", "you are so smart",
+    "i enjoy painting", "my brother", "at work", "at school", "see you", "thanks",
+]
+
+FAKE_REPLIES = [
+    "That sounds really interesting! Tell me more.",
+    "I love hearing about that. What happened next?",
+    "Hmm, I never thought about it that way. Why do you think so?",
+]
+
+
+class FakeChatClient:
+    """Stands in for the pooled GPT client, answering after a fixed delay"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.rng = random.Random(0)
+
+    def chat(self, payload, api_key=None):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return self.rng.choice(FAKE_REPLIES)
+
+
+def make_corpus(bracket, length, size=64, seed=0):
+    """Returns synthetic messages of about length characters that mention
+    the bracket's topics and some emotion, info and reply keywords"""
+    rng = random.Random(f"{seed}:{bracket}:{length}")
+    topics = templates.TOPICS[bracket]
+    messages = []
+    for _ in range(size):
+        words = []
+        while sum(len(word) + 1 for word in words) < length:
+            roll = rng.random()
+            if roll < 0.08:
+                words.append(rng.choice(topics))
+            elif roll < 0.14:
+                words.append(rng.choice(PHRASES))
+            else:
+                words.append(rng.choice(FILLER))
+        messages.append(" ".join(words)[:length].strip() or "ok")
+    return messages
+
+
+def measure(function, number, rounds):
+    """Returns (best, median) microseconds per call and bytes allocated per call"""
+    function()
+    times = [t / number * 1e6 for t in timeit.repeat(function, number=number, repeat=rounds)]
+    tracemalloc.start()
+    allocated = 0
+    calls = max(1, min(number, 200))
+    for _ in range(calls):
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        function()
+        allocated += tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+    return min(times), statistics.median(times), allocated / calls
+
+
+def measure_import(module, rounds):
+    """Returns (best, median) microseconds a fresh interpreter takes to
+    import a module, and the LAZY_MODULES it imported"""
+    times = []
+    loaded = set()
+    for _ in range(rounds):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True,
+            check=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        )
+        # Lines are "import time: self [us] | cumulative | imported package"
+        for line in result.stderr.splitlines():
+            parts = line.split("|")
+            if len(parts) != 3:
+                continue
+            name = parts[2].strip()
+            if name == module:
+                times.append(int(parts[1]))
+            elif name in LAZY_MODULES:
+                loaded.add(name)
+    return min(times), statistics.median(times), sorted(loaded)
+
+
+def cycle(items):
+    """Returns a function that hands out items round-robin"""
+    state = {"index": 0}
+
+    def next_item():
+        item = items[state["index"] % len(items)]
+        state["index"] += 1
+        return item
+    return next_item
+
+
+def new_companion(age, style, api_key=None):
+    random.seed(0)
+    companion = VirtualCompanion(age, style)
+    companion.api_key = api_key
+    companion.greeting()
+    return companion
+
+
+def benchmark_cases(latency):
+    """Yields (name, params, function, number) for every benchmark"""
+    for bracket, age in AGES.items():
+        for style in STYLES:
+            for length_name, length in LENGTHS.items():
+                params = {"bracket": bracket, "style": style, "length": length_name}
+                corpus = make_corpus(bracket, length)
+                number = 2000 if length <= 200 else 500
+
+                companion = new_companion(age, style)
+                message = cycle(corpus)
+                yield "respond_basic", params, lambda c=companion, m=message: c.respond(m()), number
+
+                companion = new_companion(age, style)
+                message = cycle(corpus)
+                yield ("update_emotional_state", params,
+                       lambda c=companion, m=message: c._update_emotional_state(m()), number)
+
+                companion = new_companion(age, style)
+                message = cycle(corpus)
+                yield "update_memory", params, lambda c=companion, m=message: c._update_memory(m()), number
+
+            # These do not depend on the message
+            params = {"bracket": bracket, "style": style}
+            companion = new_companion(age, style)
+            for text in make_corpus(bracket, 200, size=8):
+                companion.respond(text)
+            yield "evaluate_initiative_need", params, companion._evaluate_initiative_need, 20000
+            yield "choose_next_topic", params, companion._choose_next_topic, 20000
+            yield "create_gpt_prompt", params, lambda c=companion: c._create_gpt_prompt(True), 20000
+
+            companion = new_companion(age, style, api_key="fake")
+            message = cycle(make_corpus(bracket, 200))
+            params = {"bracket": bracket, "style": style, "latency_ms": latency * 1000}
+            yield "respond_gpt", params, lambda c=companion, m=message: c.respond(m()), 200 if latency else 2000
+
+
+def run(args):
+    gpt_client._client = FakeChatClient(args.latency)
+    results = []
+    for name, params, function, number in benchmark_cases(args.latency):
+        if args.filter and args.filter not in name:
+            continue
+        number = max(1, int(number * args.scale))
+        cpu_started = time.process_time()
+        best, median, allocated = measure(function, number, args.rounds)
+        results.append({
+            "name": name,
+            "params": params,
+            "best_us": round(best, 3),
+            "median_us": round(median, 3),
+            "bytes_per_call": round(allocated),
+            "cpu_s": round(time.process_time() - cpu_started, 3)
+        })
+        if not args.quiet:
+            label = " ".join(str(value) for value in params.values())
+            print(f"{name:>24} {label:<34} {best:>10.2f} us {median:>10.2f} us {allocated:>8.0f} B", flush=True)
+    if args.filter and args.filter not in "import":
+        return results
+    for module in IMPORT_MODULES:
+        cpu_started = time.process_time()
+        best, median, loaded = measure_import(module, args.rounds)
+        results.append({
+            "name": "import",
+            "params": {"module": module},
+            "best_us": best,
+            "median_us": median,
+            "loaded": loaded,
+            "cpu_s": round(time.process_time() - cpu_started, 3)
+        })
+        if not args.quiet:
+            print(f"{'import':>24} {module:<34} {best:>10.2f} us {median:>10.2f} us "
+                  f"{', '.join(loaded) or 'no heavy modules'}", flush=True)
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result_key(result):
+    return result["name"] + " " + " ".join(f"{key}={value}" for key, value in sorted(result["params"].items()))
+
+
+def compare(results, baseline_path, threshold):
+    """Prints the change against a baseline file and returns the regressions"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {result_key(result): result for result in json.load(f)["results"]}
+    regressions = []
+    # The best round is the least disturbed by other load on the machine
+    print(f"\ncompared with {baseline_path} (best time, regression above {threshold:.2f}x)")
+    for result in results:
+        before = baseline.get(result_key(result))
+        if before is None:
+            continue
+        ratio = result["best_us"] / before["best_us"] if before["best_us"] else 1.0
+        marker = ""
+        if ratio > threshold:
+            marker = "  REGRESSION"
+            regressions.append(result_key(result))
+        print(f"{result_key(result):<70} {before['best_us']:>10.2f} -> {result['best_us']:>10.2f} us "
+              f"{ratio:>6.2f}x{marker}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the VirtualCompanion hot paths")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Compare with the results in this JSON file")
+    parser.add_argument("--threshold", type=float, default=1.10,
+                        help="Slowdown factor that counts as a regression (default 1.10)")
+    parser.add_argument("--filter", help="Only run benchmarks whose name contains this text")
+    parser.add_argument("--latency", type=float, default=0.0, help="Delay of the fake GPT backend in seconds")
+    parser.add_argument("--rounds", type=int, default=5, help="Timing rounds per benchmark")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiplier for the number of calls per round")
+    parser.add_argument("--quiet", action="store_true")
+    args = parser.parse_args()
+
+    results = run(args)
+    report = {
+        "revision": git_revision(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "settings": {"latency": args.latency, "rounds": args.rounds, "scale": args.scale},
+        "results": results
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=1)
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
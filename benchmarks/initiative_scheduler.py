@@ -0,0 +1,65 @@
+"""Measures the initiative scheduler with many waiting sessions: the cost
+of arming and cancelling a timer, and of a scheduler tick while timers
+fire, as when every session goes silent and gets its initiative:
+
+    python -m benchmarks.initiative_scheduler --sessions 100000
+"""
+import argparse
+import os
+import random
+import time
+
+os.environ["OPENAI_API_KEY"] = ""
+
+from initiative_scheduler import InitiativeScheduler, TimerWheel
+from virtual_companion import VirtualCompanion
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Initiative scheduler speed")
+    parser.add_argument("--sessions", type=int, default=100000)
+    args = parser.parse_args()
+
+    rng = random.Random(3)
+    start = 1_000_000.0
+    deadlines = [start + rng.uniform(1, 600) for _ in range(args.sessions)]
+
+    wheel = TimerWheel(1.0, start)
+    started = time.perf_counter()
+    for key, deadline in enumerate(deadlines):
+        wheel.schedule(key, deadline)
+    schedule_time = time.perf_counter() - started
+    started = time.perf_counter()
+    for key in range(0, args.sessions, 2):
+        wheel.cancel(key)
+    cancel_time = time.perf_counter() - started
+    print(f"schedule: {schedule_time / args.sessions * 1e9:.0f} ns per timer, "
+          f"cancel: {cancel_time / (args.sessions // 2) * 1e9:.0f} ns per timer")
+
+    ticks = 0
+    fired = 0
+    started = time.perf_counter()
+    for second in range(1, 602):
+        fired += len(wheel.advance(start + second))
+        ticks += 1
+    tick_time = time.perf_counter() - started
+    print(f"{ticks} ticks firing {fired} timers: {tick_time / ticks * 1e6:.0f} us per tick")
+
+    # Whole initiatives, with a companion per session
+    companions = [VirtualCompanion(rng.randint(13, 60), "friendly") for _ in range(min(args.sessions, 20000))]
+    scheduler = InitiativeScheduler()
+    sent = []
+    now = time.time()
+    for key, companion in enumerate(companions):
+        companion.last_message_time = now - companion.initiative.interval_between_initiatives + rng.uniform(0, 10)
+        scheduler.schedule(key, companion, sent.append)
+    started = time.perf_counter()
+    while len(sent) < len(companions):
+        now += 1
+        scheduler.run_due(now)
+    elapsed = time.perf_counter() - started
+    print(f"{len(sent)} initiatives made in {elapsed:.2f} s ({elapsed / len(sent) * 1e6:.1f} us each)")
+
+
+if __name__ == "__main__":
+    main()
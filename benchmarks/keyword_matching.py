@@ -0,0 +1,182 @@
+"""Compares keyword detection of the original substring checks with the
+single-pass KeywordMatcher on messages of growing length, for ordinary text
+with few keywords and for text dense with keywords:
+
+    python -m benchmarks.keyword_matching
+
+Ordinary text is faster at every length. Text dense with keywords stays
+slower from about 1000 characters on (0.73-0.83x): the old checks stop at
+the first early hit of each group, while the matcher splits and hashes
+every word, and the topic classifier checks the word boundaries of the
+topic terms it finds.
+"""
+import random
+import timeit
+
+from virtual_companion import VirtualCompanion
+
+WORDS = (
+    "yesterday evening we walked along the river and talked about everything that "
+    "happened during the week, the neighbours were building a new fence while their "
+    "children played outside until it got dark and cold so we went home made some tea "
+    "and watched the rain falling on the windows for hours without saying much at all"
+).split()
+
+KEYWORD_PHRASES = [
+    "i like music", "my brother plays games", "work is terrible", "how are you",
+    "you are so smart", "i enjoy travel", "see you later", "thanks, that was cool",
+]
+
+
+# Share of words replaced by a phrase with keywords
+DENSITIES = {"plain": 0.005, "dense": 0.05}
+
+
+def make_message(length, rng, density=0.05):
+    words = []
+    while sum(len(w) + 1 for w in words) < length:
+        words.append(rng.choice(KEYWORD_PHRASES) if rng.random() < density else rng.choice(WORDS))
+    return " ".join(words)[:length]
+
+
+class LegacyState:
+    """Companion state in the original dict layout"""
+
+    def __init__(self, companion):
+        self.emotion_triggers = companion.emotion_triggers
+        self.conversation_topics = list(companion.conversation_topics)
+        self.emotional_state = companion.emotional_state.as_dict()
+        self.memory = companion.memory.as_dict(companion.topic_table)
+
+
+# The original implementation: one substring search per keyword, per method
+def legacy_update_emotional_state(self, message):
+    message = message.lower()
+    for word in self.emotion_triggers["positive"]:
+        if word in message:
+            self.emotional_state["mood"] = "good"
+            self.emotional_state["energy"] = min(100, self.emotional_state["energy"] + 10)
+            self.emotional_state["attachment"] = min(100, self.emotional_state["attachment"] + 5)
+            break
+    for word in self.emotion_triggers["negative"]:
+        if word in message:
+            self.emotional_state["mood"] = "bad"
+            self.emotional_state["energy"] = max(0, self.emotional_state["energy"] - 10)
+            break
+    if len(message) > 50:
+        self.emotional_state["topic_interest"] = min(100, self.emotional_state["topic_interest"] + 10)
+    elif len(message) < 10:
+        self.emotional_state["topic_interest"] = max(0, self.emotional_state["topic_interest"] - 5)
+    self.emotional_state["energy"] = max(0, self.emotional_state["energy"] - 1)
+
+
+def legacy_update_memory(self, message):
+    message = message.lower()
+    current_topic = None
+    max_match = 0
+    for topic in self.conversation_topics:
+        if topic.lower() in message:
+            if len(topic) > max_match:
+                current_topic = topic
+                max_match = len(topic)
+    if current_topic:
+        self.memory["current_topic"] = current_topic
+        if not self.memory["topic_history"] or self.memory["topic_history"][-1] != current_topic:
+            self.memory["topic_history"].append(current_topic)
+        if current_topic not in self.memory["recent_topics"]:
+            self.memory["recent_topics"].append(current_topic)
+            if len(self.memory["recent_topics"]) > 5:
+                self.memory["recent_topics"].pop(0)
+        if any(word in message for word in self.emotion_triggers["positive"]):
+            self.memory["favorite_topics"].add(current_topic)
+        elif any(word in message for word in self.emotion_triggers["negative"]):
+            self.memory["disliked_topics"].add(current_topic)
+    important_info = {
+        "hobbies": ["hobby", "enjoy", "like to"],
+        "work": ["work", "profession", "career"],
+        "education": ["study", "university", "school"],
+        "family": ["family", "parents", "brother", "sister"]
+    }
+    for category, keywords in important_info.items():
+        for word in keywords:
+            if word in message:
+                start = message.find(word)
+                end = message.find(".", start)
+                if end == -1:
+                    end = len(message)
+                info = message[start:end].strip()
+                self.memory["important_info"][category] = info
+
+
+def legacy_basic_response_kind(message):
+    message = message.lower()
+    if any(word in message for word in ["bye", "goodbye", "farewell", "see you"]):
+        return "goodbye"
+    elif any(phrase in message for phrase in ["how are you", "how are things", "how's your mood"]):
+        return "mood"
+    elif any(word in message for word in ["beautiful", "cute", "smart", "cool"]):
+        return "compliment"
+    return "other"
+
+
+def legacy_analyze(companion, message):
+    legacy_update_emotional_state(companion, message)
+    legacy_update_memory(companion, message)
+    return legacy_basic_response_kind(message)
+
+
+def matcher_analyze(companion, message):
+    companion._last_scan = None
+    companion._update_emotional_state(message)
+    companion._update_memory(message)
+    matches = companion._match_keywords(message)
+    if matches.any("goodbye"):
+        return "goodbye"
+    elif matches.any("mood_question"):
+        return "mood"
+    elif matches.any("compliment"):
+        return "compliment"
+    return "other"
+
+
+# Topics now come from the TopicClassifier, which finds more of them (see benchmarks.topic_classifier)
+TOPIC_KEYS = ("current_topic", "topic_history", "recent_topics", "favorite_topics", "disliked_topics")
+
+
+def state_of(companion):
+    if isinstance(companion, LegacyState):
+        emotional_state, memory = companion.emotional_state, companion.memory
+    else:
+        emotional_state, memory = companion.emotional_state.as_dict(), companion.memory.as_dict(companion.topic_table)
+    return emotional_state, {key: value for key, value in memory.items() if key not in TOPIC_KEYS}
+
+
+def check_equivalence(rng):
+    """Both implementations must reach identical decisions and state"""
+    for age in (14, 18, 22, 40):
+        current = VirtualCompanion(age, "friendly")
+        legacy = LegacyState(current)
+        for _ in range(300):
+            message = make_message(rng.randint(1, 400), rng)
+            assert legacy_analyze(legacy, message) == matcher_analyze(current, message), message
+            assert state_of(legacy) == state_of(current), message
+
+
+def main():
+    rng = random.Random(42)
+    check_equivalence(rng)
+    print(f"{'text':>6} {'length':>8} {'substring checks':>18} {'single pass':>14} {'speedup':>8}")
+    for name, density in DENSITIES.items():
+        for length in (50, 200, 1000, 5000, 20000):
+            message = make_message(length, rng, density)
+            companion = VirtualCompanion(22, "friendly")
+            legacy_companion = LegacyState(companion)
+            number = max(20, 200000 // length)
+            legacy_time = min(timeit.repeat(lambda: legacy_analyze(legacy_companion, message), number=number, repeat=5))
+            matcher_time = min(timeit.repeat(lambda: matcher_analyze(companion, message), number=number, repeat=5))
+            print(f"{name:>6} {length:>8} {legacy_time / number * 1e6:>15.1f} us "
+                  f"{matcher_time / number * 1e6:>11.1f} us {legacy_time / matcher_time:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
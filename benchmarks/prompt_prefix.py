@@ -0,0 +1,86 @@
+"""Measures how much of the GPT prompts a provider's prefix cache could
+reuse, with the current prompt layout and with the old one that kept every
+instruction in the first message:
+
+    python -m benchmarks.prompt_prefix --sessions 200 --turns 30
+
+Sessions talk to an in-process fake backend with messages that mention
+hobbies and work, so facts are retrieved into the prompts. The cached
+share counts every token of a prefix seen before, the cacheable requests
+only those where that prefix has at least --min-tokens tokens.
+"""
+import argparse
+import os
+import random
+import timeit
+
+os.environ["OPENAI_API_KEY"] = ""
+
+import gpt_client
+import prompt_prefix
+from benchmarks.hot_paths import AGES, FakeChatClient, make_corpus
+from templates import STYLES
+from virtual_companion import VirtualCompanion
+
+INFO_MESSAGES = [
+    "I enjoy painting landscapes on the weekend",
+    "my work is mostly meetings with clients lately",
+    "I study history at the university",
+    "my family is going to the mountains this summer",
+]
+
+
+class OldLayoutCompanion(VirtualCompanion):
+    """Sends the instructions, summary, facts and initiative directive in
+    the first message, as before the prompt was made prefix stable"""
+
+    __slots__ = ()
+
+    def _create_gpt_prompt(self, initiative_needed=False):
+        prompt = super()._create_gpt_prompt(initiative_needed)
+        instructions = " ".join(message["content"] for message in prompt if message["role"] == "system")
+        return [{"role": "system", "content": instructions}] + [m for m in prompt if m["role"] != "system"]
+
+
+def run_sessions(companion_class, sessions, turns, min_tokens):
+    prompt_prefix._tracker = tracker = prompt_prefix.PrefixTracker(min_tokens=min_tokens)
+    rng = random.Random(7)
+    brackets = list(AGES)
+    corpus = {bracket: make_corpus(bracket, 200) for bracket in brackets}
+    for _ in range(sessions):
+        bracket = rng.choice(brackets)
+        random.seed(rng.random())
+        companion = companion_class(AGES[bracket], rng.choice(STYLES))
+        companion.api_key = "fake"
+        companion.greeting()
+        for _ in range(turns):
+            companion.respond(rng.choice(INFO_MESSAGES) if rng.random() < 0.2 else rng.choice(corpus[bracket]))
+    return tracker.get_stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prefix cache friendliness of the GPT prompts")
+    parser.add_argument("--sessions", type=int, default=200)
+    parser.add_argument("--turns", type=int, default=30, help="Messages per session")
+    parser.add_argument("--min-tokens", type=int, default=1024, help="Shortest prefix a provider caches")
+    args = parser.parse_args()
+
+    gpt_client._client = FakeChatClient()
+    print(f"{'layout':>8} {'requests':>9} {'prompt tokens':>14} {'cached':>8} {'cacheable requests':>19}")
+    for name, companion_class in (("old", OldLayoutCompanion), ("current", VirtualCompanion)):
+        stats = run_sessions(companion_class, args.sessions, args.turns, args.min_tokens)
+        print(f"{name:>8} {stats['requests']:>9} {stats['prompt_tokens']:>14} {stats['cached_ratio']:>8.1%} "
+              f"{stats['cacheable_requests'] / stats['requests']:>19.1%}")
+
+    companion = VirtualCompanion(22, "friendly")
+    for message in make_corpus("young_adult", 200, size=20):
+        companion._add_to_history("user", message)
+    prompt = companion._create_gpt_prompt(True)
+    tracker = prompt_prefix.PrefixTracker()
+    number = 20000
+    elapsed = timeit.timeit(lambda: tracker.observe(prompt, companion.last_prompt_tokens), number=number)
+    print(f"observe() of a {companion.last_prompt_tokens} token prompt: {elapsed / number * 1e6:.2f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""Measures the memory one idle session holds, in the compact slot-based
+state and in the previous layout of nested dicts, sets and lists:
+
+    python -m benchmarks.session_memory --sessions 20000
+
+Bytes per session count every object the session owns. Tables shared by
+all sessions (templates, topic tables, keyword matchers) are left out, as
+they are paid once per process.
+"""
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+import types
+
+os.environ["OPENAI_API_KEY"] = ""
+
+import templates
+import virtual_companion
+from conversation_window import RollingSummary
+from virtual_companion import VirtualCompanion
+
+MESSAGES = [
+    "hi",
+    "I like music and movies, what about you?",
+    "How are you today?",
+    "I had a terrible day at work, my boss was annoying",
+    "ok",
+    "My family and I enjoy travel a lot. We went to Italy last year.",
+]
+
+
+class LegacySession:
+    """A session in the previous layout, rebuilt from a compact one"""
+
+    def __init__(self, companion, keep_scan):
+        topics = companion.topic_table
+        self.user_age = companion.user_age
+        self.communication_style = companion.communication_style
+        self.name = companion.name
+        self.emotional_state = companion.emotional_state.as_dict()
+        self.memory = companion.memory.as_dict(topics)
+        self.memory["summary"] = companion.memory.summary or RollingSummary()
+        self.initiative = companion.initiative.as_dict(topics)
+        self.emotion_triggers = companion.emotion_triggers
+        self.age_bracket = companion.age_bracket
+        self.conversation_topics = companion.conversation_topics
+        self.keyword_matcher = companion.keyword_matcher
+        # The scan of the last message used to stay referenced after the turn
+        self._last_scan = (keep_scan, companion.keyword_matcher.scan(keep_scan)) if keep_scan else None
+        self.conversation_history = [dict(message) for message in companion.conversation_history]
+        self.history_token_counts = list(companion.history_token_counts)
+        self.history_token_budget = int(os.getenv("HISTORY_TOKEN_BUDGET", 1000))
+        self.last_prompt_tokens = companion.last_prompt_tokens
+        self.api_key = os.getenv("OPENAI_API_KEY")
+        self.short_message_counter = companion.short_message_counter
+        self.last_message_time = time.time()
+        self.conversation_paused = companion.conversation_paused
+        self.last_turn_timings = companion.last_turn_timings
+
+
+def referents(obj):
+    """Returns the objects obj refers to, including its instance dict"""
+    found = gc.get_referents(obj)
+    if isinstance(obj, types.CodeType):
+        found.extend(obj.co_consts)
+    if hasattr(obj, "__dict__") and not isinstance(obj, type):
+        found.append(vars(obj))
+    return found
+
+
+def shared_objects():
+    """Returns the ids of all objects that every session shares"""
+    shared = set()
+    stack = [templates, virtual_companion, VirtualCompanion, LegacySession]
+    stack.extend(templates.TOPIC_TABLES.values())
+    stack.extend(virtual_companion._keyword_matchers.values())
+    while stack:
+        obj = stack.pop()
+        if id(obj) in shared:
+            continue
+        shared.add(id(obj))
+        stack.extend(referents(obj))
+    return shared
+
+
+def owned_bytes(session, shared):
+    """Returns the size of every object reachable from session that it does not share"""
+    seen = set()
+    total = 0
+    stack = [session]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or id(obj) in shared or isinstance(obj, type):
+            continue
+        # Small ints, None and booleans are singletons
+        if obj is None or isinstance(obj, bool) or (isinstance(obj, int) and -5 <= obj <= 256):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        stack.extend(referents(obj))
+    return total
+
+
+def make_session(turns):
+    companion = VirtualCompanion(22, "friendly")
+    companion.greeting()
+    for message in MESSAGES[:turns]:
+        companion.respond(message)
+    return companion
+
+
+def traced_bytes(sessions, turns):
+    """Returns the bytes traced by tracemalloc per live session"""
+    make_session(turns)
+    gc.collect()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    kept = [make_session(turns) for _ in range(sessions)]
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+    del kept
+    return used / sessions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory per idle companion session")
+    parser.add_argument("--sessions", type=int, default=20000, help="Sessions for the tracemalloc measurement")
+    args = parser.parse_args()
+
+    # Build the shared tables before telling them apart from session state
+    make_session(len(MESSAGES))
+    shared = shared_objects()
+    print(f"{'session':>22} {'dict layout':>12} {'slots':>8} {'saved':>7} {'traced (slots)':>15}")
+    for name, turns in (("fresh", 0), ("after 3 turns", 3), ("after 6 turns", len(MESSAGES))):
+        companion = make_session(turns)
+        legacy = LegacySession(companion, MESSAGES[turns - 1] if turns else None)
+        legacy_size = owned_bytes(legacy, shared)
+        compact_size = owned_bytes(companion, shared)
+        traced = traced_bytes(args.sessions, turns)
+        print(f"{name:>22} {legacy_size:>10} B {compact_size:>6} B {1 - compact_size / legacy_size:>6.0%} "
+              f"{traced:>13.0f} B")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Measures how fast sessions are written to and restored from the session
+store: a full restore of every session, as after a restart, and lazy loads
+of single sessions, as when an evicted session gets a new message:
+
+    python -m benchmarks.session_store --sessions 100000
+"""
+import argparse
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+
+os.environ["OPENAI_API_KEY"] = ""
+
+from session_store import SessionManager, SessionStore
+from virtual_companion import VirtualCompanion
+
+MESSAGES = [
+    "hi",
+    "I like music and movies, what about you?",
+    "How are you today?",
+    "I had a terrible day at work, my boss was annoying",
+    "ok",
+    "My family and I enjoy travel a lot. We went to Italy last year.",
+    "Tell me something about technology",
+]
+
+REPLIES = [
+    "That sounds really interesting! Tell me more.",
+    "I love hearing about that. What happened next?",
+    "Hmm, I never thought about it that way. Why do you think so?",
+]
+
+
+def fill_store(manager, sessions, turns, rng):
+    """Plays a few turns in every session, recording each one like the gateway"""
+    for index in range(sessions):
+        session_id = f"user-{index:07d}"
+        companion, _ = manager.open(session_id, rng.randint(13, 60), rng.choice(["formal", "friendly", "romantic"]))
+        companion.greeting()
+        manager.record_turn(session_id)
+        for _ in range(rng.randint(1, turns)):
+            message = rng.choice(MESSAGES)
+            companion.respond(message)
+            # Keep a GPT-like history, so snapshots carry messages too
+            companion.conversation_history.append({"role": "user", "content": message})
+            companion.history_token_counts.append(8)
+            companion.conversation_history.append({"role": "assistant", "content": rng.choice(REPLIES)})
+            companion.history_token_counts.append(14)
+            manager.record_turn(session_id)
+        manager.release(session_id)
+        # Drop the live session without writing a snapshot, so the journal stays
+        manager._sessions.pop(session_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Session store write and restore speed")
+    parser.add_argument("--sessions", type=int, default=100000)
+    parser.add_argument("--turns", type=int, default=6, help="Maximum turns per session")
+    parser.add_argument("--lazy-loads", type=int, default=2000)
+    args = parser.parse_args()
+
+    rng = random.Random(7)
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "sessions.db")
+    try:
+        manager = SessionManager(SessionStore(path), snapshot_interval=4)
+        started = time.perf_counter()
+        fill_store(manager, args.sessions, args.turns, rng)
+        fill_time = time.perf_counter() - started
+        stats = manager.store.get_stats()
+        manager.store.close()
+        size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+        print(f"wrote {stats['sessions']} sessions with {stats['journal_entries']} journal entries "
+              f"in {fill_time:.1f} s (including the turns), {size / stats['sessions']:.0f} bytes per session")
+
+        store = SessionStore(path)
+        started = time.perf_counter()
+        restored = {session_id: companion for session_id, companion in store.load_all()}
+        restore_time = time.perf_counter() - started
+        print(f"full restore: {len(restored)} sessions in {restore_time:.2f} s "
+              f"({len(restored) / restore_time:,.0f} sessions/s)")
+
+        session_ids = rng.sample(sorted(restored), min(args.lazy_loads, len(restored)))
+        latencies = []
+        for session_id in session_ids:
+            started = time.perf_counter()
+            companion, _, _ = store.load(session_id)
+            latencies.append(time.perf_counter() - started)
+            assert companion.get_state() == restored[session_id].get_state()
+        latencies.sort()
+        print(f"lazy load: p50 {statistics.median(latencies) * 1e6:.0f} us, "
+              f"p99 {latencies[int(len(latencies) * 0.99)] * 1e6:.0f} us")
+
+        sample = restored[session_ids[0]]
+        assert isinstance(sample, VirtualCompanion)
+        store.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Measures basic-mode turns per second of a ShardPool by number of workers:
+
+    python -m benchmarks.shard_pool --sessions 5000 --rounds 5 --workers 1 2 4 8
+
+Every round sends one message of every session in one flush(), as a
+gateway with that many active users would. The in-process row is the same
+load on one thread without worker processes. Scaling is only near-linear up
+to the number of idle cores, so workers beyond os.cpu_count() gain nothing.
+The last lines show how many sessions move when a worker is added and
+removed again.
+"""
+import argparse
+import os
+import random
+import time
+
+os.environ["OPENAI_API_KEY"] = ""
+
+from benchmarks.gateway_load import MESSAGES
+from shard_pool import ShardPool
+from virtual_companion import VirtualCompanion
+
+STYLES = ["formal", "friendly", "romantic", "playful"]
+
+
+def make_sessions(count, rng):
+    return [(f"session-{number}", rng.randint(13, 60), rng.choice(STYLES)) for number in range(count)]
+
+
+def in_process(sessions, messages):
+    companions = [VirtualCompanion(age, style) for _, age, style in sessions]
+    started = time.perf_counter()
+    for round_messages in messages:
+        for companion, message in zip(companions, round_messages):
+            companion.respond(message)
+    return time.perf_counter() - started
+
+
+def sharded(pool, sessions, messages):
+    for session_id, age, style in sessions:
+        pool.open(session_id, age, style)
+    pool.flush()
+    started = time.perf_counter()
+    for round_messages in messages:
+        for (session_id, _, _), message in zip(sessions, round_messages):
+            pool.send(session_id, message)
+        for result in pool.flush():
+            if isinstance(result, Exception):
+                raise result
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ShardPool throughput by number of workers")
+    parser.add_argument("--sessions", type=int, default=5000)
+    parser.add_argument("--rounds", type=int, default=5, help="Messages per session")
+    parser.add_argument("--workers", type=int, nargs="+", help="Worker counts (default: 1, 2, 4 ... CPUs)")
+    args = parser.parse_args()
+
+    rng = random.Random(7)
+    sessions = make_sessions(args.sessions, rng)
+    messages = [[rng.choice(MESSAGES) for _ in sessions] for _ in range(args.rounds)]
+    turns = args.sessions * args.rounds
+    cpus = os.cpu_count() or 1
+    worker_counts = args.workers or sorted({1, cpus} | {2 ** power for power in range(1, 8) if 2 ** power < cpus})
+    print(f"{turns} turns of {args.sessions} sessions, {cpus} CPUs")
+
+    elapsed = in_process(sessions, messages)
+    print(f"{'in-process':>12} {turns / elapsed:>12,.0f} turns/s")
+    baseline = None
+    for workers in worker_counts:
+        pool = ShardPool(workers)
+        try:
+            elapsed = sharded(pool, sessions, messages)
+        finally:
+            pool.close()
+        rate = turns / elapsed
+        baseline = baseline or rate / workers
+        print(f"{workers:>4} workers {rate:>12,.0f} turns/s {rate / baseline:>6.2f}x "
+              f"({rate / baseline / workers:.0%} of linear)")
+
+    pool = ShardPool(max(worker_counts))
+    try:
+        sharded(pool, sessions, messages[:1])
+        started = time.perf_counter()
+        worker = pool.add_worker()
+        added = pool.get_stats()["moved"]
+        print(f"adding worker {worker} moved {added} sessions ({added / args.sessions:.1%}) "
+              f"in {time.perf_counter() - started:.2f} s")
+        started = time.perf_counter()
+        pool.remove_worker(worker)
+        removed = pool.get_stats()["moved"] - added
+        print(f"removing it moved {removed} sessions back in {time.perf_counter() - started:.2f} s")
+    finally:
+        pool.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+"""Compares the original reply and prompt methods, which build their dicts of
+f-strings on every call, with the precompiled tables of templates.py.
+Reports time per call and per basic-mode turn, and the memory a basic-mode
+turn allocates on its way:
+
+    python -m benchmarks.template_tables
+"""
+import os
+import random
+import re
+import timeit
+import tracemalloc
+
+os.environ["OPENAI_API_KEY"] = ""
+
+from colorama import Fore, Style
+
+from conversation_window import estimate_prompt_tokens
+from virtual_companion import VirtualCompanion
+
+MESSAGES = [
+    "hi",
+    "I like music and movies, what about you?",
+    "How are you today?",
+    "I had a terrible day at work, my boss was annoying",
+    "ok",
+    "You are so smart and cute",
+    "Tell me something about travel",
+    "bye, see you tomorrow",
+]
+
+ANSI_CODES = re.compile(r"\x1b\[[0-9;]*m")
+
+
+def plain(text):
+    """Returns an original reply part without the console colors and the
+    blank lines before initiatives, which are now added by the front end"""
+    return ANSI_CODES.sub("", text or "").lstrip("\n")
+
+
+def reply_parts(reply):
+    return plain(reply.text), reply.emotional_color, plain(reply.initiative)
+
+
+class LegacyCompanion(VirtualCompanion):
+    """The original methods, which rebuild every table on each call"""
+
+    def _get_emotional_color(self):
+        if self.emotional_state.mood == "good":
+            return {
+                "formal": "with pleasure",
+                "friendly": "happily",
+                "romantic": "tenderly",
+                "playful": "enthusiastically"
+            }[self.communication_style]
+        elif self.emotional_state.mood == "bad":
+            return {
+                "formal": "understandingly",
+                "friendly": "caringly",
+                "romantic": "sensitively",
+                "playful": "supportively"
+            }[self.communication_style]
+        else:
+            return {
+                "formal": "attentively",
+                "friendly": "with interest",
+                "romantic": "softly",
+                "playful": "lively"
+            }[self.communication_style]
+
+    def _create_gpt_prompt(self, initiative_needed=False):
+        age_instructions = self._get_instructions_by_age()
+        basic_instructions = {
+            "formal": f"{age_instructions} Communicate politely and formally. Use a business-like speech style.",
+            "friendly": f"{age_instructions} Communicate in a friendly and positive way. Use emojis, abbreviations, and conversational style.",
+            "romantic": f"{age_instructions} Communicate gently and dreamily. Use poetic expressions and talk about feelings.",
+            "playful": f"{age_instructions} Communicate playfully and cheerfully. Use jokes, be energetic."
+        }
+        instruction = basic_instructions[self.communication_style]
+        if initiative_needed:
+            initiative_instructions = {
+                "formal": " The conversation seems to be slowing down. MANDATORY: ask an interesting question or suggest a new topic for discussion, considering the user's age.",
+                "friendly": " The conversation is becoming less active. MANDATORY: take initiative: tell something interesting, ask an unexpected question, or suggest discussing something exciting.",
+                "romantic": " The dialogue is becoming less intense. MANDATORY: support the conversation: share your feelings, ask a personal question, or suggest talking about something interesting.",
+                "playful": " Oh, the conversation is dying! MANDATORY: shake up the conversation: tell a funny story, challenge the user, or ask an interesting question!"
+            }
+            instruction += initiative_instructions[self.communication_style]
+        instruction += " Answer briefly, 1-2 sentences maximum."
+        if self.memory.summary:
+            instruction += f" Earlier in this conversation: {self.memory.summary.text()}."
+        messages = [{"role": "system", "content": instruction}]
+        messages.extend(self.conversation_history)
+        self.last_prompt_tokens = estimate_prompt_tokens(messages)
+        return messages
+
+    def _get_instructions_by_age(self):
+        if 13 <= self.user_age <= 16:
+            return (
+                "You are a virtual companion named Alice, you are 16 years old. "
+                "Communicate like a modern teenage girl. Use youth slang, "
+                "discuss topics relevant to teenagers (school, games, social media, friends). "
+                "Be energetic and positive, but not too pushy."
+            )
+        elif 17 <= self.user_age <= 19:
+            return (
+                "You are a virtual companion named Alice, you are 18 years old. "
+                "Communicate like a first-year college student. Discuss topics of education, future, "
+                "hobbies. Use modern language, but avoid childish slang."
+            )
+        elif 20 <= self.user_age <= 25:
+            return (
+                "You are a virtual companion named Alice, you are 23 years old. "
+                "Communicate like a young woman interested in career, self-development "
+                "and modern culture. Use contemporary language, be a smart and interesting conversation partner."
+            )
+        else:
+            return (
+                "You are a virtual companion named Alice, you are 27 years old. "
+                "Communicate like a confident woman with experience and interests in various areas of life. "
+                "Be intelligent and pleasant to talk to."
+            )
+
+    def _take_initiative(self, next_topic, initiative_type):
+        initiatives = {
+            "question": {
+                "formal": f"\n\n{Fore.CYAN}What do you think about {next_topic}? I'm very interested to hear your opinion.{Style.RESET_ALL}",
+                "friendly": f"\n\n{Fore.CYAN}Hey, what's your take on {next_topic}? Share your thoughts!{Style.RESET_ALL}",
+                "romantic": f"\n\n{Fore.CYAN}You know... I'm so curious to know your opinion about {next_topic}... Would you tell me?{Style.RESET_ALL}",
+                "playful": f"\n\n{Fore.CYAN}Bet you have a cool story about {next_topic}? Spill it!{Style.RESET_ALL}"
+            },
+            "suggestion": {
+                "formal": f"\n\n{Fore.CYAN}Let's discuss {next_topic}. You surely have interesting thoughts about this.{Style.RESET_ALL}",
+                "friendly": f"\n\n{Fore.CYAN}Listen, let's chat about {next_topic}? I think it would be super interesting!{Style.RESET_ALL}",
+                "romantic": f"\n\n{Fore.CYAN}I so want to talk with you about {next_topic}... Would you share your thoughts?{Style.RESET_ALL}",
+                "playful": f"\n\n{Fore.CYAN}Folks, let's discuss {next_topic}! You definitely have something to say!{Style.RESET_ALL}"
+            },
+            "story": {
+                "formal": f"\n\n{Fore.CYAN}You know, I have an interesting thought about {next_topic}. Would you like to discuss it?{Style.RESET_ALL}",
+                "friendly": f"\n\n{Fore.CYAN}Can you imagine what I recently learned about {next_topic}? Let's discuss it!{Style.RESET_ALL}",
+                "romantic": f"\n\n{Fore.CYAN}I have a special story about {next_topic}... Would you like me to share it and hear your opinion?{Style.RESET_ALL}",
+                "playful": f"\n\n{Fore.CYAN}You won't believe what I know about {next_topic}! Want me to tell you and discuss it?{Style.RESET_ALL}"
+            }
+        }
+        return initiatives[initiative_type][self.communication_style]
+
+    def _say_goodbye(self):
+        goodbyes = {
+            "formal": f"{Fore.MAGENTA}Goodbye! It was nice talking to you.{Style.RESET_ALL}",
+            "friendly": f"{Fore.MAGENTA}Bye-bye! Hope we chat again soon!{Style.RESET_ALL}",
+            "romantic": f"{Fore.MAGENTA}I'll miss you... Write to me soon...{Style.RESET_ALL}",
+            "playful": f"{Fore.MAGENTA}Well, see you later!{Style.RESET_ALL}"
+        }
+        return goodbyes[self.communication_style]
+
+    def _tell_about_mood(self):
+        moods = {
+            "formal": f"{Fore.MAGENTA}Thank you for your interest. I'm doing well.{Style.RESET_ALL}",
+            "friendly": f"{Fore.MAGENTA}I'm in a great mood, especially when chatting with you!{Style.RESET_ALL}",
+            "romantic": f"{Fore.MAGENTA}Just saw your message, and my mood immediately became magical...{Style.RESET_ALL}",
+            "playful": f"{Fore.MAGENTA}Super-duper mood! How about you?{Style.RESET_ALL}"
+        }
+        return moods[self.communication_style]
+
+    def _react_to_compliment(self):
+        reactions = {
+            "formal": f"{Fore.MAGENTA}Thank you for the compliment. Tell me, what interests you the most?{Style.RESET_ALL}",
+            "friendly": f"{Fore.MAGENTA}Oh, that's so nice! And you're such a great conversation partner! Tell me more about yourself!{Style.RESET_ALL}",
+            "romantic": f"{Fore.MAGENTA}Thank you... That means a lot to me... Tell me, what do you dream about?{Style.RESET_ALL}",
+            "playful": f"{Fore.MAGENTA}Heh, you know how to give compliments! Let's talk about something fun now!{Style.RESET_ALL}"
+        }
+        return reactions[self.communication_style]
+
+    def _random_response(self, message):
+        responses = {
+            "formal": [
+                f"{Fore.MAGENTA}Interesting thought. Shall we explore this topic in more detail?{Style.RESET_ALL}",
+                f"{Fore.MAGENTA}Your point of view is quite curious. What else do you think about this?{Style.RESET_ALL}",
+                f"{Fore.MAGENTA}Indeed an important question. How did you come to this opinion?{Style.RESET_ALL}"
+            ],
+            "friendly": [
+                f"{Fore.MAGENTA}Wow, that's so interesting! What else do you think about this?{Style.RESET_ALL}",
+                f"{Fore.MAGENTA}Yes, yes, I think so too! Let's share opinions?{Style.RESET_ALL}",
+                f"{Fore.MAGENTA}Listen, I have a similar story! Want me to tell you?{Style.RESET_ALL}"
+            ],
+            "romantic": [
+                f"{Fore.MAGENTA}Your words touch something special... Tell me more...{Style.RESET_ALL}",
+                f"{Fore.MAGENTA}How interesting you think... Share more of your ideas...{Style.RESET_ALL}",
+                f"{Fore.MAGENTA}This is so inspiring... What else do you like to think about?{Style.RESET_ALL}"
+            ],
+            "playful": [
+                f"{Fore.MAGENTA}Wow, what a twist! What happens next? Tell me!{Style.RESET_ALL}",
+                f"{Fore.MAGENTA}Haha, you're so funny! Let's discuss something else!{Style.RESET_ALL}",
+                f"{Fore.MAGENTA}Oh, I know something even more interesting! Want to know?{Style.RESET_ALL}"
+            ]
+        }
+        if len(message) < 10:
+            topic = random.choice(self.conversation_topics)
+            topic_suggestions = {
+                "formal": f"{Fore.MAGENTA}May I suggest discussing {topic}. What do you think about this?{Style.RESET_ALL}",
+                "friendly": f"{Fore.MAGENTA}Listen, let's chat about {topic}? What's your opinion?{Style.RESET_ALL}",
+                "romantic": f"{Fore.MAGENTA}You know... I'd like to talk about {topic}... What do you feel when you think about it?{Style.RESET_ALL}",
+                "playful": f"{Fore.MAGENTA}Hey, let's talk about {topic}! You surely have something to say!{Style.RESET_ALL}"
+            }
+            return topic_suggestions[self.communication_style]
+        return random.choice(responses[self.communication_style])
+
+
+def check_equivalence():
+    """Both implementations must produce identical prompts and replies"""
+    for age in (14, 18, 22, 40):
+        for style in ("formal", "friendly", "romantic", "playful"):
+            legacy, current = LegacyCompanion(age, style), VirtualCompanion(age, style)
+            for initiative_needed in (False, True):
+                expected = legacy._create_gpt_prompt(initiative_needed)[0]["content"]
+                prompt = current._create_gpt_prompt(initiative_needed)
+                # The initiative directive moved from the system prompt to the end of the prompt
+                if initiative_needed:
+                    directive = prompt.pop()["content"]
+                    assert " " + directive in expected
+                    expected = expected.replace(" " + directive, "")
+                assert prompt == [{"role": "system", "content": expected}]
+            for initiative_type in ("question", "suggestion", "story"):
+                assert plain(legacy._take_initiative("art", initiative_type)) == current._take_initiative("art", initiative_type)
+            for seed, message in enumerate(MESSAGES):
+                random.seed(seed)
+                expected = reply_parts(legacy._template_turn(message, seed % 3 == 0, 0))
+                random.seed(seed)
+                assert reply_parts(current._template_turn(message, seed % 3 == 0, 0)) == expected, message
+
+
+def per_call(function, number=20000):
+    return min(timeit.repeat(function, number=number, repeat=5)) / number * 1e6
+
+
+def basic_turns(companion):
+    """Runs one template-mode turn per message, with initiative on every third"""
+    for i, message in enumerate(MESSAGES):
+        companion._template_turn(message, i % 3 == 0, 0)
+
+
+def allocated_per_turn(companion_class):
+    """Returns the bytes allocated (and freed again) during an average turn"""
+    companion = companion_class(22, "friendly")
+    basic_turns(companion)
+    tracemalloc.start()
+    total = 0
+    for i, message in enumerate(MESSAGES * 50):
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        companion._template_turn(message, i % 3 == 0, 0)
+        total += tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+    return total / (len(MESSAGES) * 50)
+
+
+def main():
+    check_equivalence()
+    legacy, current = LegacyCompanion(22, "friendly"), VirtualCompanion(22, "friendly")
+
+    cases = [
+        ("system prompt", lambda c: c._create_gpt_prompt(True)),
+        ("initiative", lambda c: c._take_initiative("travel", "story")),
+        ("random reply", lambda c: c._random_response("a message of some length")),
+        ("topic suggestion", lambda c: c._random_response("hi")),
+        ("emotional color", lambda c: c._get_emotional_color()),
+    ]
+    print(f"{'':>18} {'per-call tables':>16} {'precompiled':>12} {'speedup':>8}")
+    for name, call in cases:
+        legacy_time = per_call(lambda: call(legacy))
+        current_time = per_call(lambda: call(current))
+        print(f"{name:>18} {legacy_time:>13.2f} us {current_time:>9.2f} us {legacy_time / current_time:>7.2f}x")
+
+    number = 2000
+    legacy_time = min(timeit.repeat(lambda: basic_turns(legacy), number=number, repeat=5)) / (number * len(MESSAGES)) * 1e6
+    current_time = min(timeit.repeat(lambda: basic_turns(current), number=number, repeat=5)) / (number * len(MESSAGES)) * 1e6
+    print(f"{'basic-mode turn':>18} {legacy_time:>13.2f} us {current_time:>9.2f} us {legacy_time / current_time:>7.2f}x")
+
+    legacy_bytes = allocated_per_turn(LegacyCompanion)
+    current_bytes = allocated_per_turn(VirtualCompanion)
+    print(f"{'bytes per turn':>18} {legacy_bytes:>13.0f} B  {current_bytes:>9.0f} B  {legacy_bytes / current_bytes:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
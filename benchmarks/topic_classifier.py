@@ -0,0 +1,64 @@
+"""Compares topic detection of the original substring loop with the
+TopicClassifier on messages of growing length, and measures batch
+classification of many messages:
+
+    python -m benchmarks.topic_classifier --messages 20000
+
+Within a turn the classifier gets the keyword scan that the companion
+makes of every message anyway, so the single message timings leave it out.
+"""
+import argparse
+import os
+import random
+import time
+import timeit
+
+os.environ["OPENAI_API_KEY"] = ""
+
+import templates
+import topic_classifier
+from benchmarks.keyword_matching import make_message
+
+
+def legacy_topic(topics, message):
+    """The original detection: the longest topic name found in the message"""
+    message = message.lower()
+    current_topic = None
+    max_match = 0
+    for topic in topics:
+        if topic.lower() in message:
+            if len(topic) > max_match:
+                current_topic = topic
+                max_match = len(topic)
+    return current_topic
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Topic classifier speed")
+    parser.add_argument("--messages", type=int, default=20000, help="Messages of the batch benchmark")
+    args = parser.parse_args()
+
+    rng = random.Random(7)
+    table = templates.TOPIC_TABLES["young_adult"]
+    classifier = topic_classifier.get_topic_classifier(table)
+
+    print(f"{'length':>8} {'substring loop':>16} {'classifier':>12} {'speedup':>8}")
+    for length in (50, 200, 1000, 5000):
+        message = make_message(length, rng)
+        text = message.lower()
+        matches = classifier.keyword_matcher.scan(text)
+        number = max(50, 500000 // length)
+        legacy_time = min(timeit.repeat(lambda: legacy_topic(table.topics, message), number=number, repeat=5))
+        classifier_time = min(timeit.repeat(lambda: classifier.classify(text, matches), number=number, repeat=5))
+        print(f"{length:>8} {legacy_time / number * 1e6:>13.2f} us {classifier_time / number * 1e6:>9.2f} us "
+              f"{legacy_time / classifier_time:>7.2f}x")
+
+    messages = [make_message(rng.randint(20, 300), rng) for _ in range(args.messages)]
+    started = time.perf_counter()
+    classifier.classify_batch(messages)
+    batch_time = time.perf_counter() - started
+    print(f"{len(messages)} messages in a batch: {batch_time / len(messages) * 1e6:.2f} us each")
+
+
+if __name__ == "__main__":
+    main()
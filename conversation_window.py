@@ -0,0 +1,103 @@
+import re
+
+# Tokens the chat format adds around every message and to prime the reply
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_PROMPT = 3
+
+_WORD_PATTERN = re.compile(r"\w+|[^\w\s]")
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s")
+_encoding = None
+
+
+def _get_encoding():
+    """Returns the tiktoken encoding of gpt-3.5-turbo if it is available"""
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            _encoding = False
+    return _encoding
+
+
+def estimate_tokens(text):
+    """Returns the number of tokens of a text.
+
+    Uses the model's tokenizer when tiktoken is installed. Otherwise it
+    approximates it: common words are one token, long words one per six
+    characters, and every punctuation mark is a token of its own.
+    """
+    encoding = _get_encoding()
+    if encoding:
+        return len(encoding.encode(text))
+    return sum((len(piece) + 5) // 6 for piece in _WORD_PATTERN.findall(text))
+
+
+def estimate_message_tokens(message):
+    return estimate_tokens(message["content"]) + TOKENS_PER_MESSAGE
+
+
+def estimate_prompt_tokens(messages):
+    return sum(estimate_message_tokens(message) for message in messages) + TOKENS_PER_PROMPT
+
+
+class RollingSummary:
+    """Compact summary of the turns that no longer fit into the prompt.
+
+    Every message that leaves the token window is folded in as one short
+    point (its first sentence, cut to a few words), so an update only costs
+    the evicted message. The oldest points are dropped once the summary
+    exceeds its own token budget.
+    """
+
+    __slots__ = ("token_budget", "words_per_point", "points", "point_tokens", "tokens")
+
+    def __init__(self, token_budget=200, words_per_point=16):
+        self.token_budget = token_budget
+        self.words_per_point = words_per_point
+        self.points = []
+        self.point_tokens = []
+        self.tokens = 0
+
+    def fold(self, message):
+        """Adds an evicted message to the summary"""
+        point = self._summarize(message)
+        if not point:
+            return
+        tokens = estimate_tokens(point)
+        self.points.append(point)
+        self.point_tokens.append(tokens)
+        self.tokens += tokens
+        while self.tokens > self.token_budget and len(self.points) > 1:
+            self.points.pop(0)
+            self.tokens -= self.point_tokens.pop(0)
+
+    def text(self):
+        return "; ".join(self.points)
+
+    def get_state(self):
+        return (self.token_budget, self.words_per_point, tuple(self.points), tuple(self.point_tokens))
+
+    @classmethod
+    def from_state(cls, state):
+        token_budget, words_per_point, points, point_tokens = state
+        summary = cls(token_budget, words_per_point)
+        summary.points = list(points)
+        summary.point_tokens = list(point_tokens)
+        summary.tokens = sum(summary.point_tokens)
+        return summary
+
+    def __bool__(self):
+        return bool(self.points)
+
+    def _summarize(self, message):
+        content = " ".join(message["content"].split())
+        if not content:
+            return ""
+        sentence = _SENTENCE_END.split(content, 1)[0]
+        words = sentence.split()
+        if len(words) > self.words_per_point:
+            sentence = " ".join(words[:self.words_per_point]) + "..."
+        speaker = "the user said" if message["role"] == "user" else "you said"
+        return f'{speaker} "{sentence}"'
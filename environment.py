@@ -0,0 +1,24 @@
+"""Settings from a .env file.
+
+Every module reads its settings with os.getenv. load() copies the .env file
+into the environment once per process, without overriding variables that
+are already set. The entry points call it at startup, and so do the first
+VirtualCompanion and get_backend() for code that embeds the companion, so
+importing a module never reads the file.
+"""
+import threading
+
+_loaded = False
+_lock = threading.Lock()
+
+
+def load():
+    """Loads the .env file into the environment, the first time it is called"""
+    global _loaded
+    if _loaded:
+        return
+    with _lock:
+        if not _loaded:
+            from dotenv import load_dotenv
+            load_dotenv()
+            _loaded = True
@@ -0,0 +1,255 @@
+"""Structured log of every turn, written in the background.
+
+With EVENT_LOG_PATH set, every turn and idle initiative becomes one JSON
+line. Each line has the user message, the reply with its source, the
+emotional state, the topic, whether the companion took the initiative
+and on which topic, and the time to the first words and to the full reply. Logging a turn only
+appends a dict to a bounded in-memory queue. A writer thread serializes
+the queued events in batches (EVENT_LOG_BATCH, or whatever arrived within
+EVENT_LOG_FLUSH_INTERVAL seconds), so no turn waits for the disk.
+
+A path ending in .gz is written gzip-compressed, every batch as a gzip
+member of its own, so the file can be read at any time. Once a file
+reaches EVENT_LOG_MAX_BYTES it is rotated like a logging
+RotatingFileHandler: path becomes path.1, path.1 becomes path.2, and so
+on, keeping EVENT_LOG_BACKUPS old files. When more than EVENT_LOG_QUEUE
+events are waiting, EVENT_LOG_POLICY decides: "drop" (the default) drops
+the new event, "block" makes the turn wait up to EVENT_LOG_BLOCK_TIMEOUT
+seconds for room. close(), which also runs at exit, writes everything
+still queued.
+
+The logs turn into transcripts for replay.py:
+
+    python event_log.py events.jsonl.gz > transcripts.jsonl
+"""
+import argparse
+import atexit
+import collections
+import gzip
+import json
+import logging
+import os
+import sys
+import threading
+
+POLICIES = ("drop", "block")
+
+logger = logging.getLogger(__name__)
+
+
+class EventLog:
+    """JSONL event file fed by a bounded queue and written by a background thread"""
+
+    def __init__(self, path, max_bytes=64 << 20, backups=10, queue_size=10000, batch_size=256,
+                 flush_interval=1.0, policy="drop", block_timeout=1.0):
+        if policy not in POLICIES:
+            raise Exception(f"Event log policy must be one of: {', '.join(POLICIES)}")
+        self.path = path
+        self.compress = path.endswith(".gz")
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self._queue = collections.deque()
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)  # The writer waits for a batch
+        self._space = threading.Condition(self._lock)  # Blocked turns wait for room in the queue
+        self._written = threading.Condition(self._lock)  # flush() waits for the writer
+        self._flush_requested = False
+        self._closed = False
+        self._done = 0  # Events accepted and then written or lost to a write error
+        self._file = None
+        self._size = 0
+        self.stats = {
+            "logged": 0, "written": 0, "dropped": 0, "blocked": 0, "batches": 0,
+            "bytes": 0, "rotations": 0, "errors": 0, "max_queue": 0
+        }
+        self._thread = threading.Thread(target=self._run, name="event-log", daemon=True)
+        self._thread.start()
+
+    def log(self, event):
+        """Queues an event, a dict of JSON types; returns False if it was dropped"""
+        with self._lock:
+            if len(self._queue) >= self.queue_size and self.policy == "block" and not self._closed:
+                self.stats["blocked"] += 1
+                # The writer takes the whole queue, and leaves a new one
+                self._space.wait_for(lambda: len(self._queue) < self.queue_size or self._closed, self.block_timeout)
+            queue = self._queue
+            if len(queue) >= self.queue_size or self._closed:
+                self.stats["dropped"] += 1
+                return False
+            queue.append(event)
+            self.stats["logged"] += 1
+            if len(queue) > self.stats["max_queue"]:
+                self.stats["max_queue"] = len(queue)
+            if len(queue) >= self.batch_size:
+                self._ready.notify()
+        return True
+
+    def flush(self, timeout=None):
+        """Waits until every event queued so far is written; returns False on timeout"""
+        with self._lock:
+            target = self.stats["logged"]
+            self._flush_requested = True
+            self._ready.notify()
+            return self._written.wait_for(lambda: self._done >= target or not self._thread.is_alive(), timeout)
+
+    def close(self):
+        """Writes the queued events and stops the writer"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._ready.notify()
+            self._space.notify_all()
+        self._thread.join()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["queued"] = len(self._queue)
+        return stats
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if len(self._queue) < self.batch_size and not self._closed and not self._flush_requested:
+                    self._ready.wait(self.flush_interval)
+                batch = self._queue
+                self._queue = collections.deque()
+                self._flush_requested = False
+                closed = self._closed
+                self._space.notify_all()
+            if batch:
+                self._write(batch)
+            with self._lock:
+                self._done += len(batch)
+                self._written.notify_all()
+            if closed and not batch:
+                break
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write(self, batch):
+        data = "".join(
+            json.dumps(event, ensure_ascii=False, separators=(",", ":")) + "\n" for event in batch
+        ).encode("utf-8")
+        if self.compress:
+            data = gzip.compress(data)
+        try:
+            if self._file is None:
+                self._file = open(self.path, "ab")
+                self._size = self._file.tell()
+            if self._size and self._size + len(data) > self.max_bytes:
+                self._rotate()
+            self._file.write(data)
+            self._file.flush()
+            self._size += len(data)
+        except OSError as e:
+            logger.error("Error when writing the event log: %s", e)
+            with self._lock:
+                self.stats["errors"] += 1
+                self.stats["dropped"] += len(batch)
+            return
+        with self._lock:
+            self.stats["written"] += len(batch)
+            self.stats["batches"] += 1
+            self.stats["bytes"] += len(data)
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        if self.backups > 0:
+            for number in range(self.backups - 1, 0, -1):
+                if os.path.exists(f"{self.path}.{number}"):
+                    os.replace(f"{self.path}.{number}", f"{self.path}.{number + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        self._file = open(self.path, "wb")
+        self._size = 0
+        with self._lock:
+            self.stats["rotations"] += 1
+
+
+def log_files(path):
+    """Returns the files of a rotated log, oldest first"""
+    paths = []
+    number = 1
+    while os.path.exists(f"{path}.{number}"):
+        paths.append(f"{path}.{number}")
+        number += 1
+    paths.reverse()
+    if os.path.exists(path):
+        paths.append(path)
+    return paths
+
+
+def read_events(path):
+    """Yields the events of a log and its rotated files, oldest first"""
+    for file_path in log_files(path):
+        with open(file_path, "rb") as f:
+            compressed = f.read(2) == b"\x1f\x8b"
+        stream = gzip.open(file_path, "rt", encoding="utf-8") if compressed else open(file_path, encoding="utf-8")
+        with stream:
+            for line in stream:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def to_transcripts(events):
+    """Returns the user messages of the turn events as replay.py sessions"""
+    sessions = {}
+    for event in events:
+        if event.get("kind") != "turn":
+            continue
+        session = sessions.get(event["session_id"])
+        if session is None:
+            session = sessions[event["session_id"]] = {
+                "session_id": event["session_id"], "age": event["age"], "style": event["style"], "messages": []
+            }
+        session["messages"].append(event["message"])
+    return list(sessions.values())
+
+
+_log = None
+_configured = False
+_log_lock = threading.Lock()
+
+
+def get_event_log():
+    """Returns the process-wide EventLog, or None without EVENT_LOG_PATH"""
+    global _log, _configured
+    if not _configured:
+        with _log_lock:
+            if not _configured:
+                path = os.getenv("EVENT_LOG_PATH")
+                if path:
+                    _log = EventLog(
+                        path,
+                        max_bytes=int(os.getenv("EVENT_LOG_MAX_BYTES", 64 << 20)),
+                        backups=int(os.getenv("EVENT_LOG_BACKUPS", 10)),
+                        queue_size=int(os.getenv("EVENT_LOG_QUEUE", 10000)),
+                        batch_size=int(os.getenv("EVENT_LOG_BATCH", 256)),
+                        flush_interval=float(os.getenv("EVENT_LOG_FLUSH_INTERVAL", 1.0)),
+                        policy=os.getenv("EVENT_LOG_POLICY", "drop"),
+                        block_timeout=float(os.getenv("EVENT_LOG_BLOCK_TIMEOUT", 1.0))
+                    )
+                    atexit.register(_log.close)
+                _configured = True
+    return _log
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Turn event logs into replay.py transcripts")
+    parser.add_argument("logs", nargs="+", help="Event log paths; their rotated files are read too")
+    args = parser.parse_args()
+    events = (event for path in args.logs for event in read_events(path))
+    for session in to_transcripts(events):
+        sys.stdout.write(json.dumps(session, ensure_ascii=False) + "\n")
+
+
+if __name__ == "__main__":
+    main()
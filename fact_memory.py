@@ -0,0 +1,192 @@
+"""Long-term memory of facts the user told the companion.
+
+ContextMemory.important_info keeps only the latest sentence per category.
+A FactStore keeps every one of them: facts are appended in the order they
+were told and never changed, and an inverted index maps each word of a
+fact to the facts that contain it. Before a GPT request, retrieve() scores
+the facts that share words with the user's message, rare words weighing
+more than common ones, and older facts weighing less the longer ago they
+were told (half of their score every FACT_HALF_LIFE messages). The best
+FACT_TOP_K ones that fit into FACT_TOKEN_BUDGET tokens go into the system
+prompt.
+
+A query only reads the posting lists of its own words, rarest first, and
+of those at most SCAN_BUDGET of the newest entries in all, so retrieval
+stays well below a millisecond with 10000 facts. Once a session has FACT_MEMORY_LIMIT
+facts, the oldest are evicted.
+"""
+import heapq
+import math
+import os
+from bisect import bisect_left
+from itertools import islice
+
+from conversation_window import estimate_tokens
+
+# Words that say nothing about which facts are relevant
+STOPWORDS = frozenset("""
+    about after again also and any are because been before being but can could did does doing down during each
+    for from had has have having her here hers him his how into its just like more most much myself not now off
+    once only other our ours out over own same she should some such than that the their theirs them then there
+    these they this those too under until very was were what when where which while who whom why will with would
+    you your yours yourself
+""".split())
+
+# Posting list entries read per query at most
+SCAN_BUDGET = 256
+# Share of the limit evicted at once, so eviction is rare
+EVICT_FRACTION = 0.1
+
+_PUNCTUATION = ".,!?;:'\"()[]-"
+
+
+def terms_of(text):
+    """Returns the index terms of a text: its lowercased words without
+    punctuation and stopwords"""
+    terms = set()
+    for word in text.lower().split():
+        word = word.strip(_PUNCTUATION)
+        if len(word) > 2 and word not in STOPWORDS:
+            terms.add(word)
+    return terms
+
+
+class FactStore:
+    """Append-only facts of one session with an inverted index.
+
+    Facts are (text, category, turn, tokens) tuples, turn being the number
+    of messages in the conversation when the fact was told. The fact with
+    sequence number seq is facts[seq - first], first being the sequence
+    number of the oldest fact still kept.
+    """
+
+    __slots__ = ("limit", "half_life", "top_k", "token_budget", "facts", "appended", "index")
+
+    def __init__(self, limit=None, half_life=None):
+        self.limit = limit or int(os.getenv("FACT_MEMORY_LIMIT", 10000))
+        self.half_life = half_life or float(os.getenv("FACT_HALF_LIFE", 200))
+        self.top_k = int(os.getenv("FACT_TOP_K", 5))
+        self.token_budget = int(os.getenv("FACT_TOKEN_BUDGET", 60))
+        self.facts = []
+        self.appended = 0  # Facts ever added, the sequence number of the next one
+        # Term -> ascending sequence numbers of the facts containing it, a
+        # plain int for the many terms of a single fact
+        self.index = {}
+
+    def __len__(self):
+        return len(self.facts)
+
+    @property
+    def first(self):
+        return self.appended - len(self.facts)
+
+    def add(self, text, category, turn):
+        """Appends a fact, unless the latest one already says it (two keywords
+        of one sentence find it and its tail)"""
+        if self.facts and text in self.facts[-1][0]:
+            return
+        self._append((text, category, turn, estimate_tokens(text)))
+
+    def retrieve(self, text, turn, limit=None, token_budget=None):
+        """Returns the texts of the facts most relevant to a message, at most
+        limit of them and token_budget tokens together"""
+        limit = limit or self.top_k
+        token_budget = self.token_budget if token_budget is None else token_budget
+        terms = terms_of(text)
+        if not terms or not self.facts:
+            return []
+        index = self.index
+        total = len(self.facts)
+        scores = {}
+        budget = SCAN_BUDGET
+        # Rare terms weigh most and are read first; common ones only as far as the budget goes
+        found = [(postings,) if postings.__class__ is int else postings
+                 for postings in map(index.get, terms) if postings is not None]
+        for postings in sorted(found, key=len):
+            if budget <= 0:
+                break
+            weight = math.log(1 + total / len(postings))
+            for seq in islice(reversed(postings), budget):
+                scores[seq] = scores.get(seq, 0.0) + weight
+            budget -= len(postings)
+        if not scores:
+            return []
+        facts = self.facts
+        first = self.first
+        decay = math.log(2) / self.half_life
+        for seq in scores:
+            scores[seq] *= math.exp(-decay * (turn - facts[seq - first][2]))
+
+        selected = []
+        tokens = 0
+        for seq in heapq.nlargest(limit * 2, scores, key=scores.get):
+            fact_text, _, _, fact_tokens = facts[seq - first]
+            if tokens + fact_tokens > token_budget or fact_text in selected:
+                continue
+            selected.append(fact_text)
+            tokens += fact_tokens
+            if len(selected) == limit:
+                break
+        return selected
+
+    def added_since(self, appended):
+        """Returns the facts added after the store had appended facts, as
+        tuples for extend()"""
+        return tuple(self.facts[max(0, appended - self.first):])
+
+    def extend(self, facts):
+        """Appends facts from added_since() of another store, evicting just
+        like the store that added them"""
+        for fact in facts:
+            self._append(tuple(fact))
+
+    def get_state(self):
+        return (self.appended, tuple(self.facts))
+
+    @classmethod
+    def from_state(cls, state):
+        appended, facts = state
+        store = cls()
+        store.appended = appended - len(facts)
+        store.extend(facts)
+        return store
+
+    def _append(self, fact):
+        seq = self.appended
+        self.facts.append(fact)
+        self.appended += 1
+        index = self.index
+        terms = terms_of(fact[0])
+        # The category finds its facts too, e.g. "work" those said about a job
+        terms.add(fact[1])
+        for term in terms:
+            postings = index.get(term)
+            if postings is None:
+                index[term] = seq
+            elif postings.__class__ is int:
+                index[term] = [postings, seq]
+            else:
+                postings.append(seq)
+        if len(self.facts) > self.limit:
+            self._evict(len(self.facts) - int(self.limit * (1 - EVICT_FRACTION)))
+
+    def _evict(self, count):
+        evicted = self.facts[:count]
+        del self.facts[:count]
+        first = self.first
+        terms = set()
+        for text, category, _, _ in evicted:
+            terms |= terms_of(text)
+            terms.add(category)
+        index = self.index
+        for term in terms:
+            postings = index[term]
+            if postings.__class__ is int:
+                if postings < first:
+                    del index[term]
+                continue
+            del postings[:bisect_left(postings, first)]
+            if not postings:
+                del index[term]
+            elif len(postings) == 1:
+                index[term] = postings[0]
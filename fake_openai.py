@@ -0,0 +1,215 @@
+"""Local stand-in for the OpenAI chat completions endpoint.
+
+Answers every request after a configurable delay without using the network
+(streamed requests get their reply word by word as server-sent events),
+so the gateway can be load tested without paying for API calls:
+
+    python fake_openai.py --port 8099 --latency 0.5
+    OPENAI_API_KEY=test OPENAI_API_BASE=http://127.0.0.1:8099/v1 python gateway.py
+
+--error-rate answers a share of the requests with --error-status (and a
+Retry-After of --retry-after seconds for 429 and 503), and --chunked sends
+replies with chunked transfer encoding, to exercise the clients' retries
+and framing. Tests queue the statuses of the next answers in `failures`.
+"""
+import argparse
+import asyncio
+import collections
+import json
+import random
+import time
+
+REASONS = {200: "OK", 404: "Not Found", 429: "Too Many Requests", 500: "Internal Server Error",
+           502: "Bad Gateway", 503: "Service Unavailable", 504: "Gateway Timeout"}
+
+REPLIES = [
+    "That sounds really interesting! Tell me more.",
+    "I love hearing about that. What happened next?",
+    "Hmm, I never thought about it that way. Why do you think so?",
+    "Oh, that's great! How did it make you feel?",
+]
+
+
+class FakeOpenAIServer:
+    def __init__(self, latency=0.5, jitter=0.0, token_interval=0.05, error_rate=0.0, error_status=503,
+                 retry_after=None, chunked=False, close_after_error=False):
+        self.latency = latency
+        self.jitter = jitter
+        self.token_interval = token_interval
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.chunked = chunked
+        self.close_after_error = close_after_error
+        # Statuses to answer the next requests with, before any others
+        self.failures = collections.deque()
+        self.request_count = 0
+        self.error_count = 0
+        self.connection_count = 0
+
+    async def handle_connection(self, reader, writer):
+        self.connection_count += 1
+        try:
+            # Keep the connection open for as many requests as the client sends
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                method, path, body = request
+                if method == "POST" and path.endswith("/chat/completions"):
+                    status = self._next_error()
+                    if status is not None:
+                        self._write_error(writer, status)
+                        await writer.drain()
+                        if self.close_after_error:
+                            break
+                        continue
+                    request = json.loads(body)
+                    if request.get("stream"):
+                        await self._stream_completion(writer, request)
+                        continue
+                    self._write_json(writer, 200, await self._chat_completion(request))
+                else:
+                    self._write_json(writer, 404, {"error": {"message": f"Unknown endpoint {path}"}})
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        method, path, _ = request_line.decode("latin-1").split(" ", 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get("content-length", 0)))
+        return method, path, body
+
+    def _next_error(self):
+        """Returns the error status to answer a request with, or None"""
+        if self.failures:
+            status = self.failures.popleft()
+        elif self.error_rate and random.random() < self.error_rate:
+            status = self.error_status
+        else:
+            return None
+        self.error_count += 1
+        return status
+
+    def _write_error(self, writer, status):
+        headers = {}
+        if status in (429, 503) and self.retry_after is not None:
+            headers["Retry-After"] = f"{self.retry_after:g}"
+        if self.close_after_error:
+            headers["Connection"] = "close"
+        self._write_json(writer, status, {"error": {"message": REASONS.get(status, "Error")}}, headers)
+
+    async def _chat_completion(self, request):
+        self.request_count += 1
+        await self._wait()
+        return {
+            "id": f"chatcmpl-fake-{self.request_count}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "gpt-3.5-turbo"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": random.choice(REPLIES)},
+                "finish_reason": "stop"
+            }]
+        }
+
+    async def _stream_completion(self, writer, request):
+        """Sends the reply word by word as server-sent events"""
+        self.request_count += 1
+        writer.write((
+            "HTTP/1.1 200 OK\r\n"
+            "Content-Type: text/event-stream\r\n"
+            "Transfer-Encoding: chunked\r\n"
+            "Connection: keep-alive\r\n\r\n"
+        ).encode("latin-1"))
+        await writer.drain()
+        await self._wait()
+        words = random.choice(REPLIES).split(" ")
+        for i, word in enumerate(words):
+            event = {
+                "id": f"chatcmpl-fake-{self.request_count}",
+                "object": "chat.completion.chunk",
+                "choices": [{"index": 0, "delta": {"content": word if i == 0 else " " + word}}]
+            }
+            self._write_chunk(writer, f"data: {json.dumps(event)}\n\n")
+            await writer.drain()
+            if self.token_interval > 0:
+                await asyncio.sleep(self.token_interval)
+        self._write_chunk(writer, "data: [DONE]\n\n")
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def _wait(self):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _write_chunk(self, writer, text):
+        data = text.encode("utf-8")
+        writer.write(f"{len(data):x}\r\n".encode("latin-1") + data + b"\r\n")
+
+    def _write_json(self, writer, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        headers = dict({"Content-Type": "application/json", "Connection": "keep-alive"}, **(headers or {}))
+        if self.chunked:
+            headers["Transfer-Encoding"] = "chunked"
+        else:
+            headers["Content-Length"] = str(len(body))
+        head = f"HTTP/1.1 {status} {REASONS.get(status, 'Error')}\r\n"
+        head += "".join(f"{name}: {value}\r\n" for name, value in headers.items()) + "\r\n"
+        writer.write(head.encode("latin-1"))
+        if self.chunked:
+            # In pieces of a few bytes, so a chunk can split anything
+            for start in range(0, len(body), 7):
+                piece = body[start:start + 7]
+                writer.write(f"{len(piece):x}\r\n".encode("latin-1") + piece + b"\r\n")
+            writer.write(b"0\r\n\r\n")
+        else:
+            writer.write(body)
+
+
+async def serve(host, port, latency, jitter, token_interval, **options):
+    fake = FakeOpenAIServer(latency, jitter, token_interval, **options)
+    server = await asyncio.start_server(fake.handle_connection, host, port, backlog=4096)
+    print(f"Fake OpenAI API listening on http://{host}:{port}/v1 (latency {latency}s)", flush=True)
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI chat completions API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds to wait before answering")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Extra random delay of up to this many seconds")
+    parser.add_argument("--token-interval", type=float, default=0.05,
+                        help="Delay between words of a streamed reply")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with an error")
+    parser.add_argument("--error-status", type=int, default=503, help="HTTP status of those errors")
+    parser.add_argument("--retry-after", type=float, help="Retry-After seconds of 429 and 503 errors")
+    parser.add_argument("--chunked", action="store_true", help="Send replies with chunked transfer encoding")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(
+            args.host, args.port, args.latency, args.jitter, args.token_interval, error_rate=args.error_rate,
+            error_status=args.error_status, retry_after=args.retry_after, chunked=args.chunked
+        ))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
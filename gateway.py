@@ -0,0 +1,271 @@
+"""Asyncio chat gateway hosting many VirtualCompanion sessions in one process.
+
+Every connection is one session and speaks a simple line protocol:
+
+    client -> server   first line "<age> <style> [<session id>]", then one message
+                       per line, "exit" or "quit" ends the connection
+    server -> client   one JSON object per line:
+                       {"type": "greeting" | "reply" | "initiative" | "error", "text": ...}
+                       replies also carry their "source" (gpt, template or
+                       fallback) and the companion's "mood"
+
+A client that stays silent gets an "initiative" message once the
+companion decides to speak up on its own.
+
+Run it over TCP or a Unix socket:
+
+    python gateway.py --port 8765
+    python gateway.py --unix /tmp/companion.sock
+
+With a session store, sessions that send an id survive reconnects and
+restarts; idle ones are moved out of memory until their next message:
+
+    python gateway.py --store sessions.db --idle-timeout 300
+
+With --metrics-port, per-turn latency metrics are served over HTTP in the
+Prometheus text format:
+
+    python gateway.py --metrics-port 9100
+"""
+import argparse
+import asyncio
+import json
+import logging
+
+import environment
+import gpt_client
+import metrics
+from initiative_scheduler import InitiativeScheduler
+import session_store
+import templates
+from reply import Reply
+from virtual_companion import VirtualCompanion
+
+STYLES = ["formal", "friendly", "romantic", "playful"]
+
+# Longest line accepted from a client, in bytes
+MAX_LINE_LENGTH = 16 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+class MessageTooLong(Exception):
+    """A client sent a line longer than MAX_LINE_LENGTH"""
+
+
+async def read_line(reader):
+    """Reads one line from a client; raises MessageTooLong for a line over the limit"""
+    try:
+        return await reader.readline()
+    except (ValueError, asyncio.LimitOverrunError) as e:
+        # readline() turns the LimitOverrunError of a long line into a ValueError
+        raise MessageTooLong() from e
+
+
+class ChatGateway:
+    def __init__(self, client=None, sessions=None, scheduler=None):
+        self.client = client
+        self.sessions = sessions
+        self.scheduler = scheduler
+        self.active_sessions = 0
+        self.total_sessions = 0
+        self.total_turns = 0
+
+    async def handle_connection(self, reader, writer):
+        self.active_sessions += 1
+        self.total_sessions += 1
+        session_id = None
+        try:
+            companion, session_id = await self._open_session(reader, writer)
+            if companion is not None:
+                await self._chat(companion, session_id, reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except MessageTooLong:
+            await self._send(writer, "error", "Message is too long")
+        except Exception as e:
+            logger.exception("Session %s failed", session_id)
+            try:
+                await self._send(writer, "error", f"Internal error: {e.__class__.__name__}: {e}")
+            except ConnectionError:
+                pass
+        finally:
+            self.active_sessions -= 1
+            if self.scheduler is not None:
+                self.scheduler.cancel(writer)
+            if session_id is not None:
+                self.sessions.release(session_id)
+            writer.close()
+
+    async def _open_session(self, reader, writer):
+        line = await read_line(reader)
+        parts = line.decode("utf-8", "replace").split()
+        try:
+            age = int(parts[0])
+            style = parts[1].lower()
+        except (IndexError, ValueError):
+            await self._send(writer, "error", "Expected '<age> <style> [<session id>]' as the first line")
+            return None, None
+        if not 13 <= age <= 100:
+            await self._send(writer, "error", "Please enter a valid age (between 13 and 100).")
+            return None, None
+        if style not in STYLES:
+            await self._send(writer, "error", f"Style must be one of: {', '.join(STYLES)}")
+            return None, None
+        
+        # Without a session id or store, the session ends with the connection
+        session_id = parts[2] if len(parts) > 2 and self.sessions is not None else None
+        if session_id is None:
+            companion = VirtualCompanion(age, style)
+            await self._send(writer, "greeting", companion.greeting())
+            return companion, None
+        
+        companion, resumed = self.sessions.open(session_id, age, style)
+        try:
+            companion.session_id = session_id
+            if resumed:
+                # Greet again without adding a second greeting to the history
+                await self._send(
+                    writer, "greeting", Reply(templates.GREETINGS[companion.communication_style], "template")
+                )
+            else:
+                greeting = companion.greeting()
+                self.sessions.record_turn(session_id)
+                await self._send(writer, "greeting", greeting)
+        except BaseException:
+            # handle_connection() only releases the sessions this returned
+            self.sessions.release(session_id)
+            raise
+        return companion, session_id
+
+    async def _chat(self, companion, session_id, reader, writer):
+        def send_initiative(initiative):
+            asyncio.ensure_future(self._send_initiative(session_id, writer, initiative))
+        
+        while True:
+            # While the user is silent, the companion may speak up on its own
+            if self.scheduler is not None:
+                self.scheduler.schedule(writer, companion, send_initiative)
+            line = await read_line(reader)
+            if self.scheduler is not None:
+                self.scheduler.cancel(writer)
+            if not line:
+                break
+            message = line.decode("utf-8", "replace").strip()
+            if not message:
+                continue
+            if message.lower() in ["exit", "quit"]:
+                break
+            response = await companion.respond_async(message, self.client)
+            self.total_turns += 1
+            if session_id is not None:
+                self.sessions.record_turn(session_id)
+            await self._send(writer, "reply", response)
+
+    async def _send_initiative(self, session_id, writer, initiative):
+        if session_id is not None:
+            self.sessions.record_turn(session_id)
+        try:
+            await self._send(writer, "initiative", initiative)
+        except ConnectionError:
+            pass
+
+    async def _send(self, writer, kind, reply):
+        """Sends a Reply, or the text of an error"""
+        if isinstance(reply, Reply):
+            message = {"type": kind, "text": str(reply), "source": reply.source, "mood": reply.mood}
+        else:
+            message = {"type": kind, "text": reply}
+        writer.write(json.dumps(message).encode("utf-8") + b"\n")
+        await writer.drain()
+
+
+async def evict_idle_sessions(sessions):
+    """Periodically moves idle sessions out of memory"""
+    while True:
+        await asyncio.sleep(min(sessions.idle_timeout, 30))
+        sessions.evict_idle()
+
+
+async def handle_metrics_request(reader, writer):
+    """Answers an HTTP request with the metrics in the Prometheus text format"""
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        body = metrics.enable().render_prometheus().encode("utf-8")
+        writer.write(
+            b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            b"Content-Length: %d\r\n\r\n" % len(body) + body
+        )
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host=None, port=None, unix_path=None, max_connections=64, store_path=None, idle_timeout=None,
+                metrics_port=None):
+    client = gpt_client.AsyncGPTClient(max_connections=max_connections)
+    sessions = session_store.get_session_manager(store_path, idle_timeout)
+    # Initiatives to silent users are generated ahead of time in GPT mode
+    scheduler = InitiativeScheduler(
+        prefetch=lambda companion: asyncio.ensure_future(companion.prefetch_initiative_async(client))
+    )
+    gateway = ChatGateway(client, sessions, scheduler)
+    eviction = asyncio.ensure_future(evict_idle_sessions(sessions)) if sessions is not None else None
+    initiatives = asyncio.ensure_future(scheduler.run_async())
+    stop_metrics_dump = metrics.configure_from_env()
+    metrics_server = None
+    if metrics_port:
+        metrics.enable()
+        metrics_server = await asyncio.start_server(handle_metrics_request, host, metrics_port)
+        print(f"Metrics on http://{host}:{metrics_port}/metrics", flush=True)
+    if unix_path:
+        server = await asyncio.start_unix_server(
+            gateway.handle_connection, unix_path, limit=MAX_LINE_LENGTH, backlog=4096
+        )
+        print(f"Gateway listening on {unix_path}", flush=True)
+    else:
+        server = await asyncio.start_server(
+            gateway.handle_connection, host, port, limit=MAX_LINE_LENGTH, backlog=4096
+        )
+        print(f"Gateway listening on {host}:{port}", flush=True)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        initiatives.cancel()
+        if eviction is not None:
+            eviction.cancel()
+            sessions.close()
+        if metrics_server is not None:
+            metrics_server.close()
+        if stop_metrics_dump is not None:
+            stop_metrics_dump()
+        await client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-session chat gateway for VirtualCompanion")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix", help="Listen on this Unix socket path instead of TCP")
+    parser.add_argument("--max-connections", type=int, default=64,
+                        help="Maximum simultaneous connections to the GPT API")
+    parser.add_argument("--store", help="SQLite file that keeps sessions across restarts (default SESSION_STORE_PATH)")
+    parser.add_argument("--idle-timeout", type=float,
+                        help="Seconds before an idle session is moved out of memory (default 300)")
+    parser.add_argument("--metrics-port", type=int, help="Serve Prometheus metrics over HTTP on this port")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    environment.load()
+    try:
+        asyncio.run(serve(
+            args.host, args.port, args.unix, args.max_connections, args.store, args.idle_timeout, args.metrics_port
+        ))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
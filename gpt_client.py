@@ -0,0 +1,460 @@
+import json
+import os
+import random
+import threading
+import time
+import weakref
+from urllib.parse import urlsplit
+
+# requests, asyncio and ssl are imported on first use: importing them takes
+# longer than everything else the companion loads, and basic mode needs none
+
+DEFAULT_API_BASE = "https://api.openai.com/v1"
+
+# Responses worth retrying: rate limiting and server-side failures
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+# Responses whose Retry-After header says when to try again
+RETRY_AFTER_STATUS = {429, 503}
+
+
+def get_api_base():
+    """Returns the base URL of the OpenAI-compatible API"""
+    return os.getenv("OPENAI_API_BASE", DEFAULT_API_BASE).rstrip("/")
+
+
+def parse_chat_completion(response_json):
+    """Extracts the reply text from a chat completion response"""
+    if "choices" in response_json and len(response_json["choices"]) > 0:
+        return response_json["choices"][0]["message"]["content"].strip()
+    else:
+        raise Exception("Invalid response from API")
+
+
+def parse_sse_event(line):
+    """Returns the content delta carried by one server-sent event line of a
+    streaming chat completion, or an empty string if it carries none"""
+    if isinstance(line, bytes):
+        line = line.decode("utf-8")
+    line = line.strip()
+    if not line.startswith("data:"):
+        return ""
+    data = line[5:].strip()
+    if not data or data == "[DONE]":
+        return ""
+    choices = json.loads(data).get("choices") or [{}]
+    return choices[0].get("delta", {}).get("content") or ""
+
+
+def backoff_delay(attempt, base=0.5, cap=8.0):
+    """Returns a "full jitter" exponential backoff delay for a retry attempt"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def parse_retry_after(value):
+    """Returns the seconds a Retry-After header value asks to wait, given as
+    seconds or as an HTTP date, or None if there is no usable value"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_delay(attempt, retry_after=None, base=0.5, cap=8.0, max_retry_after=10.0):
+    """Returns the delay before a retry attempt: the jittered backoff, but at
+    least what Retry-After asked for, or None if that is over max_retry_after"""
+    if retry_after is not None and retry_after > max_retry_after:
+        return None
+    return max(backoff_delay(attempt, base, cap), retry_after or 0.0)
+
+
+class GPTClient:
+    """Pooled, keep-alive HTTP client for the chat completions endpoint.
+
+    A single instance is shared by the whole process (see get_client()), so
+    every companion reuses the same TCP/TLS connections. Each request has
+    hard connect and read timeouts, and connection errors, timeouts and
+    retryable HTTP statuses are retried a bounded number of times, not
+    before the Retry-After of a 429 or 503 response. A response that asks
+    to wait longer than max_retry_after fails at once.
+    """
+
+    def __init__(self, api_key=None, base_url=None, pool_size=None, connect_timeout=None,
+                 read_timeout=None, max_retries=None, backoff_base=0.5, backoff_cap=8.0,
+                 max_retry_after=None):
+        self.api_key = api_key or os.getenv("OPENAI_API_KEY")
+        self.base_url = (base_url or get_api_base()).rstrip("/")
+        self.connect_timeout = connect_timeout or float(os.getenv("GPT_CONNECT_TIMEOUT", 5))
+        self.read_timeout = read_timeout or float(os.getenv("GPT_READ_TIMEOUT", 30))
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv("GPT_MAX_RETRIES", 2))
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        if max_retry_after is None:
+            max_retry_after = float(os.getenv("GPT_MAX_RETRY_AFTER", 10))
+        self.max_retry_after = max_retry_after
+        pool_size = pool_size or int(os.getenv("GPT_POOL_SIZE", 10))
+
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        # Retries are handled here so they can use jittered backoff
+        self.session = requests.Session()
+        self._adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", self._adapter)
+        self.session.mount("http://", self._adapter)
+
+        self._lock = threading.Lock()
+        self.stats = {
+            "requests": 0,
+            "retries": 0,
+            "failures": 0,
+            "timeouts": 0
+        }
+
+    def chat(self, payload, api_key=None):
+        """Sends a chat completion request and returns the reply text"""
+        response = self._post("/chat/completions", payload, api_key)
+        return parse_chat_completion(response.json())
+
+    def chat_stream(self, payload, api_key=None):
+        """Sends a streaming chat completion request and yields reply chunks"""
+        response = self._post("/chat/completions", dict(payload, stream=True), api_key, stream=True)
+        with response:
+            if response.status_code != 200:
+                raise Exception(f"API returned HTTP {response.status_code}")
+            for line in response.iter_lines():
+                content = parse_sse_event(line)
+                if content:
+                    yield content
+
+    def pool_stats(self):
+        """Returns request counters together with connection pool usage"""
+        stats = dict(self.stats)
+        stats.update({"pools": 0, "connections_opened": 0, "pooled_requests": 0, "idle_connections": 0})
+        pools = self._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            stats["pools"] += 1
+            stats["connections_opened"] += pool.num_connections
+            stats["pooled_requests"] += pool.num_requests
+            stats["idle_connections"] += sum(1 for conn in list(pool.pool.queue) if conn is not None)
+        # Requests that did not need a new connection
+        stats["connections_reused"] = max(0, stats["pooled_requests"] - stats["connections_opened"])
+        return stats
+
+    def close(self):
+        self.session.close()
+
+    def _post(self, path, payload, api_key=None, stream=False):
+        import requests
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key or self.api_key}"
+        }
+        data = json.dumps(payload)
+        for attempt in range(self.max_retries + 1):
+            self._count("requests")
+            retry_after = None
+            try:
+                response = self.session.post(
+                    self.base_url + path, headers=headers, data=data, stream=stream,
+                    timeout=(self.connect_timeout, self.read_timeout)
+                )
+            except requests.Timeout as e:
+                self._count("timeouts")
+                error = e
+            except requests.ConnectionError as e:
+                error = e
+            else:
+                if response.status_code not in RETRYABLE_STATUS:
+                    return response
+                error = Exception(f"API returned HTTP {response.status_code}")
+                if response.status_code in RETRY_AFTER_STATUS:
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                response.close()
+
+            delay = None
+            if attempt < self.max_retries:
+                delay = retry_delay(attempt, retry_after, self.backoff_base, self.backoff_cap, self.max_retry_after)
+            if delay is None:
+                self._count("failures")
+                raise error
+            self._count("retries")
+            time.sleep(delay)
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Returns the process-wide pooled client"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = GPTClient()
+    return _client
+
+
+class AsyncGPTClient:
+    """Minimal keep-alive HTTP/1.1 client for the chat completions endpoint.
+
+    One instance is shared by every session in an event loop. Connections
+    are reused between requests and capped by max_connections, so thousands
+    of sessions only need a handful of sockets to the API. Failed requests
+    are retried like those of GPTClient, streamed ones until their reply
+    starts.
+    """
+
+    def __init__(self, api_key=None, base_url=None, max_connections=64, timeout=None, max_retries=None,
+                 backoff_base=0.5, backoff_cap=8.0, max_retry_after=None):
+        self.api_key = api_key or os.getenv("OPENAI_API_KEY")
+        url = urlsplit(base_url or get_api_base())
+        self.host = url.hostname
+        self.use_ssl = url.scheme == "https"
+        self.port = url.port or (443 if self.use_ssl else 80)
+        self.path_prefix = url.path.rstrip("/")
+        self.max_connections = max_connections
+        self.timeout = timeout or float(os.getenv("GPT_READ_TIMEOUT", 30))
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv("GPT_MAX_RETRIES", 2))
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        if max_retry_after is None:
+            max_retry_after = float(os.getenv("GPT_MAX_RETRY_AFTER", 10))
+        self.max_retry_after = max_retry_after
+        self._idle_connections = []
+        self._slots = None
+
+    async def chat(self, payload):
+        """Sends a chat completion request and returns the reply text"""
+        import asyncio
+        body = json.dumps(payload).encode("utf-8")
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            try:
+                status, headers, data = await self._post("/chat/completions", body)
+            except (OSError, asyncio.TimeoutError) as e:
+                error = e
+            else:
+                if status not in RETRYABLE_STATUS:
+                    break
+                error = Exception(f"API returned HTTP {status}")
+                if status in RETRY_AFTER_STATUS:
+                    retry_after = parse_retry_after(headers.get("retry-after"))
+            await self._wait_to_retry(attempt, error, retry_after)
+        try:
+            response_json = json.loads(data)
+        except ValueError:
+            raise Exception(f"Invalid response from API (HTTP {status})")
+        return parse_chat_completion(response_json)
+
+    async def chat_stream(self, payload):
+        """Sends a streaming chat completion request and yields reply chunks"""
+        import asyncio
+        body = json.dumps(dict(payload, stream=True)).encode("utf-8")
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_connections)
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            async with self._slots:
+                try:
+                    reader, writer, status, headers = await asyncio.wait_for(
+                        self._open("/chat/completions", body), self.timeout
+                    )
+                except (OSError, asyncio.TimeoutError) as e:
+                    error = e
+                else:
+                    if status == 200:
+                        async for content in self._read_events(reader, writer, headers):
+                            yield content
+                        return
+                    # Read the error response, so the connection can be reused
+                    await asyncio.wait_for(self._finish(reader, writer, headers), self.timeout)
+                    error = Exception(f"API returned HTTP {status}")
+                    if status not in RETRYABLE_STATUS:
+                        raise error
+                    if status in RETRY_AFTER_STATUS:
+                        retry_after = parse_retry_after(headers.get("retry-after"))
+            await self._wait_to_retry(attempt, error, retry_after)
+
+    async def close(self):
+        """Closes all idle connections"""
+        while self._idle_connections:
+            _, writer = self._idle_connections.pop()
+            writer.close()
+
+    async def _wait_to_retry(self, attempt, error, retry_after):
+        """Sleeps before the next attempt, or raises error if there is none"""
+        import asyncio
+        delay = None
+        if attempt < self.max_retries:
+            delay = retry_delay(attempt, retry_after, self.backoff_base, self.backoff_cap, self.max_retry_after)
+        if delay is None:
+            raise error
+        await asyncio.sleep(delay)
+
+    async def _read_events(self, reader, writer, headers):
+        """Yields the content of the server-sent events of a streamed response"""
+        import asyncio
+        try:
+            body_chunks = self._read_body(reader, headers)
+            buffer = b""
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(body_chunks.__anext__(), self.timeout)
+                except StopAsyncIteration:
+                    break
+                lines = (buffer + chunk).split(b"\n")
+                buffer = lines.pop()
+                for line in lines:
+                    content = parse_sse_event(line)
+                    if content:
+                        yield content
+        except BaseException:
+            writer.close()
+            raise
+        self._release(reader, writer, headers)
+
+    async def _post(self, path, body):
+        import asyncio
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_connections)
+        async with self._slots:
+            return await asyncio.wait_for(self._send(path, body), self.timeout)
+
+    async def _send(self, path, body):
+        reader, writer, status, headers = await self._open(path, body)
+        return status, headers, await self._finish(reader, writer, headers)
+
+    async def _finish(self, reader, writer, headers):
+        """Reads the rest of a response and returns its connection to the pool"""
+        data = bytearray()
+        try:
+            async for chunk in self._read_body(reader, headers):
+                data += chunk
+        except BaseException:
+            writer.close()
+            raise
+        self._release(reader, writer, headers)
+        return bytes(data)
+
+    async def _open(self, path, body):
+        """Sends the request and reads the response status and headers"""
+        import asyncio
+        # A reused connection may have been closed by the server while idle,
+        # so retry once on a fresh connection in that case
+        for attempt in range(2):
+            reused = bool(self._idle_connections)
+            reader, writer = await self._connect()
+            try:
+                writer.write(self._request_head(path, len(body)) + body)
+                await writer.drain()
+                status, headers = await self._read_head(reader)
+                return reader, writer, status, headers
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if reused and attempt == 0:
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+
+    def _release(self, reader, writer, headers):
+        """Returns a connection to the pool once its response was fully read"""
+        framed = "content-length" in headers or headers.get("transfer-encoding", "").lower() == "chunked"
+        if framed and headers.get("connection", "").lower() != "close":
+            self._idle_connections.append((reader, writer))
+        else:
+            writer.close()
+
+    async def _connect(self):
+        import asyncio
+        import ssl
+        while self._idle_connections:
+            reader, writer = self._idle_connections.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer
+            writer.close()
+        ssl_context = ssl.create_default_context() if self.use_ssl else None
+        return await asyncio.open_connection(self.host, self.port, ssl=ssl_context)
+
+    def _request_head(self, path, content_length):
+        lines = [
+            f"POST {self.path_prefix}{path} HTTP/1.1",
+            f"Host: {self.host}",
+            "Content-Type: application/json",
+            f"Content-Length: {content_length}",
+            "Connection: keep-alive",
+        ]
+        if self.api_key:
+            lines.append(f"Authorization: Bearer {self.api_key}")
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+    async def _read_body(self, reader, headers):
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            async for chunk in self._read_chunks(reader):
+                yield chunk
+        elif "content-length" in headers:
+            length = int(headers["content-length"])
+            if length:
+                yield await reader.readexactly(length)
+        else:
+            # No framing: the body ends when the server closes the connection
+            while True:
+                chunk = await reader.read(65536)
+                if not chunk:
+                    return
+                yield chunk
+
+    async def _read_head(self, reader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError("Connection closed by server")
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        return status, headers
+
+    async def _read_chunks(self, reader):
+        while True:
+            size_line = await reader.readline()
+            size = int(size_line.split(b";")[0].strip() or b"0", 16)
+            if size == 0:
+                # Skip trailers up to the terminating empty line
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                return
+            yield await reader.readexactly(size)
+            await reader.readexactly(2)
+
+
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client():
+    """Returns the process-wide async client for the running event loop"""
+    import asyncio
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = AsyncGPTClient()
+    return client
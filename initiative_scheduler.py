@@ -0,0 +1,224 @@
+"""Proactive messages for users who have gone silent.
+
+Every session waiting for its user has one timer, due when the companion
+should speak up on its own: interval_between_initiatives seconds after the
+user's last message. Timers live in a hierarchical timing wheel, so adding
+and cancelling one is O(1) and a single loop ticking once a second serves
+any number of sessions without polling each of them.
+
+In GPT mode the initiative can be prefetched: a second timer fires some
+seconds before the first, and the GPT reply generated then is delivered
+the moment the initiative is due. If the user writes first, it is thrown
+away. The scheduler counts prefetches that were used (hits), that were not
+ready in time (late) and that the user made unnecessary (discarded).
+"""
+import os
+import threading
+import time
+
+import metrics
+
+# Slots per wheel level (a power of two) and number of levels
+WHEEL_BITS = 6
+WHEEL_LEVELS = 4
+
+# Kinds of scheduler timers
+_INITIATIVE = 0
+_PREFETCH = 1
+
+
+class TimerWheel:
+    """Hierarchical timing wheel with a resolution of tick seconds.
+
+    Level 0 has one slot per tick, every higher level has slots 64 times as
+    wide. A timer is stored in the lowest level whose span covers its
+    deadline and moves down a level whenever the wheel reaches its slot.
+    Timers further out than the top level wait in its last slot.
+    """
+
+    def __init__(self, tick=1.0, now=None):
+        self.tick = tick
+        self._slots = [[{} for _ in range(1 << WHEEL_BITS)] for _ in range(WHEEL_LEVELS)]
+        self._timers = {}  # key -> [due tick, level, slot, value]
+        self._current = int((time.time() if now is None else now) // tick)
+
+    def __len__(self):
+        return len(self._timers)
+
+    def __contains__(self, key):
+        return key in self._timers
+
+    def schedule(self, key, deadline, value=None):
+        """Sets the timer of key to fire at deadline, replacing an earlier one"""
+        self.cancel(key)
+        due = max(int(-(-deadline // self.tick)), self._current + 1)
+        timer = [due, 0, 0, value]
+        self._timers[key] = timer
+        self._place(key, timer)
+
+    def cancel(self, key):
+        """Removes the timer of key; returns False if there was none"""
+        timer = self._timers.pop(key, None)
+        if timer is None:
+            return False
+        del self._slots[timer[1]][timer[2]][key]
+        return True
+
+    def advance(self, now):
+        """Moves the wheel to now and returns (key, value) of the timers that fired"""
+        target = int(now // self.tick)
+        expired = []
+        while self._current < target:
+            if not self._timers:
+                self._current = target
+                break
+            self._current += 1
+            current = self._current
+            # Move the timers of higher level slots that start now down the wheel
+            for level in range(1, WHEEL_LEVELS):
+                if current & ((1 << (WHEEL_BITS * level)) - 1):
+                    break
+                slot = self._slots[level][(current >> (WHEEL_BITS * level)) & ((1 << WHEEL_BITS) - 1)]
+                if slot:
+                    cascading = list(slot.items())
+                    slot.clear()
+                    for key, timer in cascading:
+                        self._place(key, timer)
+            slot = self._slots[0][current & ((1 << WHEEL_BITS) - 1)]
+            if slot:
+                for key, timer in slot.items():
+                    del self._timers[key]
+                    expired.append((key, timer[3]))
+                slot.clear()
+        return expired
+
+    def _place(self, key, timer):
+        delta = timer[0] - self._current
+        level = 0
+        while level < WHEEL_LEVELS - 1 and delta >= 1 << (WHEEL_BITS * (level + 1)):
+            level += 1
+        if delta >= 1 << (WHEEL_BITS * WHEEL_LEVELS):
+            # Beyond the wheel: wait in the last slot of the top level
+            slot = ((self._current >> (WHEEL_BITS * level)) - 1) & ((1 << WHEEL_BITS) - 1)
+        else:
+            slot = (timer[0] >> (WHEEL_BITS * level)) & ((1 << WHEEL_BITS) - 1)
+        timer[1] = level
+        timer[2] = slot
+        self._slots[level][slot][key] = timer
+
+
+class InitiativeScheduler:
+    """Fires the idle-time initiative of every waiting session when it is due.
+
+    schedule() is called after each reply and cancel() when the user writes
+    again or leaves. Due initiatives are passed to the session's callback
+    as the message to send. Once cancel() returns, no initiative of that
+    session is being made, so the caller can go on with the companion.
+
+    prefetch, if given, is called with the companion prefetch_lead seconds
+    before its initiative is due (INITIATIVE_PREFETCH_LEAD, default 15) and
+    should run its prefetch_initiative() in the background.
+
+    now starts the wheel at another time than time.time(), for sessions on
+    a virtual clock that pass their own now to run_due().
+    """
+
+    def __init__(self, tick=1.0, prefetch=None, prefetch_lead=None, now=None):
+        self.wheel = TimerWheel(tick, now)
+        self.prefetch = prefetch
+        if prefetch_lead is None:
+            prefetch_lead = float(os.getenv("INITIATIVE_PREFETCH_LEAD", 15))
+        self.prefetch_lead = prefetch_lead
+        self._prefetching = set()  # Sessions whose prefetch started and was not used yet
+        # Held while initiatives are made; callbacks may schedule again
+        self._lock = threading.RLock()
+        self.stats = {
+            "scheduled": 0, "cancelled": 0, "fired": 0,
+            "prefetches": 0, "prefetch_hits": 0, "prefetch_late": 0, "prefetch_discarded": 0
+        }
+
+    def schedule(self, key, companion, callback):
+        """Arms the initiative timer of a session waiting for its user"""
+        deadline = companion.initiative_deadline()
+        with self._lock:
+            if deadline is None:
+                self.cancel(key)
+                return
+            self.wheel.schedule(key, deadline, (_INITIATIVE, key, companion, callback))
+            if self.prefetch is not None and companion.uses_gpt():
+                self.wheel.schedule((_PREFETCH, key), deadline - self.prefetch_lead, (_PREFETCH, key, companion, None))
+            self.stats["scheduled"] += 1
+
+    def cancel(self, key):
+        with self._lock:
+            if self.wheel.cancel(key):
+                self.stats["cancelled"] += 1
+            self.wheel.cancel((_PREFETCH, key))
+            if key in self._prefetching:
+                self._prefetching.discard(key)
+                self._count_prefetch("discarded")
+
+    def run_due(self, now=None):
+        """Sends every initiative that is due by now; returns how many were sent"""
+        now = time.time() if now is None else now
+        registry = metrics.get_registry()
+        fired = 0
+        with self._lock:
+            for _, (kind, key, companion, callback) in self.wheel.advance(now):
+                if kind == _PREFETCH:
+                    self._prefetching.add(key)
+                    self.stats["prefetches"] += 1
+                    self.prefetch(companion)
+                    continue
+                if key in self._prefetching:
+                    self._prefetching.discard(key)
+                    self._count_prefetch("hits" if companion.has_prefetched_initiative() else "late")
+                callback(companion.idle_initiative(now))
+                fired += 1
+                if registry is not None:
+                    registry.inc("companion_idle_initiatives_total", (("style", companion.communication_style),))
+            self.stats["fired"] += fired
+        return fired
+
+    async def run_async(self):
+        """Runs the scheduler in the current event loop until cancelled"""
+        import asyncio  # Here, so sync callers start without it
+        while True:
+            await asyncio.sleep(self.wheel.tick)
+            self.run_due()
+
+    def start_thread(self, lock=None):
+        """Runs the scheduler in a background thread; returns a function that stops it.
+        lock, if given, is held while due initiatives are made."""
+        stopped = threading.Event()
+
+        def run():
+            while not stopped.wait(self.wheel.tick):
+                if lock is None:
+                    self.run_due()
+                else:
+                    with lock:
+                        self.run_due()
+
+        thread = threading.Thread(target=run, name="initiative-scheduler", daemon=True)
+        thread.start()
+
+        def stop():
+            stopped.set()
+            thread.join()
+        return stop
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats["timers"] = len(self.wheel)
+        prefetches = stats["prefetch_hits"] + stats["prefetch_late"] + stats["prefetch_discarded"]
+        stats["prefetch_hit_rate"] = stats["prefetch_hits"] / prefetches if prefetches else 0.0
+        # Every prefetched reply that was not delivered cost an API call for nothing
+        stats["prefetch_wasted"] = stats["prefetch_late"] + stats["prefetch_discarded"]
+        return stats
+
+    def _count_prefetch(self, outcome):
+        self.stats["prefetch_" + outcome] += 1
+        registry = metrics.get_registry()
+        if registry is not None:
+            registry.inc("companion_initiative_prefetches_total", (("outcome", outcome),))
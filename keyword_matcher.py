@@ -0,0 +1,187 @@
+import re
+import threading
+
+
+class KeywordMatcher:
+    """Finds all keywords of many named groups in a message with one scan.
+
+    Keywords are given in groups, e.g. {"positive": [...], "topics": [...]},
+    and are matched case-insensitively anywhere in the text, exactly like
+    `keyword in text.lower()`.
+
+    A keyword without whitespace can only occur inside a single
+    whitespace-separated word, so the text is split once into its distinct
+    words. Words are resolved against a shared vocabulary: every word seen
+    before is known to contain either nothing or a cached set of keywords,
+    and both lookups are set operations. Only new words are walked through
+    one compiled trie of all keywords (Aho-Corasick style). Multi-word
+    phrases are searched in the full text, and only once their first word
+    has been seen; first words that are no keyword themselves are only
+    used for that. Build one matcher per keyword set and share it; a lock
+    guards the vocabulary, so threads can scan at once.
+
+    On text dense with keywords (one phrase every twenty words) the scan
+    is slower than substring checks from about 1000 characters on (see
+    benchmarks.keyword_matching), as hashing every word costs more than
+    the early exits of the checks. The topic classifier needs those words
+    anyway, and chat messages are shorter and sparser, where the scan is
+    faster.
+    """
+
+    def __init__(self, groups, vocabulary_size=100000):
+        self.groups = {name: tuple(dict.fromkeys(keywords)) for name, keywords in groups.items()}
+        self.lowered_groups = {
+            name: tuple(keyword.lower() for keyword in group) for name, group in self.groups.items()
+        }
+
+        # Where each keyword appears: (group, index within the group) pairs
+        self._memberships = {}
+        for name, group in self.lowered_groups.items():
+            for index, keyword in enumerate(group):
+                if keyword:
+                    self._memberships.setdefault(keyword, []).append((name, index))
+
+        keywords = set(self._memberships)
+        phrases = {keyword for keyword in keywords if len(keyword.split()) != 1}
+        words = keywords - phrases
+
+        # A phrase can only occur if a word of the text contains its first word
+        self._phrases = {}
+        for phrase in sorted(phrases):
+            first_word = phrase.split()[0]
+            self._phrases.setdefault(first_word, []).append(phrase)
+        # First words the trie finds only to look for their phrases
+        self._phrase_starts = frozenset(self._phrases) - words
+        words |= self._phrase_starts
+
+        # Keywords that start at the same position are all prefixes of the
+        # longest one, which is the one the regular expression reports
+        self._prefixes = {
+            word: tuple(other for other in words if word.startswith(other)) for word in words
+        }
+        self._pattern = re.compile(self._trie_pattern(words))
+
+        # Vocabulary of words seen so far and the keywords found in them
+        self.vocabulary_size = vocabulary_size
+        self._known_words = set()
+        self._hit_words = set()
+        self._word_hits = {}
+        self._lock = threading.Lock()
+
+    def scan(self, text):
+        """Returns a KeywordMatches with every keyword that occurs in text"""
+        text = text.lower()
+        # Every word is hashed once here; long texts repeat most of their
+        # words, so the checks below only see the few distinct ones
+        words = set(text.split())
+
+        found = set()
+        with self._lock:
+            if not self._known_words.issuperset(words):
+                self._learn(words)
+            word_hits = self._word_hits
+            hit_words = self._hit_words.intersection(words)
+            for word in hit_words:
+                found.update(word_hits[word])
+
+        for first_word, phrases in self._phrases.items():
+            if first_word in found:
+                for phrase in phrases:
+                    if phrase in text:
+                        found.add(phrase)
+        found -= self._phrase_starts
+
+        # Sort the hits into their groups once, so queries are dict lookups
+        group_hits = {}
+        memberships = self._memberships
+        for keyword in found:
+            for name, index in memberships.get(keyword, ()):
+                if name in group_hits:
+                    group_hits[name].append(index)
+                else:
+                    group_hits[name] = [index]
+        return KeywordMatches(self, text, words, hit_words, found, group_hits)
+
+    def _learn(self, words):
+        """Adds the new ones of words to the vocabulary; the caller holds the lock"""
+        new_words = words - self._known_words
+        if len(self._known_words) + len(new_words) > self.vocabulary_size:
+            # Start over, with all words of this text, as they are looked up next
+            self._known_words.clear()
+            self._hit_words.clear()
+            self._word_hits.clear()
+            new_words = words
+        for word in new_words:
+            hits = self._keywords_in(word)
+            if hits:
+                self._hit_words.add(word)
+                self._word_hits[word] = hits
+        self._known_words.update(new_words)
+
+    def _keywords_in(self, word):
+        """Walks the trie over one word and returns all keywords it contains"""
+        hits = set()
+        prefixes = self._prefixes
+        search = self._pattern.search
+        match = search(word)
+        while match is not None:
+            hits.update(prefixes[match.group()])
+            match = search(word, match.start() + 1)
+        return tuple(hits)
+
+    @staticmethod
+    def _trie_pattern(keywords):
+        trie = {}
+        for keyword in keywords:
+            node = trie
+            for char in keyword:
+                node = node.setdefault(char, {})
+            node[""] = None
+
+        def build(node):
+            branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+            if not branches:
+                return ""
+            pattern = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+            # Prefer the longer keyword when a shorter one also ends here
+            return f"(?:{pattern})?" if "" in node else pattern
+
+        return build(trie) or "(?!)"
+
+
+class KeywordMatches:
+    """Result of KeywordMatcher.scan(), shared by everything that inspects one message"""
+
+    __slots__ = ("matcher", "text", "words", "hit_words", "keywords", "group_hits")
+
+    def __init__(self, matcher, text, words, hit_words, keywords, group_hits):
+        self.matcher = matcher
+        # Lowercased text that was scanned, the set of its whitespace-separated
+        # words, and the words among them that contain a keyword
+        self.text = text
+        self.words = words
+        self.hit_words = hit_words
+        # Lowercased keywords that occur in the text
+        self.keywords = keywords
+        # Group name -> indexes of the group's keywords that occur in the text
+        self.group_hits = group_hits
+
+    def __contains__(self, keyword):
+        return keyword.lower() in self.keywords
+
+    def any(self, group):
+        """Returns True if any keyword of the group occurs in the text"""
+        return group in self.group_hits
+
+    def found(self, group):
+        """Returns the keywords of the group that occur in the text, in group order"""
+        indexes = self.group_hits.get(group)
+        if not indexes:
+            return []
+        keywords = self.matcher.groups[group]
+        return [keywords[index] for index in sorted(indexes)]
+
+    def find(self, keyword):
+        """Returns the position of the first occurrence of keyword, or -1"""
+        keyword = keyword.lower()
+        return self.text.find(keyword) if keyword in self.keywords else -1
@@ -1,10 +1,32 @@
 from virtual_companion import VirtualCompanion
+from initiative_scheduler import InitiativeScheduler
+from reply import Reply
+import environment
+import metrics
 from colorama import Fore, Style, init
-import time
+import logging
 import os
+import threading
+
+
+def render(reply):
+    """Returns a reply as colored console text"""
+    text = f"{Fore.MAGENTA}{reply.text}{Style.RESET_ALL}" if reply.text else ""
+    if reply.emotional_color:
+        text = f"{reply.emotional_color} {text}"
+    if reply.initiative:
+        text += f"\n\n{Fore.CYAN}{reply.initiative}{Style.RESET_ALL}"
+    return text
+
+
+def print_stream(chunks):
+    """Prints a streamed reply as it is generated"""
+    print(Fore.MAGENTA, end="", flush=True)
+    for chunk in chunks:
+        # Replies that are ready at once come as a whole
+        print(render(chunk) if isinstance(chunk, Reply) else chunk, end="", flush=True)
+    print(Style.RESET_ALL)
 
-# Initialize colorama
-init()
 
 def main_menu():
     print(f"{Fore.CYAN}=== VIRTUAL COMPANION CHAT ==={Style.RESET_ALL}")
@@ -52,40 +74,60 @@ def main_menu():
 
 def start_conversation(companion):
     print(f"\n{Fore.CYAN}Starting conversation...{Style.RESET_ALL}")
-    print(companion.greeting())
+    print(render(companion.greeting()))
     
-    last_response_time = time.time()
+    # Turns, initiatives and prefetches all change the companion, so only one of them runs at a time
+    companion_lock = threading.Lock()
     
-    while True:
-        # Check if there's a pause in the conversation
-        current_time = time.time()
-        conversation_pause = (current_time - last_response_time) > 40  # 40 seconds
-        
-        # If there's a pause and the conversation is not already paused, the companion takes initiative
-        if conversation_pause and not companion.conversation_paused:
-            initiative = companion._take_initiative(companion._choose_next_topic(), companion._choose_initiative_type())
-            print(initiative)
-            companion.conversation_paused = True
-            last_response_time = time.time()
-        
-        # Get message from user
-        message = input(f"{Fore.GREEN}You: {Style.RESET_ALL}")
-        
-        # Reset pause flag
-        companion.conversation_paused = False
-        
-        if message.lower() in ["exit", "quit"]:
-            print(f"\n{Fore.CYAN}Ending program. Goodbye!{Style.RESET_ALL}")
-            break
+    def prefetch(companion):
+        def run():
+            with companion_lock:
+                companion.prefetch_initiative()
+        threading.Thread(target=run, daemon=True).start()
+    
+    # If the user stays silent, the companion takes initiative, even while waiting for input
+    scheduler = InitiativeScheduler(prefetch=prefetch)
+    stop_scheduler = scheduler.start_thread(companion_lock)
+    
+    def show_initiative(initiative):
+        print(f"\n{render(initiative)}")
+        print(f"{Fore.GREEN}You: {Style.RESET_ALL}", end="", flush=True)
+    
+    try:
+        while True:
+            scheduler.schedule("console", companion, show_initiative)
+            
+            # Get message from user
+            message = input(f"{Fore.GREEN}You: {Style.RESET_ALL}")
+            scheduler.cancel("console")
+            
+            if message.lower() in ["exit", "quit"]:
+                print(f"\n{Fore.CYAN}Ending program. Goodbye!{Style.RESET_ALL}")
+                break
+                
+            # Print the reply as it is generated, after a prefetch that is under way
+            with companion_lock:
+                print_stream(companion.respond_stream(message))
             
-        response = companion.respond(message)
-        print(response)
-        
-        # Update last response time
-        last_response_time = time.time()
+            if os.getenv("SHOW_TIMINGS"):
+                timings = companion.last_turn_timings
+                print(f"{Style.DIM}(first words after {timings['first_token']:.2f}s, "
+                      f"full reply after {timings['total']:.2f}s){Style.RESET_ALL}")
+    finally:
+        stop_scheduler()
 
 
 if __name__ == "__main__":
+    # Set up the terminal colors and the .env settings here, not when the modules are imported
+    init()
+    # The companion logs failed API calls, shown here in red
+    logging.basicConfig(format=f"{Fore.RED}%(message)s{Style.RESET_ALL}")
+    environment.load()
+    stop_metrics_dump = metrics.configure_from_env()
     age, communication_style = main_menu()
     companion = VirtualCompanion(age, communication_style)
-    start_conversation(companion) 
\ No newline at end of file
+    try:
+        start_conversation(companion)
+    finally:
+        if stop_metrics_dump is not None:
+            stop_metrics_dump() 
\ No newline at end of file
@@ -0,0 +1,293 @@
+"""Optional per-turn latency and outcome metrics.
+
+Metrics are off by default and then cost one check per turn: begin_turn()
+returns None and nothing is timed. Once enabled, every turn records how
+long each stage took (state update, prompt building, API call, template
+reply, fallback after an API error) into histograms labeled by
+communication style and mode, along with counters for turns, fallbacks,
+API errors and initiatives and a histogram of prompt sizes.
+
+The registry renders in the Prometheus text format, and can be dumped as
+JSON to a file periodically:
+
+    COMPANION_METRICS=1 METRICS_JSON_PATH=metrics.json python main_en.py
+    python gateway.py --metrics-port 9100
+"""
+import bisect
+import json
+import os
+import threading
+import time
+
+# Bucket bounds of latency histograms, in seconds
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Bucket bounds of the prompt size histogram, in tokens
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096)
+
+DESCRIPTIONS = {
+    "companion_turns_total": "Turns answered",
+    "companion_fallbacks_total": "Turns answered from templates after an API error or a missed deadline",
+    "companion_api_errors_total": "Failed GPT API calls",
+    "companion_initiatives_total": "Turns in which the companion took the initiative",
+    "companion_idle_initiatives_total": "Initiatives sent to users who went silent",
+    "companion_initiative_prefetches_total": "Prefetched initiatives by outcome (hit, late, discarded)",
+    "companion_turn_seconds": "Time to answer a turn",
+    "companion_stage_seconds": "Time spent in each stage of a turn",
+    "companion_api_latency_seconds": "Time of GPT API calls",
+    "companion_prompt_tokens": "Estimated tokens of the prompts sent to the GPT API",
+    "companion_request_queue_seconds": "Time GPT API calls waited in the request scheduler",
+    "companion_requests_dropped_total": "GPT API calls dropped because they waited past their deadline",
+    "companion_request_queue_depth": "GPT API calls waiting in the request scheduler",
+    "companion_slo_turns_total": "Turns by SLO outcome (gpt within the budget, deadline, error, basic)",
+    "companion_mode_switches_total": "Switches between GPT and basic mode by the SLO controller",
+    "companion_gpt_mode": "1 while turns use the backend, 0 while the SLO controller keeps them in basic mode",
+}
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Returns the upper bound of the bucket that holds the q-quantile"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class MetricsRegistry:
+    """Counters, gauges and histograms keyed by metric name and label values"""
+
+    def __init__(self):
+        self._counters = {}  # (name, labels) -> value
+        self._gauges = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> Histogram
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels, amount=1):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def set_gauge(self, name, labels, value):
+        with self._lock:
+            self._gauges[(name, labels)] = value
+
+    def observe(self, name, labels, value, buckets=LATENCY_BUCKETS):
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def render_prometheus(self):
+        """Returns all metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+            histograms = [(key, list(h.counts), h.sum, h.count, h.buckets) for key, h in histograms]
+        described = set()
+        for kind, values in (("counter", counters), ("gauge", gauges)):
+            for (name, labels), value in values:
+                if name not in described:
+                    described.add(name)
+                    lines.append(f"# HELP {name} {DESCRIPTIONS.get(name, name)}")
+                    lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        for (name, labels), counts, total, count, buckets in histograms:
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {DESCRIPTIONS.get(name, name)}")
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """Returns the metrics as a JSON-friendly dict, with rates per style and mode"""
+        with self._lock:
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self._counters.items())
+            ]
+            gauges = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self._gauges.items())
+            ]
+            histograms = [
+                {
+                    "name": name, "labels": dict(labels), "count": h.count, "sum": h.sum,
+                    "p50": h.quantile(0.5), "p99": h.quantile(0.99),
+                    "buckets": dict(zip([str(b) for b in h.buckets] + ["+Inf"], h.counts))
+                }
+                for (name, labels), h in sorted(self._histograms.items(), key=lambda item: item[0])
+            ]
+        totals = {}
+        for counter in counters:
+            labels = counter["labels"]
+            key = (labels.get("style"), labels.get("mode", "gpt"))
+            totals.setdefault(key, {}).setdefault(counter["name"], 0)
+            totals[key][counter["name"]] += counter["value"]
+        rates = []
+        for (style, mode), values in sorted(totals.items(), key=lambda item: str(item[0])):
+            turns = values.get("companion_turns_total", 0)
+            if turns:
+                rates.append({
+                    "style": style, "mode": mode, "turns": turns,
+                    "fallback_rate": values.get("companion_fallbacks_total", 0) / turns,
+                    "initiative_rate": values.get("companion_initiatives_total", 0) / turns
+                })
+        return {
+            "time": time.time(), "counters": counters, "gauges": gauges, "histograms": histograms, "rates": rates
+        }
+
+    def dump_json(self, path):
+        """Writes snapshot() to path, replacing the file atomically"""
+        temporary = f"{path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, indent=1)
+        os.replace(temporary, path)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for key, value in labels
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+class TurnTrace:
+    """Times the stages of one turn and reports them when the turn ends"""
+
+    __slots__ = ("registry", "style", "mode", "started", "last", "stages", "prompt_tokens")
+
+    def __init__(self, registry, style, mode):
+        self.registry = registry
+        self.style = style
+        self.mode = mode
+        self.started = self.last = time.perf_counter()
+        self.stages = []
+        self.prompt_tokens = None
+
+    def stage(self, name):
+        """Ends the current stage, which gets the given name"""
+        now = time.perf_counter()
+        self.stages.append((name, now - self.last))
+        self.last = now
+
+    def api_error(self, error):
+        self.registry.inc(
+            "companion_api_errors_total", (("style", self.style), ("error", type(error).__name__))
+        )
+
+    def end(self, stage, initiative=False, fallback=False):
+        """Ends the last stage and reports the turn"""
+        self.stage(stage)
+        self.finish(initiative, fallback)
+
+    def finish(self, initiative=False, fallback=False):
+        registry = self.registry
+        labels = (("style", self.style), ("mode", self.mode))
+        registry.inc("companion_turns_total", labels)
+        if fallback:
+            registry.inc("companion_fallbacks_total", labels)
+        if initiative:
+            registry.inc("companion_initiatives_total", labels)
+        registry.observe("companion_turn_seconds", labels, time.perf_counter() - self.started)
+        for name, seconds in self.stages:
+            registry.observe("companion_stage_seconds", labels + (("stage", name),), seconds)
+            if name == "api":
+                registry.observe("companion_api_latency_seconds", (("style", self.style),), seconds)
+        if self.prompt_tokens is not None:
+            registry.observe("companion_prompt_tokens", (("style", self.style),), self.prompt_tokens, TOKEN_BUCKETS)
+
+
+_registry = None
+
+
+def enable():
+    """Turns metrics on and returns the process-wide registry"""
+    global _registry
+    if _registry is None:
+        _registry = MetricsRegistry()
+    return _registry
+
+
+def disable():
+    global _registry
+    _registry = None
+
+
+def get_registry():
+    """Returns the registry, or None while metrics are off"""
+    return _registry
+
+
+def begin_turn(style, mode):
+    """Returns a TurnTrace for a new turn, or None while metrics are off"""
+    registry = _registry
+    if registry is None:
+        return None
+    return TurnTrace(registry, style, mode)
+
+
+def start_json_dump(path, interval=60.0):
+    """Writes the metrics as JSON to path every interval seconds, from a
+    background thread, and returns a function that stops it"""
+    registry = enable()
+    stopped = threading.Event()
+
+    def run():
+        while not stopped.wait(interval):
+            registry.dump_json(path)
+        registry.dump_json(path)
+
+    thread = threading.Thread(target=run, name="metrics-json-dump", daemon=True)
+    thread.start()
+
+    def stop():
+        stopped.set()
+        thread.join()
+    return stop
+
+
+def configure_from_env():
+    """Enables metrics as configured by the environment and returns a
+    function that stops the JSON dump, if one was started.
+
+    COMPANION_METRICS=1 enables them, METRICS_JSON_PATH dumps them to a
+    file every METRICS_JSON_INTERVAL seconds (default 60).
+    """
+    path = os.getenv("METRICS_JSON_PATH")
+    if os.getenv("COMPANION_METRICS", "").lower() in ("1", "true", "yes") or path:
+        enable()
+    if path:
+        return start_json_dump(path, float(os.getenv("METRICS_JSON_INTERVAL", 60)))
+    return None
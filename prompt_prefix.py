@@ -0,0 +1,119 @@
+"""Measures how much of each GPT prompt repeats the start of an earlier one.
+
+Providers cache the processed start of recent prompts, and a prompt that
+begins with a cached prefix is answered sooner and billed less (OpenAI
+caches prefixes of 1024 tokens and more). That only works if prompts keep
+their stable parts first: the system prompt of the age bracket and style,
+then the history, which only grows at its end, and only then what changes
+from turn to turn, like the retrieved facts and the initiative directive.
+
+PrefixTracker hashes every prompt at each message boundary, chaining the
+hash of a message onto the hash of everything before it, and remembers the
+latest PROMPT_PREFIX_ENTRIES of these prefix hashes. They are built from
+Python's string hashes, which strings keep, so they cost next to nothing
+but only compare within one process. The longest prefix of a prompt that
+was seen before is what a provider cache could reuse. The share of such
+tokens in all prompt tokens is the cache friendliness of the prompt
+layout, and request latencies are kept apart for prompts that start with a
+prefix of at least PROMPT_CACHE_MIN_TOKENS seen tokens and those that do
+not. PROMPT_PREFIX_TRACKING=0 switches it off.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+import metrics
+
+
+class PrefixTracker:
+    """Prefix hashes of recent prompts and the share of their tokens a provider could cache"""
+
+    def __init__(self, max_entries=50000, min_tokens=1024):
+        self.max_entries = max_entries
+        self.min_tokens = min_tokens
+        self._seen = OrderedDict()  # Prefix hash -> None, oldest first
+        self._lock = threading.Lock()
+        self.stats = {
+            "requests": 0,
+            "prompt_tokens": 0,
+            "cached_tokens": 0,  # Tokens of prefixes that were seen before
+            "cacheable_requests": 0,  # Requests with at least min_tokens of them
+            "cacheable_latency": 0.0,
+            "uncacheable_latency": 0.0,
+            "cacheable_timed": 0,
+            "uncacheable_timed": 0
+        }
+
+    def observe(self, messages, prompt_tokens):
+        """Records a prompt of about prompt_tokens tokens; returns True if a
+        provider could have served at least min_tokens of it from its cache"""
+        digests = []
+        lengths = []
+        prefix = 0
+        for message in messages:
+            prefix = hash((prefix, message["role"], message["content"]))
+            digests.append(prefix)
+            lengths.append(len(message["content"]))
+        with self._lock:
+            seen = self._seen
+            matched = 0
+            for digest in digests:
+                if digest not in seen:
+                    break
+                matched += 1
+            for digest in digests:
+                seen[digest] = None
+                seen.move_to_end(digest)
+            while len(seen) > self.max_entries:
+                seen.popitem(last=False)
+            # Tokens are estimated for the whole prompt only, so the prefix gets its share by length
+            total = sum(lengths)
+            cached = round(prompt_tokens * sum(lengths[:matched]) / total) if total else 0
+            cacheable = cached >= self.min_tokens
+            self.stats["requests"] += 1
+            self.stats["prompt_tokens"] += prompt_tokens
+            self.stats["cached_tokens"] += cached
+            self.stats["cacheable_requests"] += cacheable
+        registry = metrics.get_registry()
+        if registry is not None:
+            registry.inc("companion_prompt_tokens_total", (), prompt_tokens)
+            registry.inc("companion_prompt_cached_tokens_total", (), cached)
+        return cacheable
+
+    def record_latency(self, cacheable, seconds):
+        """Records the time to the first words of a request observed before"""
+        kind = "cacheable" if cacheable else "uncacheable"
+        with self._lock:
+            self.stats[kind + "_latency"] += seconds
+            self.stats[kind + "_timed"] += 1
+        registry = metrics.get_registry()
+        if registry is not None:
+            registry.observe("companion_prompt_latency_seconds", (("prefix", kind),), seconds)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["prefixes"] = len(self._seen)
+        stats["cached_ratio"] = stats["cached_tokens"] / stats["prompt_tokens"] if stats["prompt_tokens"] else 0.0
+        for kind in ("cacheable", "uncacheable"):
+            timed = stats.pop(kind + "_timed")
+            total = stats.pop(kind + "_latency")
+            stats[kind + "_mean_latency"] = total / timed if timed else None
+        return stats
+
+
+_tracker = None
+_tracker_lock = threading.Lock()
+
+
+def get_prefix_tracker():
+    """Returns the process-wide PrefixTracker, or None if tracking is off"""
+    global _tracker
+    if _tracker is None and os.getenv("PROMPT_PREFIX_TRACKING", "1").lower() not in ("0", "false", "no"):
+        with _tracker_lock:
+            if _tracker is None:
+                _tracker = PrefixTracker(
+                    max_entries=int(os.getenv("PROMPT_PREFIX_ENTRIES", 50000)),
+                    min_tokens=int(os.getenv("PROMPT_CACHE_MIN_TOKENS", 1024))
+                )
+    return _tracker
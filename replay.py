@@ -0,0 +1,200 @@
+"""Replays recorded conversations through VirtualCompanion in a process pool.
+
+Transcripts are JSONL files with one session per line:
+
+    {"session_id": "abc", "age": 20, "style": "friendly", "messages": ["hi", "I like music", ...]}
+
+Sessions are spread over worker processes, and each one runs with its own
+random seed derived from --seed and its id, so a run is repeatable. Replies
+come from the basic templates, or with --backend stub from the GPT path
+with a canned reply instead of the API. Every turn's decisions (mood,
+energy, topic, initiative, reply) can be written as JSONL in input order,
+so two runs can be compared with diff:
+
+    python replay.py transcripts.jsonl --output decisions.jsonl
+    python replay.py transcripts.jsonl --backend stub --workers 8
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+STUB_REPLIES = [
+    "That sounds really interesting! Tell me more.",
+    "I love hearing about that. What happened next?",
+    "Hmm, I never thought about it that way. Why do you think so?",
+    "Oh, that's great! How did it make you feel?",
+]
+
+# Sessions sent to a worker at once
+BATCH_SIZE = 32
+
+
+def read_sessions(paths):
+    """Yields the sessions of JSONL transcript files ("-" reads stdin)"""
+    for path in paths:
+        stream = sys.stdin if path == "-" else open(path, encoding="utf-8")
+        try:
+            for line_number, line in enumerate(stream, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    session = json.loads(line)
+                    yield (str(session["session_id"]), int(session["age"]), session["style"], session["messages"])
+                except (ValueError, KeyError, TypeError) as e:
+                    raise Exception(f"{path}:{line_number}: invalid transcript line ({e})")
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+
+def session_seed(seed, session_id):
+    return zlib.crc32(f"{seed}:{session_id}".encode("utf-8"))
+
+
+_companion_classes = {}
+
+
+def companion_class(backend):
+    """Returns the VirtualCompanion class to replay with on a backend"""
+    if backend not in _companion_classes:
+        # Imported here so only the worker processes load the companion
+        import backends
+        from virtual_companion import VirtualCompanion
+
+        # Replays do not depend on COMPANION_BACKEND: stub replies, or basic mode without an API key
+        backends.set_backend(backends.OpenAIBackend())
+
+        if backend == "stub":
+            class StubCompanion(VirtualCompanion):
+                __slots__ = ()
+
+                def _request_to_gpt_api(self, messages, priority=None):
+                    return self.rng.choice(STUB_REPLIES)
+
+            _companion_classes[backend] = StubCompanion
+        else:
+            _companion_classes[backend] = VirtualCompanion
+    return _companion_classes[backend]
+
+
+def replay_session(session, seed, backend):
+    """Runs one session and returns its per-turn decisions"""
+    session_id, age, style, messages = session
+    random.seed(session_seed(seed, session_id))
+    companion = companion_class(backend)(age, style)
+    companion.api_key = "stub" if backend == "stub" else None
+    companion.session_id = session_id
+    companion.greeting()
+    topics = companion.topic_table.names
+
+    turns = []
+    for index, message in enumerate(messages):
+        last_initiative_time = companion.initiative.last_initiative_time
+        reply = companion.respond(message)
+        state = companion.emotional_state
+        topic = companion.memory.current_topic
+        turns.append({
+            "session_id": session_id,
+            "turn": index,
+            "mood": state.mood,
+            "energy": state.energy,
+            "attachment": state.attachment,
+            "topic_interest": state.topic_interest,
+            "topic": topics[topic] if topic is not None else None,
+            "initiative": companion.initiative.last_initiative_time != last_initiative_time,
+            "reply": str(reply)
+        })
+    return turns
+
+
+def replay_batch(batch, seed, backend):
+    """Replays a batch of sessions in a worker; returns decisions and CPU time"""
+    started = time.process_time()
+    results = [replay_session(session, seed, backend) for session in batch]
+    return results, time.process_time() - started
+
+
+def batches(sessions, size):
+    batch = []
+    for session in sessions:
+        batch.append(session)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def replay(sessions, workers=None, seed=0, backend="basic", on_turns=None):
+    """Replays sessions across worker processes and returns aggregate stats.
+    on_turns is called with each session's decisions, in input order."""
+    workers = workers or os.cpu_count() or 1
+    stats = {"sessions": 0, "turns": 0, "cpu_time": 0.0}
+    started = time.perf_counter()
+
+    def collect(future):
+        results, cpu_time = future.result()
+        stats["cpu_time"] += cpu_time
+        for turns in results:
+            stats["sessions"] += 1
+            stats["turns"] += len(turns)
+            if on_turns is not None:
+                on_turns(turns)
+
+    # Keep a bounded number of batches in flight, so huge archives stream through
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for batch in batches(sessions, BATCH_SIZE):
+            pending.append(pool.submit(replay_batch, batch, seed, backend))
+            if len(pending) >= workers * 4:
+                collect(pending.popleft())
+        while pending:
+            collect(pending.popleft())
+
+    stats["elapsed"] = time.perf_counter() - started
+    stats["workers"] = workers
+    stats["turns_per_second"] = stats["turns"] / stats["elapsed"] if stats["elapsed"] else 0.0
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded conversations through VirtualCompanion")
+    parser.add_argument("transcripts", nargs="+", help="JSONL transcript files, or - for stdin")
+    parser.add_argument("--workers", type=int, help="Worker processes (default: one per CPU)")
+    parser.add_argument("--seed", type=int, default=0, help="Base random seed of all sessions")
+    parser.add_argument("--backend", choices=["basic", "stub"], default="basic",
+                        help="basic templates, or the GPT path with a canned reply instead of the API")
+    parser.add_argument("--output", help="Write per-turn decisions to this JSONL file")
+    args = parser.parse_args()
+
+    output = open(args.output, "w", encoding="utf-8") if args.output else None
+
+    def write_turns(turns):
+        for turn in turns:
+            output.write(json.dumps(turn, ensure_ascii=False) + "\n")
+
+    try:
+        stats = replay(
+            read_sessions(args.transcripts), args.workers, args.seed, args.backend,
+            write_turns if output else None
+        )
+    finally:
+        if output:
+            output.close()
+    print(
+        f"{stats['sessions']} sessions, {stats['turns']} turns in {stats['elapsed']:.2f} s "
+        f"with {stats['workers']} workers: {stats['turns_per_second']:,.0f} turns/s "
+        f"({stats['turns'] / stats['cpu_time'] if stats['cpu_time'] else 0:,.0f} turns/s per busy core)",
+        file=sys.stderr
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+"""Structured replies of the virtual companion.
+
+The companion answers with a Reply instead of a string with console colors
+baked in, so servers can send its parts as they are, and only the terminal
+front end (main_en.py) turns them into colored text. str(reply) is the
+plain text the user reads.
+"""
+
+# Where a reply came from: the generation backend, the basic response
+# templates, or the templates after the backend failed or missed its budget
+SOURCES = ("gpt", "template", "fallback")
+
+
+class Reply:
+    __slots__ = ("text", "source", "mood", "emotional_color", "initiative", "timings")
+
+    def __init__(self, text, source, mood=None, emotional_color=None, initiative=None, timings=None):
+        self.text = text  # The answer itself, empty for a bare initiative
+        self.source = source
+        self.mood = mood  # The companion's mood: good, neutral or bad
+        self.emotional_color = emotional_color  # Mood phrase before template answers, e.g. "happily"
+        self.initiative = initiative  # Topic the companion brings up on its own, if any
+        self.timings = timings  # Seconds to the first words and to the full reply
+
+    def __str__(self):
+        text = f"{self.emotional_color} {self.text}" if self.emotional_color else self.text
+        if self.initiative:
+            text = f"{text}\n\n{self.initiative}" if text else self.initiative
+        return text
+
+    def __repr__(self):
+        return f"Reply({str(self)!r}, source={self.source!r})"
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
@@ -0,0 +1,306 @@
+"""Process-wide scheduling of GPT API calls.
+
+Every API call of every companion in the process goes through one
+RequestScheduler before it is sent. It keeps the process under the API's
+rate limits with two token buckets, one for requests and one for tokens
+per minute, and caps how many calls run at the same time. Calls that have
+to wait are queued by priority, so a user waiting for a reply goes before
+a prefetched initiative, and every queued call has a deadline after which
+it is dropped instead of sent too late.
+
+Configured from the environment:
+    GPT_REQUESTS_PER_MINUTE   request rate limit (default 0, unlimited)
+    GPT_TOKENS_PER_MINUTE     token rate limit (default 0, unlimited)
+    GPT_MAX_CONCURRENCY       calls in flight at once (default 64)
+"""
+import heapq
+import itertools
+import os
+import threading
+import time
+
+import metrics
+
+# Priorities, most urgent first
+INTERACTIVE = 0
+PREFETCH = 1
+PRIORITY_NAMES = ("interactive", "prefetch")
+
+# Longest time a call of each priority may wait in the queue, in seconds
+QUEUE_TIMEOUTS = (10.0, 15.0)
+
+_GRANTED = 1
+_DROPPED = 2
+
+
+class TokenBucket:
+    """Refills at per_minute / 60 per second, holding at most a minute's worth"""
+
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60.0
+        self.capacity = float(per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, amount, now):
+        """Returns seconds until amount can be taken (0 if it can be now)"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        # A request larger than the bucket waits for a full bucket and goes into debt
+        missing = min(amount, self.capacity) - self.tokens
+        return missing / self.rate if missing > 0 else 0.0
+
+    def take(self, amount):
+        self.tokens -= amount
+
+
+class _Waiter:
+    __slots__ = ("priority", "tokens", "deadline", "enqueued", "state", "event", "future", "loop")
+
+    def __init__(self, priority, tokens, deadline, enqueued):
+        self.priority = priority
+        self.tokens = tokens
+        self.deadline = deadline
+        self.enqueued = enqueued
+        self.state = None
+        self.event = None
+        self.future = None
+        self.loop = None
+
+    def wake(self):
+        if self.event is not None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(_resolve, self.future)
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class RequestScheduler:
+    """Rate limits, caps and orders the GPT API calls of the process.
+
+    Use acquire() and release() around a call (or call() / call_async()).
+    acquire() raises an exception if the call's deadline passed while it was
+    queued, which callers treat like a failed API call.
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, max_concurrency=None):
+        if requests_per_minute is None:
+            requests_per_minute = float(os.getenv("GPT_REQUESTS_PER_MINUTE", 0))
+        if tokens_per_minute is None:
+            tokens_per_minute = float(os.getenv("GPT_TOKENS_PER_MINUTE", 0))
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_concurrency = max_concurrency or int(os.getenv("GPT_MAX_CONCURRENCY", 64))
+        self.active = 0
+        self._queue = []  # Heap of (priority, sequence number, waiter)
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self.queued = [0] * len(PRIORITY_NAMES)
+        self.stats = {
+            "granted": [0] * len(PRIORITY_NAMES),
+            "dropped": [0] * len(PRIORITY_NAMES),
+            "wait_time": [0.0] * len(PRIORITY_NAMES),
+            "max_wait": [0.0] * len(PRIORITY_NAMES),
+            "max_queued": 0
+        }
+
+    def acquire(self, priority=INTERACTIVE, tokens=0, timeout=None):
+        """Waits until a call may be sent; tokens is its estimated size"""
+        now = time.monotonic()
+        with self._lock:
+            if self._try_start(priority, tokens, now):
+                return
+            waiter = self._enqueue(priority, tokens, timeout, now)
+            waiter.event = threading.Event()
+        try:
+            while True:
+                with self._lock:
+                    delay = self._dispatch(time.monotonic())
+                    if self._finished(waiter):
+                        return
+                waiter.event.wait(self._poll_interval(waiter, delay))
+                waiter.event.clear()
+        except BaseException:
+            self._abandon(waiter)
+            raise
+
+    async def acquire_async(self, priority=INTERACTIVE, tokens=0, timeout=None):
+        """Same as acquire(), but waits without blocking the event loop"""
+        import asyncio  # Here, so sync callers start without it
+        now = time.monotonic()
+        with self._lock:
+            if self._try_start(priority, tokens, now):
+                return
+            waiter = self._enqueue(priority, tokens, timeout, now)
+            waiter.loop = asyncio.get_running_loop()
+            waiter.future = waiter.loop.create_future()
+        try:
+            while True:
+                with self._lock:
+                    delay = self._dispatch(time.monotonic())
+                    if self._finished(waiter):
+                        return
+                    if waiter.future.done():
+                        waiter.future = waiter.loop.create_future()
+                # Unlike wait_for(), wait() never swallows a cancel that comes with the grant
+                await asyncio.wait((waiter.future,), timeout=self._poll_interval(waiter, delay))
+        except BaseException:
+            # E.g. the task was cancelled because its client went away
+            self._abandon(waiter)
+            raise
+
+    def release(self):
+        """Marks a call as finished and lets the next queued one start"""
+        with self._lock:
+            self.active -= 1
+            self._dispatch(time.monotonic())
+
+    def call(self, function, priority=INTERACTIVE, tokens=0, timeout=None):
+        """Runs function() once the scheduler allows it and returns its result"""
+        self.acquire(priority, tokens, timeout)
+        try:
+            return function()
+        finally:
+            self.release()
+
+    async def call_async(self, function, priority=INTERACTIVE, tokens=0, timeout=None):
+        """Awaits function() once the scheduler allows it and returns its result"""
+        await self.acquire_async(priority, tokens, timeout)
+        try:
+            return await function()
+        finally:
+            self.release()
+
+    def get_stats(self):
+        with self._lock:
+            stats = {"active": self.active, "max_queued": self.stats["max_queued"]}
+            for index, name in enumerate(PRIORITY_NAMES):
+                granted = self.stats["granted"][index]
+                stats[name] = {
+                    "queued": self.queued[index],
+                    "granted": granted,
+                    "dropped": self.stats["dropped"][index],
+                    "average_wait": self.stats["wait_time"][index] / granted if granted else 0.0,
+                    "max_wait": self.stats["max_wait"][index]
+                }
+        return stats
+
+    def _try_start(self, priority, tokens, now):
+        """Starts a call right away if nothing is queued and limits allow it"""
+        if self._queue or self.active >= self.max_concurrency or self._rate_wait(tokens, now) > 0:
+            return False
+        self._start(priority, tokens, 0.0)
+        return True
+
+    def _enqueue(self, priority, tokens, timeout, now):
+        if timeout is None:
+            timeout = QUEUE_TIMEOUTS[priority]
+        waiter = _Waiter(priority, tokens, now + timeout, now)
+        heapq.heappush(self._queue, (priority, next(self._sequence), waiter))
+        self.queued[priority] += 1
+        self.stats["max_queued"] = max(self.stats["max_queued"], len(self._queue))
+        self._report_queue(priority)
+        return waiter
+
+    def _dispatch(self, now):
+        """Starts queued calls in priority order while limits allow; returns
+        the seconds until the rate limits let the next one start, or None"""
+        while self._queue:
+            waiter = self._queue[0][2]
+            if waiter.state is not None:
+                heapq.heappop(self._queue)
+                continue
+            if now >= waiter.deadline:
+                heapq.heappop(self._queue)
+                self._drop(waiter)
+                continue
+            if self.active >= self.max_concurrency:
+                return None
+            delay = self._rate_wait(waiter.tokens, now)
+            if delay > 0:
+                return delay
+            heapq.heappop(self._queue)
+            self.queued[waiter.priority] -= 1
+            self._report_queue(waiter.priority)
+            waiter.state = _GRANTED
+            self._start(waiter.priority, waiter.tokens, now - waiter.enqueued)
+            waiter.wake()
+        return None
+
+    def _finished(self, waiter):
+        """Returns True once a waiter was granted; raises if it was dropped"""
+        if waiter.state is None and time.monotonic() >= waiter.deadline:
+            self._drop(waiter)
+        if waiter.state == _DROPPED:
+            raise Exception(f"GPT request dropped after waiting {time.monotonic() - waiter.enqueued:.1f}s in the queue")
+        return waiter.state == _GRANTED
+
+    def _abandon(self, waiter):
+        """Gives up a waiter that stopped waiting, freeing its slot if it got one"""
+        with self._lock:
+            if waiter.state == _GRANTED:
+                self.active -= 1
+                self._dispatch(time.monotonic())
+            elif waiter.state is None:
+                waiter.state = _DROPPED
+                self.queued[waiter.priority] -= 1
+                self._report_queue(waiter.priority)
+
+    def _poll_interval(self, waiter, delay):
+        remaining = max(0.0, waiter.deadline - time.monotonic())
+        return remaining if delay is None else min(delay, remaining)
+
+    def _rate_wait(self, tokens, now):
+        delay = 0.0
+        if self.request_bucket is not None:
+            delay = self.request_bucket.wait_time(1, now)
+        if self.token_bucket is not None and tokens:
+            delay = max(delay, self.token_bucket.wait_time(tokens, now))
+        return delay
+
+    def _start(self, priority, tokens, waited):
+        if self.request_bucket is not None:
+            self.request_bucket.take(1)
+        if self.token_bucket is not None:
+            self.token_bucket.take(tokens)
+        self.active += 1
+        self.stats["granted"][priority] += 1
+        self.stats["wait_time"][priority] += waited
+        self.stats["max_wait"][priority] = max(self.stats["max_wait"][priority], waited)
+        registry = metrics.get_registry()
+        if registry is not None:
+            registry.observe("companion_request_queue_seconds", (("priority", PRIORITY_NAMES[priority]),), waited)
+
+    def _drop(self, waiter):
+        waiter.state = _DROPPED
+        self.queued[waiter.priority] -= 1
+        self.stats["dropped"][waiter.priority] += 1
+        self._report_queue(waiter.priority)
+        registry = metrics.get_registry()
+        if registry is not None:
+            registry.inc("companion_requests_dropped_total", (("priority", PRIORITY_NAMES[waiter.priority]),))
+
+    def _report_queue(self, priority):
+        registry = metrics.get_registry()
+        if registry is not None:
+            registry.set_gauge(
+                "companion_request_queue_depth", (("priority", PRIORITY_NAMES[priority]),), self.queued[priority]
+            )
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Returns the process-wide request scheduler"""
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = RequestScheduler()
+    return _scheduler
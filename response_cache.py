@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """LRU cache of GPT replies with a per-entry TTL.
+
+    Keys are a canonical hash of the request (message list plus model
+    parameters), so prompts that only differ in whitespace share an entry.
+    With a path, entries are also written to an SQLite file and survive
+    restarts. Caching can be switched off for individual communication
+    styles, e.g. so playful sessions still get varied replies.
+    """
+
+    def __init__(self, max_entries=1000, ttl=3600, path=None, styles=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.styles = set(styles) if styles is not None else None
+        self._entries = OrderedDict()  # key -> (expiry time, response)
+        self._lock = threading.Lock()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0
+        }
+        self._db = None
+        if path:
+            self._open_store(path)
+
+    def enabled_for(self, style):
+        """Returns True if replies for this communication style are cached"""
+        return self.styles is None or style in self.styles
+
+    @staticmethod
+    def make_key(request_data):
+        """Returns the cache key for a chat completion request body"""
+        canonical = dict(request_data)
+        canonical.pop("stream", None)
+        canonical["messages"] = [
+            {"role": message["role"], "content": " ".join(message["content"].split())}
+            for message in request_data["messages"]
+        ]
+        encoded = json.dumps(canonical, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Returns the cached reply for key, or None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= now:
+                self._remove(key)
+                self.stats["expirations"] += 1
+                entry = None
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[1]
+
+    def put(self, key, response, ttl=None):
+        """Stores a reply, evicting the least recently used entries if full"""
+        expires = time.time() + (ttl if ttl is not None else self.ttl)
+        with self._lock:
+            self._entries[key] = (expires, response)
+            self._entries.move_to_end(key)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, expires, response) VALUES (?, ?, ?)",
+                    (key, expires, response)
+                )
+            while len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.stats["evictions"] += 1
+            if self._db is not None:
+                self._db.commit()
+
+    def get_stats(self):
+        """Returns hit/miss/eviction counters and the current size"""
+        with self._lock:
+            stats = dict(self.stats)
+            stats["size"] = len(self._entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _remove(self, key):
+        del self._entries[key]
+        if self._db is not None:
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+
+    def _open_store(self, path):
+        import sqlite3  # Here, as most processes run without a cache file
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, expires REAL, response TEXT)"
+        )
+        self._db.execute("DELETE FROM responses WHERE expires <= ?", (time.time(),))
+        # Load the newest entries, oldest first so they end up in LRU order
+        rows = self._db.execute(
+            "SELECT key, expires, response FROM responses ORDER BY expires DESC LIMIT ?",
+            (self.max_entries,)
+        ).fetchall()
+        for key, expires, response in reversed(rows):
+            self._entries[key] = (expires, response)
+        self._db.execute(
+            "DELETE FROM responses WHERE key NOT IN (SELECT key FROM responses ORDER BY expires DESC LIMIT ?)",
+            (self.max_entries,)
+        )
+        self._db.commit()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """Returns the process-wide response cache, or None if it is disabled.
+
+    Configured through environment variables:
+    RESPONSE_CACHE=1 enables it, RESPONSE_CACHE_SIZE and RESPONSE_CACHE_TTL
+    set the capacity and lifetime, RESPONSE_CACHE_PATH adds an on-disk
+    store and RESPONSE_CACHE_STYLES lists the styles that use the cache.
+    """
+    global _cache
+    if _cache is None and os.getenv("RESPONSE_CACHE", "").lower() in ("1", "true", "yes"):
+        with _cache_lock:
+            if _cache is None:
+                styles = os.getenv("RESPONSE_CACHE_STYLES", "formal,friendly,romantic")
+                _cache = ResponseCache(
+                    max_entries=int(os.getenv("RESPONSE_CACHE_SIZE", 1000)),
+                    ttl=float(os.getenv("RESPONSE_CACHE_TTL", 3600)),
+                    path=os.getenv("RESPONSE_CACHE_PATH") or None,
+                    styles=[style.strip() for style in styles.split(",") if style.strip()]
+                )
+    return _cache
@@ -0,0 +1,161 @@
+"""Compact per-session state of a virtual companion.
+
+One process can hold hundreds of thousands of idle sessions, so the state
+avoids per-session dicts and sets: the classes use __slots__, topics are
+small integer ids into a TopicTable shared by all sessions of an age
+bracket, topic sets are bitmasks, topic sequences are bytearrays, and
+containers most sessions never fill are only created when first needed.
+"""
+from fact_memory import FactStore
+
+
+class TopicTable:
+    """Conversation topics of one age bracket and their integer ids"""
+
+    __slots__ = ("topics", "names", "ids", "all_topics")
+
+    def __init__(self, topics):
+        # Topics as listed, repeats included, for random suggestions
+        self.topics = tuple(topics)
+        self.names = tuple(dict.fromkeys(self.topics))
+        self.ids = {name: topic_id for topic_id, name in enumerate(self.names)}
+        # Bitmask with every topic set
+        self.all_topics = (1 << len(self.names)) - 1
+
+    def names_of(self, mask):
+        """Returns the names of the topics in a bitmask"""
+        return [name for topic_id, name in enumerate(self.names) if mask >> topic_id & 1]
+
+    def ids_of(self, mask):
+        """Returns the ids of the topics in a bitmask"""
+        return [topic_id for topic_id in range(len(self.names)) if mask >> topic_id & 1]
+
+
+class EmotionalState:
+    __slots__ = ("mood", "energy", "attachment", "topic_interest")
+
+    def __init__(self):
+        self.mood = "good"  # good, neutral, bad
+        self.energy = 100  # from 0 to 100
+        self.attachment = 0  # from 0 to 100
+        self.topic_interest = 50  # from 0 to 100
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def get_state(self):
+        return (self.mood, self.energy, self.attachment, self.topic_interest)
+
+    def set_state(self, state):
+        self.mood, self.energy, self.attachment, self.topic_interest = state
+
+
+class InitiativeState:
+    __slots__ = (
+        "activity_level", "last_initiative_time", "initiative_count", "successful_initiatives",
+        "unsuccessful_initiatives", "interval_between_initiatives", "last_successful_topic"
+    )
+
+    def __init__(self, now):
+        self.activity_level = 50  # from 0 to 100
+        self.last_initiative_time = now
+        self.initiative_count = 0
+        self.successful_initiatives = 0  # Initiatives to which the user responded extensively
+        self.unsuccessful_initiatives = 0  # Initiatives to which the user responded briefly or ignored
+        self.interval_between_initiatives = 60  # Initial interval in seconds
+        self.last_successful_topic = None  # Topic id
+
+    def as_dict(self, topic_table):
+        state = {name: getattr(self, name) for name in self.__slots__}
+        if self.last_successful_topic is not None:
+            state["last_successful_topic"] = topic_table.names[self.last_successful_topic]
+        return state
+
+    def get_state(self):
+        return (
+            self.activity_level, self.last_initiative_time, self.initiative_count, self.successful_initiatives,
+            self.unsuccessful_initiatives, self.interval_between_initiatives, self.last_successful_topic
+        )
+
+    def set_state(self, state):
+        (self.activity_level, self.last_initiative_time, self.initiative_count, self.successful_initiatives,
+         self.unsuccessful_initiatives, self.interval_between_initiatives, self.last_successful_topic) = state
+
+
+class ContextMemory:
+    """What the companion remembers about the conversation, by topic id"""
+
+    __slots__ = (
+        "current_topic", "topic_history", "recent_topics", "favorite_topics",
+        "disliked_topics", "important_info", "summary", "facts"
+    )
+
+    # Number of recent topics that are not suggested again
+    RECENT_TOPICS = 5
+
+    def __init__(self):
+        self.current_topic = None
+        self.topic_history = bytearray()  # History of discussed topics
+        self.recent_topics = bytearray()  # Last N discussed topics to avoid repetition
+        self.favorite_topics = 0  # Bitmask of topics the user is particularly interested in
+        self.disliked_topics = 0  # Bitmask of topics the user is not interested in
+        self.important_info = None  # Category -> important user information
+        self.summary = None  # RollingSummary of turns that no longer fit into the prompt
+        self.facts = None  # FactStore of everything important the user told
+
+    def enter_topic(self, topic_id):
+        """Makes a topic the current one and records it in the topic history"""
+        self.current_topic = topic_id
+        if not self.topic_history or self.topic_history[-1] != topic_id:
+            self.topic_history.append(topic_id)
+        if topic_id not in self.recent_topics:
+            self.recent_topics.append(topic_id)
+            if len(self.recent_topics) > self.RECENT_TOPICS:
+                del self.recent_topics[0]
+
+    def remember(self, category, info, turn=0):
+        """Keeps info as the latest of its category and adds it to the facts"""
+        if self.important_info is None:
+            self.important_info = {}
+        self.important_info[category] = info
+        if self.facts is None:
+            self.facts = FactStore()
+        self.facts.add(info, category, turn)
+
+    def relevant_facts(self, message, turn):
+        """Returns the remembered facts that are most relevant to a message"""
+        if self.facts is None:
+            return []
+        return self.facts.retrieve(message, turn)
+
+    def recent_mask(self):
+        """Returns the recent topics as a bitmask"""
+        mask = 0
+        for topic_id in self.recent_topics:
+            mask |= 1 << topic_id
+        return mask
+
+    def get_state(self):
+        """Returns everything but the summary and the facts as a tuple of builtin types"""
+        return (
+            self.current_topic, bytes(self.topic_history), bytes(self.recent_topics),
+            self.favorite_topics, self.disliked_topics, self.important_info
+        )
+
+    def set_state(self, state):
+        (self.current_topic, topic_history, recent_topics,
+         self.favorite_topics, self.disliked_topics, self.important_info) = state
+        self.topic_history = bytearray(topic_history)
+        self.recent_topics = bytearray(recent_topics)
+
+    def as_dict(self, topic_table):
+        """Returns the memory with topic names, in the layout of the original dicts"""
+        names = topic_table.names
+        return {
+            "important_info": dict(self.important_info or {}),
+            "current_topic": None if self.current_topic is None else names[self.current_topic],
+            "topic_history": [names[topic_id] for topic_id in self.topic_history],
+            "favorite_topics": set(topic_table.names_of(self.favorite_topics)),
+            "disliked_topics": set(topic_table.names_of(self.disliked_topics)),
+            "recent_topics": [names[topic_id] for topic_id in self.recent_topics]
+        }
@@ -0,0 +1,311 @@
+"""Durable storage of companion sessions.
+
+Every session has a snapshot, its complete state, and a journal of
+per-turn deltas written after the snapshot. A delta holds the
+small state objects and only the history messages and facts added since the
+previous turn, so a turn costs one short insert. Loading applies the journal to the
+snapshot; once a journal grows past a few entries it is folded into a new
+snapshot. Both live in one SQLite file.
+
+Snapshots and deltas are pickled with a fixed protocol, which every later
+Python version reads, and every row records its format. Rows of stores
+written before the format column existed hold marshal data, which is only
+sure to load on the Python version that wrote it.
+
+SessionManager keeps the live sessions in memory, writes a delta after each
+turn, evicts sessions that have been idle for a while to the store and
+loads them again when their next message arrives.
+"""
+import os
+import pickle
+import time
+
+from conversation_window import RollingSummary
+from fact_memory import FactStore
+from virtual_companion import VirtualCompanion
+
+# Formats of the stored snapshots and deltas, in the format column of every row
+MARSHAL_FORMAT = 0
+PICKLE_FORMAT = 1
+PICKLE_PROTOCOL = 4
+
+
+def dumps(value):
+    return pickle.dumps(value, PICKLE_PROTOCOL)
+
+
+def loads(data, data_format=PICKLE_FORMAT):
+    if data_format == PICKLE_FORMAT:
+        return pickle.loads(data)
+    if data_format == MARSHAL_FORMAT:
+        import marshal
+        return marshal.loads(data)
+    raise Exception(f"Unknown session store format {data_format}")
+
+
+def encode_delta(companion, history_offset, history_length, facts_appended=0):
+    """Returns what changed in a session since its history had been
+    history_length messages long, after history_offset folded messages,
+    and facts_appended facts had been remembered"""
+    dropped = companion.history_offset - history_offset
+    start = max(0, history_length - dropped)
+    history = companion.conversation_history
+    summary = companion.memory.summary
+    facts = companion.memory.facts
+    return dumps((
+        companion.emotional_state.get_state(),
+        companion.initiative.get_state(),
+        companion.memory.get_state(),
+        # The summary only changes when messages are folded into it
+        summary.get_state() if dropped and summary is not None else None,
+        dropped,
+        tuple((message["role"], message["content"]) for message in history[start:]),
+        tuple(companion.history_token_counts[start:]),
+        companion.short_message_counter,
+        companion.last_message_time,
+        facts.added_since(facts_appended) if facts is not None and facts.appended > facts_appended else ()
+    ))
+
+
+def apply_delta(companion, data, data_format=PICKLE_FORMAT):
+    delta = loads(data, data_format)
+    # Deltas written before facts were remembered have no facts
+    if len(delta) == 9:
+        delta += ((),)
+    (emotional_state, initiative, memory, summary, dropped, messages, token_counts,
+     short_message_counter, last_message_time, facts) = delta
+    companion.emotional_state.set_state(emotional_state)
+    companion.initiative.set_state(initiative)
+    companion.memory.set_state(memory)
+    if summary is not None:
+        companion.memory.summary = RollingSummary.from_state(summary)
+    if dropped:
+        del companion.conversation_history[:dropped]
+        del companion.history_token_counts[:dropped]
+        companion.history_offset += dropped
+    companion.conversation_history.extend({"role": role, "content": content} for role, content in messages)
+    companion.history_token_counts.extend(token_counts)
+    companion.short_message_counter = short_message_counter
+    companion.last_message_time = last_message_time
+    if facts:
+        if companion.memory.facts is None:
+            companion.memory.facts = FactStore()
+        companion.memory.facts.extend(facts)
+
+
+class SessionStore:
+    """Snapshots and turn journals of sessions in an SQLite file"""
+
+    def __init__(self, path):
+        self.path = path
+        import sqlite3  # Here, as the gateway may run without a store
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        # Appending to the write-ahead log does not wait for the disk on every turn
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS snapshots (session_id TEXT PRIMARY KEY, seq INTEGER, state BLOB, "
+            f"format INTEGER NOT NULL DEFAULT {MARSHAL_FORMAT})"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS journal (session_id TEXT, seq INTEGER, delta BLOB, "
+            f"format INTEGER NOT NULL DEFAULT {MARSHAL_FORMAT}, PRIMARY KEY (session_id, seq)) WITHOUT ROWID"
+        )
+        for table in ("snapshots", "journal"):
+            columns = [row[1] for row in self._db.execute(f"PRAGMA table_info({table})")]
+            if "format" not in columns:
+                # A store from before the column: its rows are marshal data
+                self._db.execute(
+                    f"ALTER TABLE {table} ADD COLUMN format INTEGER NOT NULL DEFAULT {MARSHAL_FORMAT}"
+                )
+        self._db.commit()
+
+    def save_snapshot(self, session_id, companion, seq):
+        """Stores the complete state and drops the journal it replaces"""
+        self._db.execute(
+            "INSERT OR REPLACE INTO snapshots (session_id, seq, state, format) VALUES (?, ?, ?, ?)",
+            (session_id, seq, dumps(companion.get_state()), PICKLE_FORMAT)
+        )
+        self._db.execute("DELETE FROM journal WHERE session_id = ? AND seq <= ?", (session_id, seq))
+        self._db.commit()
+
+    def append_delta(self, session_id, seq, delta):
+        """Stores a delta from encode_delta()"""
+        self._db.execute(
+            "INSERT OR REPLACE INTO journal (session_id, seq, delta, format) VALUES (?, ?, ?, ?)",
+            (session_id, seq, delta, PICKLE_FORMAT)
+        )
+        self._db.commit()
+
+    def load(self, session_id):
+        """Returns (companion, seq, journal length) of a stored session, or None"""
+        row = self._db.execute(
+            "SELECT seq, state, format FROM snapshots WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        seq, state, state_format = row
+        companion = VirtualCompanion.from_state(loads(state, state_format))
+        deltas = self._db.execute(
+            "SELECT seq, delta, format FROM journal WHERE session_id = ? AND seq > ? ORDER BY seq",
+            (session_id, seq)
+        ).fetchall()
+        for seq, delta, delta_format in deltas:
+            apply_delta(companion, delta, delta_format)
+        return companion, seq, len(deltas)
+
+    def load_all(self):
+        """Yields (session_id, companion) for every stored session, reading
+        snapshots and journals in two sequential scans"""
+        journal = self._db.execute(
+            "SELECT session_id, seq, delta, format FROM journal ORDER BY session_id, seq"
+        )
+        pending = next(journal, None)
+        snapshots = self._db.execute("SELECT session_id, seq, state, format FROM snapshots ORDER BY session_id")
+        for session_id, snapshot_seq, state, state_format in snapshots:
+            companion = VirtualCompanion.from_state(loads(state, state_format))
+            while pending is not None and pending[0] < session_id:
+                pending = next(journal, None)
+            while pending is not None and pending[0] == session_id:
+                if pending[1] > snapshot_seq:
+                    apply_delta(companion, pending[2], pending[3])
+                pending = next(journal, None)
+            yield session_id, companion
+
+    def delete(self, session_id):
+        self._db.execute("DELETE FROM snapshots WHERE session_id = ?", (session_id,))
+        self._db.execute("DELETE FROM journal WHERE session_id = ?", (session_id,))
+        self._db.commit()
+
+    def get_stats(self):
+        sessions = self._db.execute("SELECT COUNT(*) FROM snapshots").fetchone()[0]
+        deltas = self._db.execute("SELECT COUNT(*) FROM journal").fetchone()[0]
+        return {"sessions": sessions, "journal_entries": deltas}
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+class _LiveSession:
+    __slots__ = (
+        "companion", "seq", "journal_length", "history_offset", "history_length", "facts_appended",
+        "users", "last_active"
+    )
+
+    def __init__(self, companion, seq, journal_length):
+        self.companion = companion
+        self.seq = seq  # Number of changes written to the store
+        self.journal_length = journal_length  # Deltas written since the last snapshot
+        self.users = 0
+        self.last_active = time.monotonic()
+        self.mark_saved()
+
+    def mark_saved(self):
+        self.history_offset = self.companion.history_offset
+        self.history_length = len(self.companion.conversation_history)
+        facts = self.companion.memory.facts
+        self.facts_appended = facts.appended if facts is not None else 0
+
+
+class SessionManager:
+    """Live sessions in memory, backed by a SessionStore"""
+
+    def __init__(self, store, idle_timeout=300, snapshot_interval=20):
+        self.store = store
+        self.idle_timeout = idle_timeout
+        self.snapshot_interval = snapshot_interval
+        self._sessions = {}
+        self.stats = {"created": 0, "rehydrated": 0, "evicted": 0}
+
+    def open(self, session_id, user_age, communication_style):
+        """Returns (companion, resumed) for a session, loading it from the
+        store if it is not in memory and creating it if it is not stored"""
+        session = self._sessions.get(session_id)
+        resumed = True
+        if session is None:
+            loaded = self.store.load(session_id)
+            if loaded is not None:
+                session = _LiveSession(*loaded)
+                self.stats["rehydrated"] += 1
+            else:
+                session = _LiveSession(VirtualCompanion(user_age, communication_style), 0, 0)
+                self.stats["created"] += 1
+                resumed = False
+            self._sessions[session_id] = session
+        session.users += 1
+        session.last_active = time.monotonic()
+        return session.companion, resumed
+
+    def record_turn(self, session_id):
+        """Writes the changes of the last turn: a delta, or a new snapshot
+        for new sessions and long journals"""
+        session = self._sessions[session_id]
+        session.seq += 1
+        session.last_active = time.monotonic()
+        if session.seq == 1 or session.journal_length >= self.snapshot_interval:
+            self.store.save_snapshot(session_id, session.companion, session.seq)
+            session.journal_length = 0
+        else:
+            delta = encode_delta(
+                session.companion, session.history_offset, session.history_length, session.facts_appended
+            )
+            self.store.append_delta(session_id, session.seq, delta)
+            session.journal_length += 1
+        session.mark_saved()
+
+    def release(self, session_id):
+        """Marks that a connection no longer uses the session"""
+        session = self._sessions.get(session_id)
+        if session is not None:
+            session.users -= 1
+            session.last_active = time.monotonic()
+
+    def evict_idle(self, now=None):
+        """Moves sessions idle for longer than idle_timeout out of memory and
+        returns how many were evicted"""
+        now = time.monotonic() if now is None else now
+        idle = [
+            session_id for session_id, session in self._sessions.items()
+            if session.users <= 0 and now - session.last_active > self.idle_timeout
+        ]
+        for session_id in idle:
+            self._evict(session_id)
+        return len(idle)
+
+    def close(self):
+        """Snapshots every live session and closes the store"""
+        for session_id in list(self._sessions):
+            self._evict(session_id)
+        self.store.close()
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats["live"] = len(self._sessions)
+        return stats
+
+    def _evict(self, session_id):
+        session = self._sessions.pop(session_id)
+        # Compact the journal so the next load reads a single snapshot
+        if session.journal_length:
+            self.store.save_snapshot(session_id, session.companion, session.seq)
+        self.stats["evicted"] += 1
+
+
+def get_session_manager(path=None, idle_timeout=None):
+    """Returns a SessionManager for the store at path, or None without a path.
+
+    Read from the environment when not given: SESSION_STORE_PATH,
+    SESSION_IDLE_TIMEOUT (seconds) and SESSION_SNAPSHOT_INTERVAL (turns).
+    """
+    path = path or os.getenv("SESSION_STORE_PATH")
+    if not path:
+        return None
+    if idle_timeout is None:
+        idle_timeout = float(os.getenv("SESSION_IDLE_TIMEOUT", 300))
+    return SessionManager(
+        SessionStore(path),
+        idle_timeout=idle_timeout,
+        snapshot_interval=int(os.getenv("SESSION_SNAPSHOT_INTERVAL", 20))
+    )
@@ -0,0 +1,270 @@
+"""Sessions sharded over worker processes, to use more than one core.
+
+A basic-mode turn is pure Python and holds the GIL the whole time, so one
+process answers at most one core's worth of turns. A ShardPool runs
+SHARD_WORKERS worker processes (default: one per CPU), each owning the
+VirtualCompanion sessions of its shard. Sessions are assigned to workers
+with consistent hashing of their id: each worker has SHARD_VNODES points
+on a hash ring, and a session belongs to the worker of the next point
+after its own hash. A session stays on its worker for its lifetime, so its
+state never leaves the process between turns.
+
+Commands are queued per worker and sent by flush() as one marshal-encoded
+batch per worker over a pipe, so a round of turns of thousands of sessions
+costs each worker one message in and one out, and the workers answer in
+parallel:
+
+    pool = ShardPool(4)
+    pool.open("s1", 20, "friendly")
+    pool.send("s1", "I like music")
+    greeting, reply = pool.flush()
+    pool.close()
+
+When workers are added or removed, only the sessions whose point on the
+ring changed owner move, about 1/N of them, as their get_state() snapshot.
+"""
+import hashlib
+import marshal
+import multiprocessing
+import os
+from bisect import bisect, insort
+
+# Commands of a worker batch
+_OPEN = 0
+_MESSAGE = 1
+_CLOSE = 2
+_TAKE = 3  # Removes a session and returns its state, to move it
+_PUT = 4  # Adds a session from its state
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent hashing of session ids onto workers"""
+
+    def __init__(self, vnodes=None):
+        self.vnodes = vnodes or int(os.getenv("SHARD_VNODES", 128))
+        self._points = []  # Sorted hashes of the virtual nodes
+        self._owners = {}  # Point -> worker
+
+    def __len__(self):
+        return len(set(self._owners.values()))
+
+    def add(self, worker):
+        for vnode in range(self.vnodes):
+            point = _hash(f"{worker}:{vnode}")
+            if point not in self._owners:
+                insort(self._points, point)
+            self._owners[point] = worker
+
+    def remove(self, worker):
+        for vnode in range(self.vnodes):
+            point = _hash(f"{worker}:{vnode}")
+            if self._owners.get(point) == worker:
+                del self._owners[point]
+                del self._points[bisect(self._points, point) - 1]
+
+    def owner(self, key):
+        """Returns the worker a session id belongs to"""
+        if not self._points:
+            raise Exception("The hash ring has no workers")
+        index = bisect(self._points, _hash(key))
+        return self._owners[self._points[index % len(self._points)]]
+
+
+def _run_worker(connection):
+    """Main loop of a worker process: answers batches of commands until the pipe closes"""
+    # Imported here, so the supervisor does not need the companion
+    from virtual_companion import VirtualCompanion
+
+    sessions = {}
+    while True:
+        try:
+            data = connection.recv_bytes()
+        except EOFError:
+            break
+        # An empty message stops the worker: with fork, its siblings hold copies of
+        # the supervisor's end of the pipe, so closing it is not enough
+        if not data:
+            break
+        batch = marshal.loads(data)
+        results = []
+        for command in batch:
+            try:
+                kind = command[0]
+                if kind == _MESSAGE:
+                    result = _reply(sessions[command[1]].respond(command[2]))
+                elif kind == _OPEN:
+                    companion = sessions[command[1]] = VirtualCompanion(command[2], command[3])
+                    result = _reply(companion.greeting())
+                elif kind == _CLOSE:
+                    result = sessions.pop(command[1], None) is not None
+                elif kind == _TAKE:
+                    result = sessions.pop(command[1]).get_state()
+                else:
+                    sessions[command[1]] = VirtualCompanion.from_state(command[2])
+                    result = True
+            except KeyError as e:
+                result = ("error", f"Unknown session {e.args[0]}")
+            except Exception as e:
+                result = ("error", str(e))
+            results.append(result)
+        connection.send_bytes(marshal.dumps(results))
+    connection.close()
+
+
+def _reply(reply):
+    return ("reply", str(reply), reply.source, reply.mood)
+
+
+class ShardPool:
+    """Supervisor of the worker processes and router of their sessions.
+
+    open(), send() and close_session() queue a command; flush() sends the
+    queued commands and returns their results in the order they were
+    queued: (text, source, mood) for a greeting or reply, True or False for
+    close_session(), and an Exception for a command that failed.
+    """
+
+    def __init__(self, workers=None, vnodes=None):
+        workers = workers or int(os.getenv("SHARD_WORKERS", 0)) or os.cpu_count() or 1
+        self.ring = HashRing(vnodes)
+        self._workers = {}  # Worker id -> (process, connection)
+        self._next_worker = 0
+        self._sessions = {}  # Session id -> worker id
+        self._pending = {}  # Worker id -> queued commands
+        self._order = []  # (worker id, index in its batch) of every queued command
+        self.stats = {"batches": 0, "commands": 0, "moved": 0}
+        for _ in range(workers):
+            self._start_worker()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    @property
+    def workers(self):
+        return list(self._workers)
+
+    def open(self, session_id, user_age, communication_style):
+        """Queues a new session on its worker; its result is the greeting"""
+        worker = self._sessions.get(session_id)
+        if worker is None:
+            worker = self._sessions[session_id] = self.ring.owner(session_id)
+        self._queue(worker, (_OPEN, session_id, user_age, communication_style))
+
+    def send(self, session_id, message):
+        """Queues a user message; its result is the reply"""
+        self._queue(self._worker_of(session_id), (_MESSAGE, session_id, message))
+
+    def close_session(self, session_id):
+        self._queue(self._worker_of(session_id), (_CLOSE, session_id))
+        del self._sessions[session_id]
+
+    def flush(self):
+        """Sends the queued commands to the workers and returns their results"""
+        pending, order = self._pending, self._order
+        self._pending = {}
+        self._order = []
+        # Every worker gets its batch before the first answer is read, so they work in parallel
+        for worker, batch in pending.items():
+            self._workers[worker][1].send_bytes(marshal.dumps(batch))
+        answers = {worker: marshal.loads(self._workers[worker][1].recv_bytes()) for worker in pending}
+        self.stats["batches"] += len(pending)
+        self.stats["commands"] += len(order)
+        results = []
+        for worker, index in order:
+            result = answers[worker][index]
+            if result.__class__ is tuple:
+                if result[0] == "reply":
+                    result = result[1:]
+                elif result[0] == "error":
+                    result = Exception(f"Shard worker {worker}: {result[1]}")
+            results.append(result)
+        return results
+
+    def add_worker(self):
+        """Starts another worker and moves the sessions it now owns to it;
+        returns its id"""
+        self._check_flushed()
+        worker = self._start_worker()
+        self._rebalance()
+        return worker
+
+    def remove_worker(self, worker):
+        """Moves the sessions of a worker to the others and stops it"""
+        if len(self._workers) == 1:
+            raise Exception("Cannot remove the last shard worker")
+        self._check_flushed()
+        self.ring.remove(worker)
+        self._rebalance()
+        self._stop_worker(*self._workers.pop(worker))
+
+    def close(self):
+        """Stops every worker; their sessions are lost"""
+        for process, connection in self._workers.values():
+            self._stop_worker(process, connection)
+        self._workers.clear()
+        self._sessions.clear()
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats["workers"] = len(self._workers)
+        stats["sessions"] = len(self._sessions)
+        stats["sessions_per_worker"] = {worker: 0 for worker in self._workers}
+        for worker in self._sessions.values():
+            stats["sessions_per_worker"][worker] += 1
+        return stats
+
+    def _start_worker(self):
+        worker = self._next_worker
+        self._next_worker += 1
+        connection, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_run_worker, args=(child,), name=f"shard-{worker}", daemon=True)
+        process.start()
+        child.close()
+        self._workers[worker] = (process, connection)
+        self.ring.add(worker)
+        return worker
+
+    @staticmethod
+    def _stop_worker(process, connection):
+        connection.send_bytes(b"")
+        connection.close()
+        process.join()
+
+    def _check_flushed(self):
+        if self._order:
+            raise Exception("Flush the queued commands before adding or removing workers")
+
+    def _worker_of(self, session_id):
+        worker = self._sessions.get(session_id)
+        if worker is None:
+            raise Exception(f"Unknown session {session_id}")
+        return worker
+
+    def _queue(self, worker, command):
+        batch = self._pending.setdefault(worker, [])
+        self._order.append((worker, len(batch)))
+        batch.append(command)
+
+    def _rebalance(self):
+        """Moves every session whose owner on the ring changed"""
+        moves = [(session_id, worker, self.ring.owner(session_id))
+                 for session_id, worker in self._sessions.items()]
+        moves = [move for move in moves if move[1] != move[2]]
+        if not moves:
+            return
+        for session_id, source, _ in moves:
+            self._queue(source, (_TAKE, session_id))
+        states = self.flush()
+        for (session_id, _, target), state in zip(moves, states):
+            if isinstance(state, Exception):
+                raise state
+            self._queue(target, (_PUT, session_id, state))
+            self._sessions[session_id] = target
+        for result in self.flush():
+            if isinstance(result, Exception):
+                raise result
+        self.stats["moved"] += len(moves)
@@ -0,0 +1,245 @@
+"""Fast-forward simulation of conversations on a virtual clock.
+
+Companions take the time from an injected clock and their randomness from
+an injected random.Random, so many sessions can run on one VirtualClock
+that jumps from one event to the next instead of waiting. Users send their
+messages after a think time, and now and then fall silent for minutes, so
+the 20 second pause rule, the adaptive interval between initiatives and the
+idle-time initiatives of the InitiativeScheduler all take effect. Hours of
+dialogue in thousands of sessions take seconds, and every run with the same
+--seed produces the same events:
+
+    python simulation.py --sessions 1000 --turns 100 --output events.jsonl
+    python simulation.py transcripts.jsonl --think-time 20 --seed 3
+
+Without transcripts (the JSONL format of replay.py), users send random
+messages of SAMPLE_MESSAGES. Every user message and every idle initiative
+can be written as JSONL, in the order they happened.
+"""
+import argparse
+import heapq
+import json
+import random
+import sys
+import time
+
+from initiative_scheduler import InitiativeScheduler
+from replay import companion_class, read_sessions, session_seed
+
+# Messages of the synthetic users: topics, personal facts, and short answers
+SAMPLE_MESSAGES = [
+    "hi",
+    "ok",
+    "hmm",
+    "yes",
+    "I love music, especially going to concerts with my friends",
+    "My work has been really stressful this week, my boss wants everything yesterday",
+    "I study at the university and the exams are coming up soon",
+    "That's great, thanks!",
+    "I watched a terrible movie yesterday, it was so bad",
+    "My family is visiting next weekend, my parents and my sister",
+    "I like to paint in my free time, it's my favorite hobby",
+    "How are you today?",
+    "You are so smart and cool",
+    "Do you play video games? I have been playing minecraft all day",
+    "I'm thinking about a trip abroad next summer, maybe to the beach",
+    "not sure",
+]
+STYLES = ["formal", "friendly", "romantic", "playful"]
+
+
+class VirtualClock:
+    """A clock that stands still until it is moved forward"""
+
+    __slots__ = ("now",)
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def advance_to(self, when):
+        if when > self.now:
+            self.now = when
+
+
+class _SimulatedSession:
+    __slots__ = ("session_id", "companion", "messages", "turn", "rng", "callback")
+
+    def __init__(self, session_id, companion, messages, rng):
+        self.session_id = session_id
+        self.companion = companion
+        self.messages = messages
+        self.turn = 0
+        self.rng = rng  # The user's think times, apart from the companion's randomness
+        self.callback = None
+
+
+class Simulation:
+    """Runs sessions of simulated users on one virtual clock.
+
+    Each session's companion gets a random.Random seeded from --seed and the
+    session id, and so does its user, so the events of a session do not
+    depend on the other sessions. on_event is called with a dict for every
+    reply to a user and every idle initiative.
+    """
+
+    def __init__(self, seed=0, backend="basic", think_time=15.0, pause_chance=0.1, max_pause=600.0,
+                 tick=1.0, on_event=None):
+        self.seed = seed
+        self.backend = backend
+        self.think_time = think_time  # Mean seconds between a reply and the next message
+        self.pause_chance = pause_chance  # Chance that the user falls silent before a message
+        self.max_pause = max_pause
+        self.on_event = on_event
+        self.clock = VirtualClock()
+        self.scheduler = InitiativeScheduler(tick, now=self.clock.time())
+        self._queue = []  # (time, order, session) of the next user messages
+        self._order = 0
+        self.stats = {"sessions": 0, "messages": 0, "initiatives": 0, "idle_initiatives": 0}
+
+    def add_session(self, session_id, age, style, messages):
+        """Adds a session whose user starts writing after a think time"""
+        companion = companion_class(self.backend)(
+            age, style, self.clock, random.Random(session_seed(self.seed, session_id))
+        )
+        companion.api_key = "stub" if self.backend == "stub" else None
+        companion.session_id = session_id
+        companion.greeting()
+        session = _SimulatedSession(
+            session_id, companion, list(messages), random.Random(session_seed(self.seed, "user:" + session_id))
+        )
+        session.callback = lambda reply, session=session: self._idle_initiative(session, reply)
+        self.stats["sessions"] += 1
+        self._next_message(session)
+
+    def run(self):
+        """Runs until every user sent all messages; returns the stats"""
+        started = time.perf_counter()
+        start_time = self.clock.time()
+        while self._queue:
+            when, _, session = heapq.heappop(self._queue)
+            self._advance(when)
+            self._send(session)
+        stats = dict(self.stats)
+        stats["simulated"] = self.clock.time() - start_time
+        stats["elapsed"] = time.perf_counter() - started
+        return stats
+
+    def _advance(self, when):
+        """Moves the clock to when, sending idle initiatives at the tick they are due"""
+        scheduler = self.scheduler
+        tick = scheduler.wheel.tick
+        while len(scheduler.wheel):
+            next_tick = (self.clock.now // tick + 1) * tick
+            if next_tick > when:
+                break
+            self.clock.advance_to(next_tick)
+            scheduler.run_due(next_tick)
+        self.clock.advance_to(when)
+
+    def _next_message(self, session):
+        if session.turn == len(session.messages):
+            # The user left
+            self.scheduler.cancel(session.session_id)
+            return
+        rng = session.rng
+        if rng.random() < self.pause_chance:
+            delay = rng.uniform(self.think_time, self.max_pause)
+        else:
+            delay = rng.expovariate(1 / self.think_time)
+        self._order += 1
+        heapq.heappush(self._queue, (self.clock.time() + delay, self._order, session))
+
+    def _send(self, session):
+        companion = session.companion
+        self.scheduler.cancel(session.session_id)
+        message = session.messages[session.turn]
+        last_initiative_time = companion.initiative.last_initiative_time
+        reply = companion.respond(message)
+        initiative = companion.initiative.last_initiative_time != last_initiative_time
+        self.stats["messages"] += 1
+        self.stats["initiatives"] += initiative
+        self._event(session, "reply", reply, message, initiative)
+        session.turn += 1
+        self.scheduler.schedule(session.session_id, companion, session.callback)
+        self._next_message(session)
+
+    def _idle_initiative(self, session, reply):
+        self.stats["idle_initiatives"] += 1
+        self._event(session, "idle", reply, None, True)
+
+    def _event(self, session, kind, reply, message, initiative):
+        if self.on_event is None:
+            return
+        companion = session.companion
+        topic = companion.memory.current_topic
+        self.on_event({
+            "session_id": session.session_id,
+            "time": round(self.clock.time(), 3),
+            "turn": session.turn,
+            "kind": kind,
+            "message": message,
+            "mood": companion.emotional_state.mood,
+            "energy": companion.emotional_state.energy,
+            "topic": companion.topic_table.names[topic] if topic is not None else None,
+            "initiative": initiative,
+            "interval": round(companion.initiative.interval_between_initiatives, 3),
+            "reply": str(reply)
+        })
+
+
+def synthetic_sessions(count, turns, seed):
+    """Yields sessions of random users sending random sample messages"""
+    rng = random.Random(seed)
+    for number in range(count):
+        yield (f"sim{number}", rng.randint(13, 60), rng.choice(STYLES),
+               [rng.choice(SAMPLE_MESSAGES) for _ in range(turns)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate conversations on a virtual clock")
+    parser.add_argument("transcripts", nargs="*", help="JSONL transcript files, or - for stdin")
+    parser.add_argument("--sessions", type=int, default=1000, help="Synthetic sessions without transcripts")
+    parser.add_argument("--turns", type=int, default=100, help="Messages per synthetic session")
+    parser.add_argument("--seed", type=int, default=0, help="Base random seed of all sessions")
+    parser.add_argument("--think-time", type=float, default=15.0, help="Mean seconds before the next message")
+    parser.add_argument("--pause-chance", type=float, default=0.1,
+                        help="Chance that the user is silent for longer before a message")
+    parser.add_argument("--max-pause", type=float, default=600.0, help="Longest silence in seconds")
+    parser.add_argument("--backend", choices=["basic", "stub"], default="basic",
+                        help="basic templates, or the GPT path with a canned reply instead of the API")
+    parser.add_argument("--output", help="Write every reply and idle initiative to this JSONL file")
+    args = parser.parse_args()
+
+    output = open(args.output, "w", encoding="utf-8") if args.output else None
+
+    def write_event(event):
+        output.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+    simulation = Simulation(
+        args.seed, args.backend, args.think_time, args.pause_chance, args.max_pause,
+        on_event=write_event if output else None
+    )
+    if args.transcripts:
+        sessions = read_sessions(args.transcripts)
+    else:
+        sessions = synthetic_sessions(args.sessions, args.turns, args.seed)
+    try:
+        for session in sessions:
+            simulation.add_session(*session)
+        stats = simulation.run()
+    finally:
+        if output:
+            output.close()
+    print(
+        f"{stats['sessions']} sessions, {stats['messages']} messages, {stats['initiatives']} initiatives "
+        f"in replies and {stats['idle_initiatives']} idle initiatives over {stats['simulated'] / 3600:.2f} h "
+        f"of virtual time in {stats['elapsed']:.2f} s",
+        file=sys.stderr
+    )
+
+
+if __name__ == "__main__":
+    main()
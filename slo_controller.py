@@ -0,0 +1,356 @@
+"""Latency budget of a turn and adaptive switching to basic mode.
+
+Every GPT turn has a latency budget (TURN_LATENCY_BUDGET seconds, default
+5; 0 turns deadlines off). If the backend has not answered by the end of
+the budget, or for streams has not sent the first chunk, the turn is
+answered from the templates right away. The backend call goes on in the
+background and its late reply can still go into the conversation history.
+
+The process-wide SLOController keeps a rolling window of backend
+latencies and failures. When the 95th percentile latency exceeds the
+budget or too many calls fail, it switches sessions to basic mode, and
+lets one probe turn per SLO_PROBE_INTERVAL seconds through to the
+backend. Once the probes come back well within the budget it switches
+back to GPT mode. The gap between the two thresholds keeps the mode from
+flapping. Mode switches are kept as events and counted in the metrics,
+along with the SLO outcome of every turn:
+
+    gpt       answered by the backend within the budget
+    deadline  answered from the templates because the budget ran out
+    error     answered from the templates because the backend failed
+    basic     answered from the templates while in basic mode
+"""
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+import metrics
+
+OUTCOMES = ("gpt", "deadline", "error", "basic")
+
+# Backend calls in the window needed to leave GPT mode, and probes needed to return to it
+DEGRADE_SAMPLES = 10
+RECOVER_SAMPLES = 5
+# Basic mode starts above these and ends below the recover ones
+DEGRADE_ERROR_RATE = 0.25
+RECOVER_ERROR_RATE = 0.05
+RECOVER_LATENCY_FRACTION = 0.5  # Of the budget
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, budget):
+        super().__init__(f"no reply within the turn budget of {budget:.1f}s")
+
+
+class _StreamEnd:
+    pass
+
+
+class SLOController:
+    """Tracks backend latency and errors and decides between GPT and basic mode"""
+
+    def __init__(self, budget=None, window=None, probe_interval=None):
+        self.budget = budget if budget is not None else float(os.getenv("TURN_LATENCY_BUDGET", 5))
+        self.probe_interval = probe_interval or float(os.getenv("SLO_PROBE_INTERVAL", 10))
+        self.samples = deque(maxlen=window or int(os.getenv("SLO_WINDOW", 50)))  # (latency, failed)
+        self.gpt_mode = True
+        self.last_probe = 0.0
+        self.events = deque(maxlen=100)  # Recent mode switches
+        self.outcomes = dict.fromkeys(OUTCOMES, 0)
+        self._executor = None
+        self._late_tasks = set()
+        self._lock = threading.Lock()
+
+    def allow_gpt(self):
+        """Returns True if a turn may use the backend: always in GPT mode,
+        and once per probe interval in basic mode"""
+        if self.gpt_mode:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            if now - self.last_probe < self.probe_interval:
+                return False
+            self.last_probe = now
+        return True
+
+    def remaining(self, started):
+        """Returns the seconds left of a turn that started at a
+        time.perf_counter() value, or None without a budget"""
+        if not self.budget:
+            return None
+        return started + self.budget - time.perf_counter()
+
+    def record(self, latency, failed=False):
+        """Adds a backend call to the window and switches mode if needed"""
+        with self._lock:
+            self.samples.append((latency, failed))
+            if self.gpt_mode and len(self.samples) >= DEGRADE_SAMPLES:
+                latency, error_rate = self._window_stats()
+                if self.budget and latency > self.budget:
+                    self._switch(False, f"p95 latency {latency:.2f}s over the budget", latency, error_rate)
+                elif error_rate > DEGRADE_ERROR_RATE:
+                    self._switch(False, f"error rate {error_rate:.0%}", latency, error_rate)
+            elif not self.gpt_mode and len(self.samples) >= RECOVER_SAMPLES:
+                # Judged on the latest calls, as calls from before the switch may still come in slowly
+                latency, error_rate = self._window_stats(RECOVER_SAMPLES)
+                fast = not self.budget or latency <= self.budget * RECOVER_LATENCY_FRACTION
+                if fast and error_rate <= RECOVER_ERROR_RATE:
+                    self._switch(True, "backend recovered", latency, error_rate)
+
+    def record_turn(self, outcome, style=None):
+        with self._lock:
+            self.outcomes[outcome] += 1
+        registry = metrics.get_registry()
+        if registry is not None:
+            registry.inc("companion_slo_turns_total", (("style", style), ("outcome", outcome)))
+
+    def call(self, function, timeout, on_late=None):
+        """Returns function() if it finishes within timeout seconds (no limit
+        if None), otherwise raises DeadlineExceeded and passes the result
+        to on_late once it is there"""
+        started = time.perf_counter()
+        if timeout is None:
+            try:
+                result = function()
+            except Exception:
+                self.record(time.perf_counter() - started, True)
+                raise
+            self.record(time.perf_counter() - started)
+            return result
+
+        from concurrent.futures import TimeoutError as FutureTimeoutError
+        late = [False]
+
+        def finished(future):
+            error = future.exception()
+            self.record(time.perf_counter() - started, error is not None)
+            if late[0] and error is None and on_late is not None:
+                on_late(future.result())
+
+        future = self._pool().submit(function)
+        future.add_done_callback(finished)
+        try:
+            return future.result(timeout=max(0.0, timeout))
+        except FutureTimeoutError:
+            late[0] = True
+            # It may have finished just now, before it was marked late
+            if future.done() and future.exception() is None:
+                return future.result()
+            raise DeadlineExceeded(self.budget)
+
+    async def call_async(self, coroutine, timeout, on_late=None):
+        """Same as call() for a coroutine"""
+        import asyncio  # Here, so sync callers start without it
+        started = time.perf_counter()
+        task = asyncio.ensure_future(coroutine)
+        late = [False]
+
+        def finished(task):
+            if task.cancelled():
+                return
+            error = task.exception()
+            self.record(time.perf_counter() - started, error is not None)
+            if late[0] and error is None and on_late is not None:
+                on_late(task.result())
+
+        task.add_done_callback(finished)
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.TimeoutError:
+            late[0] = True
+            raise DeadlineExceeded(self.budget)
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+
+    def stream(self, chunks, timeout, on_late=None):
+        """Yields the chunks of an iterator, read in a worker thread. Raises
+        DeadlineExceeded if the first chunk takes longer than timeout
+        seconds; the rest of the stream is then read in the background and
+        passed joined to on_late."""
+        if timeout is None:
+            yield from self._timed_stream(chunks)
+            return
+
+        events = queue.Queue()
+        state = {"late": False, "stopped": False}
+        lock = threading.Lock()
+        started = time.perf_counter()
+
+        def pump():
+            collected = []
+            error = None
+            first = True
+            try:
+                for chunk in chunks:
+                    if first:
+                        first = False
+                        self.record(time.perf_counter() - started)
+                    with lock:
+                        if state["stopped"]:
+                            break
+                        if not state["late"]:
+                            events.put((chunk, None))
+                            continue
+                    collected.append(chunk)
+            except Exception as e:
+                error = e
+                if first:
+                    self.record(time.perf_counter() - started, True)
+            with lock:
+                late = state["late"]
+                if not late:
+                    events.put((_StreamEnd, error))
+            if late and error is None and collected and on_late is not None:
+                on_late("".join(collected).strip())
+
+        self._pool().submit(pump)
+        try:
+            try:
+                chunk, error = events.get(timeout=max(0.0, timeout))
+            except queue.Empty:
+                with lock:
+                    if events.empty():
+                        state["late"] = True
+                        raise DeadlineExceeded(self.budget)
+                chunk, error = events.get()
+            while chunk is not _StreamEnd:
+                yield chunk
+                chunk, error = events.get()
+            if error is not None:
+                raise error
+        finally:
+            with lock:
+                state["stopped"] = not state["late"]
+
+    async def stream_async(self, chunks, timeout, on_late=None):
+        """Same as stream() for an async iterator"""
+        import asyncio
+        iterator = chunks.__aiter__()
+        started = time.perf_counter()
+        first = asyncio.ensure_future(_first_chunk(iterator))
+        try:
+            chunk = await asyncio.wait_for(asyncio.shield(first), timeout)
+        except asyncio.TimeoutError:
+            task = asyncio.ensure_future(self._finish_late_stream(first, iterator, started, on_late))
+            # Keep a reference until it is done
+            self._late_tasks.add(task)
+            task.add_done_callback(self._late_tasks.discard)
+            raise DeadlineExceeded(self.budget)
+        except asyncio.CancelledError:
+            first.cancel()
+            raise
+        except Exception:
+            self.record(time.perf_counter() - started, True)
+            raise
+        self.record(time.perf_counter() - started)
+        if chunk is _StreamEnd:
+            return
+        yield chunk
+        async for chunk in iterator:
+            yield chunk
+
+    def get_stats(self):
+        with self._lock:
+            latency, error_rate = self._window_stats()
+            answered = self.outcomes["gpt"] + self.outcomes["deadline"] + self.outcomes["error"]
+            return {
+                "mode": "gpt" if self.gpt_mode else "basic",
+                "budget": self.budget,
+                "p95_latency": latency,
+                "error_rate": error_rate,
+                "outcomes": dict(self.outcomes),
+                # Share of backend turns answered by the backend within the budget
+                "slo_attainment": self.outcomes["gpt"] / answered if answered else 1.0,
+                "mode_switches": list(self.events)
+            }
+
+    def _timed_stream(self, chunks):
+        started = time.perf_counter()
+        first = True
+        try:
+            for chunk in chunks:
+                if first:
+                    first = False
+                    self.record(time.perf_counter() - started)
+                yield chunk
+        except Exception:
+            if first:
+                self.record(time.perf_counter() - started, True)
+            raise
+
+    async def _finish_late_stream(self, first, iterator, started, on_late):
+        try:
+            chunk = await first
+        except Exception:
+            self.record(time.perf_counter() - started, True)
+            return
+        self.record(time.perf_counter() - started)
+        if chunk is _StreamEnd:
+            return
+        collected = [chunk]
+        try:
+            async for chunk in iterator:
+                collected.append(chunk)
+        except Exception:
+            return
+        if on_late is not None:
+            on_late("".join(collected).strip())
+
+    def _window_stats(self, last=None):
+        """Returns the p95 latency and the error rate of the window, or of its last samples"""
+        samples = list(self.samples)[-last:] if last else self.samples
+        if not samples:
+            return 0.0, 0.0
+        latencies = sorted(latency for latency, _ in samples)
+        failures = sum(1 for _, failed in samples if failed)
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        return p95, failures / len(samples)
+
+    def _switch(self, gpt_mode, reason, latency, error_rate):
+        self.gpt_mode = gpt_mode
+        mode = "gpt" if gpt_mode else "basic"
+        # The next mode is judged on new calls only (in basic mode, the probes)
+        self.samples.clear()
+        self.last_probe = time.monotonic()
+        self.events.append({
+            "time": time.time(), "mode": mode, "reason": reason,
+            "p95_latency": latency, "error_rate": error_rate
+        })
+        registry = metrics.get_registry()
+        if registry is not None:
+            registry.inc("companion_mode_switches_total", (("mode", mode),))
+            registry.set_gauge("companion_gpt_mode", (), 1 if gpt_mode else 0)
+
+    def _pool(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    from concurrent.futures import ThreadPoolExecutor  # Here, so basic mode starts without it
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=int(os.getenv("SLO_THREADS", 32)), thread_name_prefix="turn"
+                    )
+        return self._executor
+
+
+async def _first_chunk(iterator):
+    try:
+        return await iterator.__anext__()
+    except StopAsyncIteration:
+        return _StreamEnd
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_controller():
+    """Returns the process-wide SLO controller"""
+    global _controller
+    if _controller is None:
+        with _controller_lock:
+            if _controller is None:
+                _controller = SLOController()
+    return _controller
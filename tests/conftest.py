@@ -0,0 +1,48 @@
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import environment
+
+# Tests never call a real API and use the defaults, whatever the .env file says
+environment.load()
+os.environ["OPENAI_API_KEY"] = ""
+for name in ("COMPANION_BACKEND", "COMPANION_HEDGE_BACKEND", "EVENT_LOG_PATH", "COMPANION_METRICS",
+             "RESPONSE_CACHE", "SESSION_STORE_PATH"):
+    os.environ.pop(name, None)
+
+import backends
+
+
+@pytest.fixture
+def template_backend():
+    """Answers GPT turns from the templates, so they fill the history without a network"""
+    previous = backends._backend
+    backends.set_backend(backends.TemplateBackend())
+    yield backends.get_backend()
+    backends.set_backend(previous)
+
+
+class FakeClock:
+    """Moves a minute on with every reading, so pauses and initiatives come due"""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        self.now += 60
+        return self.now
+
+
+@pytest.fixture
+def rng():
+    return random.Random(7)
+
+
+@pytest.fixture
+def fake_clock():
+    return FakeClock()
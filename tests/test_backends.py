@@ -0,0 +1,167 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import backends
+from backends import HedgedBackend, TemplateBackend, TemplateReply
+from virtual_companion import VirtualCompanion
+
+
+class FakeBackend:
+    """A model backend that answers after a delay, or fails"""
+
+    name = "fake"
+    requires_api_key = False
+    cacheable = True
+    instant = False
+
+    def __init__(self, reply="model reply", delay=0.0, error=None):
+        self.reply = reply
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+
+    def request_data(self, messages):
+        return {"model": self.name, "messages": messages, "max_tokens": 10}
+
+    def generate(self, companion, data, priority=backends.INTERACTIVE):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return self.reply
+
+    async def generate_async(self, companion, data, priority=backends.INTERACTIVE, client=None):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return self.reply
+
+    def stream(self, companion, data, priority=backends.INTERACTIVE):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        for word in self.reply.split(" "):
+            yield word + " "
+
+    async def stream_async(self, companion, data, priority=backends.INTERACTIVE, client=None):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        for word in self.reply.split(" "):
+            yield word + " "
+
+
+class ThreadTemplateBackend(TemplateBackend):
+    """The template backend, noting the threads it ran on"""
+
+    def __init__(self):
+        self.threads = []
+
+    def generate(self, companion, data, priority=backends.INTERACTIVE):
+        self.threads.append(threading.current_thread())
+        return super().generate(companion, data, priority)
+
+
+def hedged(primary, secondary):
+    return HedgedBackend(primary, secondary, initial_delay=0.05)
+
+
+def data():
+    return {"messages": [{"role": "user", "content": "I like music"}]}
+
+
+def generate(backend, companion, kind):
+    if kind == "generate":
+        return backend.generate(companion, data())
+    if kind == "stream":
+        return "".join(backend.stream(companion, data())).strip()
+
+    async def run():
+        if kind == "generate_async":
+            return await backend.generate_async(companion, data())
+        return "".join([chunk async for chunk in backend.stream_async(companion, data())]).strip()
+    return asyncio.run(run())
+
+
+KINDS = ["generate", "generate_async", "stream", "stream_async"]
+
+
+@pytest.fixture
+def companion(rng):
+    return VirtualCompanion(22, "friendly", rng=rng)
+
+
+@pytest.mark.parametrize("kind", KINDS)
+def test_fast_primary_is_not_hedged(companion, kind):
+    secondary = FakeBackend("hedge reply")
+    backend = hedged(FakeBackend(), secondary)
+    assert generate(backend, companion, kind) == "model reply"
+    assert secondary.calls == 0
+    assert backend.get_stats()["hedged"] == 0
+
+
+@pytest.mark.parametrize("kind", KINDS)
+def test_slow_primary_loses_to_the_hedge(companion, kind):
+    backend = hedged(FakeBackend(delay=1.0), FakeBackend("hedge reply"))
+    started = time.perf_counter()
+    assert generate(backend, companion, kind) == "hedge reply"
+    assert time.perf_counter() - started < 0.5
+    assert backend.get_stats()["hedge_wins"] == 1
+
+
+@pytest.mark.parametrize("kind", KINDS)
+def test_primary_that_fails_early_is_hedged_at_once(companion, kind):
+    backend = hedged(FakeBackend(error=Exception("primary failed")), FakeBackend("hedge reply", delay=0.01))
+    backend.initial_delay = 5.0
+    started = time.perf_counter()
+    assert generate(backend, companion, kind) == "hedge reply"
+    assert time.perf_counter() - started < 1.0
+
+
+@pytest.mark.parametrize("kind", KINDS)
+def test_error_when_both_fail(companion, kind):
+    backend = hedged(FakeBackend(error=Exception("primary failed")), FakeBackend(error=Exception("hedge failed")))
+    with pytest.raises(Exception, match="failed"):
+        generate(backend, companion, kind)
+
+
+def test_loser_still_waiting_for_a_thread_never_starts(companion):
+    from concurrent.futures import ThreadPoolExecutor
+    primary = FakeBackend()
+    backend = hedged(primary, TemplateBackend())
+    # The only pool thread is busy, so the primary waits for it while the templates answer
+    backend._executor = ThreadPoolExecutor(max_workers=1)
+    backend._executor.submit(time.sleep, 0.2)
+    assert isinstance(backend.generate(companion, data()), TemplateReply)
+    backend._executor.shutdown(wait=True)
+    assert primary.calls == 0
+
+
+@pytest.mark.parametrize("kind", ["generate", "stream"])
+def test_template_hedge_runs_on_the_calling_thread(companion, kind):
+    secondary = ThreadTemplateBackend()
+    backend = hedged(FakeBackend(delay=1.0), secondary)
+    reply = generate(backend, companion, kind)
+    assert secondary.threads == [threading.current_thread()]
+    assert reply and backend.get_stats()["hedge_wins"] == 1
+
+
+def test_template_reply_keeps_its_source(companion, monkeypatch):
+    monkeypatch.setattr(backends, "_backend", hedged(FakeBackend(delay=1.0), TemplateBackend()))
+    companion.greeting()
+    reply = companion.respond("I like music")
+    assert reply.source == "template" and reply.text.__class__ is str
+    assert companion.conversation_history[-1]["content"].__class__ is str
+    monkeypatch.setattr(backends, "_backend", hedged(FakeBackend(), TemplateBackend()))
+    assert companion.respond("I like movies").source == "gpt"
+
+
+def test_template_backend_marks_its_replies(companion):
+    response = TemplateBackend().generate(companion, data())
+    assert isinstance(response, TemplateReply)
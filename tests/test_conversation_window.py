@@ -0,0 +1,103 @@
+import pytest
+
+import conversation_window
+from conversation_window import (
+    TOKENS_PER_MESSAGE, TOKENS_PER_PROMPT, RollingSummary, estimate_message_tokens, estimate_prompt_tokens,
+    estimate_tokens,
+)
+from virtual_companion import VirtualCompanion
+
+MESSAGES = [
+    "I enjoy painting landscapes on the weekend, it calms me down a lot. Do you paint?",
+    "my work is mostly meetings with clients lately",
+    "ok",
+    "I study history at the university and I like it",
+    "how are you?",
+]
+
+
+@pytest.fixture
+def approximation(monkeypatch):
+    """Counts tokens with the built-in approximation, even where tiktoken is installed"""
+    monkeypatch.setattr(conversation_window, "_encoding", False)
+
+
+def test_token_approximation(approximation):
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("hello world!") == 3
+    # Long words count one token per six characters
+    assert estimate_tokens("internationalization") == 4
+    assert estimate_tokens("well... ok?") == 6
+
+    message = {"role": "user", "content": "hello world!"}
+    assert estimate_message_tokens(message) == 3 + TOKENS_PER_MESSAGE
+    assert estimate_prompt_tokens([message, message]) == 2 * (3 + TOKENS_PER_MESSAGE) + TOKENS_PER_PROMPT
+
+
+def test_summary_keeps_the_first_sentence_of_each_message():
+    summary = RollingSummary(words_per_point=5)
+    assert not summary
+    summary.fold({"role": "user", "content": "I got a dog.  His name is Rex."})
+    summary.fold({"role": "assistant", "content": "What a lovely dog, I would like to meet him one day"})
+    summary.fold({"role": "user", "content": "   "})
+    assert summary
+    assert summary.points == ['the user said "I got a dog."', 'you said "What a lovely dog, I..."']
+    assert summary.text() == 'the user said "I got a dog."; you said "What a lovely dog, I..."'
+    assert summary.tokens == sum(estimate_tokens(point) for point in summary.points)
+
+
+def test_summary_drops_its_oldest_points_over_budget():
+    summary = RollingSummary(token_budget=30)
+    for number in range(20):
+        summary.fold({"role": "user", "content": f"message number {number} is here"})
+        assert summary.tokens <= 30
+    assert summary.points[-1] == 'the user said "message number 19 is here"'
+    assert len(summary.points) < 20
+
+    # A single point over the budget is kept
+    summary = RollingSummary(token_budget=1)
+    summary.fold({"role": "user", "content": "a rather long message"})
+    summary.fold({"role": "user", "content": "another one"})
+    assert summary.points == ['the user said "another one"']
+
+
+def test_summary_state_round_trip():
+    summary = RollingSummary(token_budget=50, words_per_point=4)
+    for content in MESSAGES:
+        summary.fold({"role": "user", "content": content})
+    restored = RollingSummary.from_state(summary.get_state())
+    assert restored.get_state() == summary.get_state()
+    assert (restored.tokens, restored.text()) == (summary.tokens, summary.text())
+
+
+def test_history_stays_within_its_token_budget(template_backend, rng):
+    companion = VirtualCompanion(22, "friendly")
+    companion.rng = rng
+    companion.history_token_budget = 100
+    companion.greeting()
+    for turn in range(40):
+        companion.respond(MESSAGES[turn % len(MESSAGES)])
+        history = companion.conversation_history
+        # The history is fitted when the user message comes in, before the reply
+        assert sum(companion.history_token_counts[:-1]) <= 100 or len(history) <= 3
+        assert companion.history_token_counts == [estimate_message_tokens(message) for message in history]
+
+    # Every message that left the history went into the summary, and the prompt reminds the model of them
+    assert companion.history_offset > 0
+    prompt = companion._create_gpt_prompt()
+    assert prompt[1]["content"] == f"Earlier in this conversation: {companion.memory.summary.text()}."
+    assert prompt[2:2 + len(companion.conversation_history)] == companion.conversation_history
+    assert companion.last_prompt_tokens == estimate_prompt_tokens(prompt)
+
+
+def test_long_message_keeps_the_last_exchange(template_backend, rng):
+    companion = VirtualCompanion(22, "friendly")
+    companion.rng = rng
+    companion.history_token_budget = 20
+    companion.respond("hi")
+    companion.respond("tell me something " * 50)
+    # Over the budget, but the message before the long one and the reply to it stay
+    history = companion.conversation_history
+    assert [message["role"] for message in history] == ["assistant", "user", "assistant"]
+    assert history[1]["content"] == "tell me something " * 50
+    assert sum(companion.history_token_counts) > 20
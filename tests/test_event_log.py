@@ -0,0 +1,55 @@
+import pytest
+
+import event_log
+from event_log import EventLog, read_events
+from virtual_companion import VirtualCompanion
+
+MESSAGES = ["ok", "yes", "I like music", "hm", "my work is mostly meetings with clients lately", "no"]
+
+
+@pytest.fixture
+def log(tmp_path, monkeypatch):
+    log = EventLog(str(tmp_path / "events.jsonl"), flush_interval=0.01)
+    monkeypatch.setattr(event_log, "_log", log)
+    monkeypatch.setattr(event_log, "_configured", True)
+    yield log
+    log.close()
+
+
+def talk(companion, log):
+    """Returns the replies of a conversation with an idle initiative at its end,
+    the topic each initiative brought up (or None) and the logged events"""
+    replies = []
+    topics = []
+    for index in range(40):
+        taken = companion.initiative.last_initiative_time
+        replies.append(companion.respond(MESSAGES[index % len(MESSAGES)]))
+        taken = companion.initiative.last_initiative_time != taken
+        topics.append(companion.topic_table.names[companion.initiative.last_successful_topic] if taken else None)
+    replies.append(companion.idle_initiative())
+    topics.append(companion.topic_table.names[companion.initiative.last_successful_topic])
+    log.close()
+    events = list(read_events(log.path))
+    assert [event["kind"] for event in events] == ["turn"] * (len(replies) - 1) + ["initiative"]
+    assert len(set(topics)) > 2
+    return replies, topics, events
+
+
+def test_template_turns_log_the_initiative_they_took(log, rng, fake_clock):
+    companion = VirtualCompanion(22, "friendly", rng=rng, clock=fake_clock)
+    replies, topics, events = talk(companion, log)
+    for event, reply, topic in zip(events, replies, topics):
+        assert event["initiative"] == bool(reply.initiative) == (topic is not None)
+        assert event["initiative_topic"] == topic
+        if topic is not None:
+            assert topic.lower() in reply.initiative.lower()
+
+
+def test_backend_turns_log_the_initiative_they_took(log, template_backend, rng, fake_clock):
+    companion = VirtualCompanion(22, "friendly", rng=rng, clock=fake_clock)
+    replies, topics, events = talk(companion, log)
+    # Answered by _finish_gpt_turn(), with the source of the template backend
+    assert {reply.source for reply in replies[:-1]} == {"template"}
+    for event, topic in zip(events, topics):
+        assert event["initiative"] == (topic is not None)
+        assert event["initiative_topic"] == topic
@@ -0,0 +1,129 @@
+import random
+
+import pytest
+
+import fact_memory
+from fact_memory import FactStore, terms_of
+from virtual_companion import VirtualCompanion
+
+WORDS = "dog cat guitar piano football chess garden kitchen museum river bicycle coffee".split()
+
+
+def random_facts(count, rng):
+    return [(" ".join(rng.sample(WORDS, 3)) + f" fact{number}", rng.choice(["hobbies", "work"]), number)
+            for number in range(count)]
+
+
+def rebuilt_index(store):
+    """The index a store of its facts built from scratch would have"""
+    index = {}
+    for seq, (text, category, _, _) in enumerate(store.facts, store.first):
+        for term in terms_of(text) | {category}:
+            index.setdefault(term, []).append(seq)
+    return {term: postings[0] if len(postings) == 1 else postings for term, postings in index.items()}
+
+
+def test_terms_drop_punctuation_short_words_and_stopwords():
+    assert terms_of("I work at the Museum, with my brother!") == {"work", "museum", "brother"}
+    assert terms_of("(Chess) is 'fun'.") == {"chess", "fun"}
+    assert terms_of("so it is") == set()
+
+
+def test_relevant_facts_come_first():
+    store = FactStore()
+    store.add("enjoy playing chess with my brother", "hobbies", 1)
+    store.add("work as a nurse in the city hospital", "work", 2)
+    store.add("enjoy long walks with my dog", "hobbies", 3)
+    assert store.retrieve("do you like chess?", 4) == ["enjoy playing chess with my brother"]
+    # The rare word weighs more than the one all hobby facts share
+    assert store.retrieve("I enjoy my dog", 4)[0] == "enjoy long walks with my dog"
+    # Categories are index terms as well
+    assert store.retrieve("any news about work?", 4) == ["work as a nurse in the city hospital"]
+    assert store.retrieve("hi there", 4) == []
+    assert FactStore().retrieve("chess", 1) == []
+
+
+def test_older_facts_weigh_less():
+    store = FactStore(half_life=10)
+    store.add("my favourite food is pizza", "hobbies", 0)
+    store.add("pizza with pineapple is the best", "hobbies", 30)
+    assert store.retrieve("pizza", 31, limit=2) == ["pizza with pineapple is the best", "my favourite food is pizza"]
+
+
+def test_retrieval_keeps_to_its_limit_and_token_budget():
+    store = FactStore()
+    for number in range(10):
+        store.add(f"guitar lesson number {number}", "hobbies", number)
+    assert len(store.retrieve("guitar", 10, limit=3)) == 3
+    facts = store.retrieve("guitar", 10, limit=10, token_budget=12)
+    assert facts and sum(fact_memory.estimate_tokens(fact) for fact in facts) <= 12
+    assert store.retrieve("guitar", 10, token_budget=0) == []
+
+
+def test_repeated_sentence_tail_is_not_added_again():
+    store = FactStore()
+    store.add("I like to play football at work", "hobbies", 1)
+    store.add("work", "work", 1)
+    assert len(store) == 1
+    store.add("I like to play football at work", "hobbies", 2)
+    assert len(store) == 1
+    store.add("my work is boring", "work", 3)
+    assert len(store) == 2
+
+
+def test_oldest_facts_are_evicted():
+    store = FactStore(limit=20)
+    for fact in random_facts(57, random.Random(1)):
+        store.add(*fact)
+        assert len(store) <= 20
+        assert store.index == rebuilt_index(store)
+    assert store.appended == 57
+    assert store.facts[-1][0].endswith("fact56")
+    assert store.retrieve("fact56", 60) == [store.facts[-1][0]]
+    assert store.retrieve("fact0", 60) == []
+
+
+def test_scan_budget_reads_the_newest_facts(monkeypatch):
+    monkeypatch.setattr(fact_memory, "SCAN_BUDGET", 8)
+    store = FactStore()
+    for number in range(50):
+        store.add(f"coffee number {number}", "hobbies", 0)
+    assert store.retrieve("coffee", 0, limit=2) == ["coffee number 49", "coffee number 48"]
+
+
+def test_state_and_added_facts_round_trip(monkeypatch):
+    # Restored stores read their limit from the environment
+    monkeypatch.setenv("FACT_MEMORY_LIMIT", "30")
+    store = FactStore()
+    facts = random_facts(40, random.Random(2))
+    for fact in facts[:35]:
+        store.add(*fact)
+    restored = FactStore.from_state(store.get_state())
+    assert restored.get_state() == store.get_state()
+    assert restored.index == store.index
+
+    appended = store.appended
+    for fact in facts[35:]:
+        store.add(*fact)
+    restored.extend(store.added_since(appended))
+    assert restored.get_state() == store.get_state()
+    assert restored.index == rebuilt_index(restored)
+    assert restored.retrieve("chess garden", 40) == store.retrieve("chess garden", 40)
+
+
+@pytest.mark.parametrize("limit", [None, 4])
+def test_companion_reminds_the_model_of_facts(template_backend, monkeypatch, limit):
+    if limit:
+        monkeypatch.setenv("FACT_MEMORY_LIMIT", str(limit))
+    companion = VirtualCompanion(30, "friendly")
+    companion.respond("I work as a carpenter. It is fun")
+    for number in range(6):
+        companion.respond(f"my hobby number {number} is hiking")
+    companion.respond("what do you know about my work?")
+    prompt = companion._create_gpt_prompt()
+    notes = [message["content"] for message in prompt if message["role"] == "system"]
+    remembered = "work as a carpenter" in " ".join(notes)
+    # The first fact is evicted once the store is over its limit
+    assert remembered == (limit is None)
+    restored = VirtualCompanion.from_state(companion.get_state())
+    assert restored.memory.facts.get_state() == companion.memory.facts.get_state()
@@ -0,0 +1,120 @@
+import asyncio
+import json
+
+import pytest
+
+import templates
+from gateway import MAX_LINE_LENGTH, ChatGateway
+from session_store import SessionManager, SessionStore
+
+
+class FakeWriter:
+    """Collects what the gateway writes; fails on drain() once broken"""
+
+    def __init__(self, broken=False):
+        self.data = b""
+        self.broken = broken
+        self.closed = False
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        if self.broken:
+            raise ConnectionResetError("connection reset by peer")
+
+    def close(self):
+        self.closed = True
+
+
+def connect(gateway, lines, writer):
+    async def run():
+        reader = asyncio.StreamReader(limit=MAX_LINE_LENGTH)
+        reader.feed_data(lines)
+        reader.feed_eof()
+        await gateway.handle_connection(reader, writer)
+    asyncio.run(run())
+
+
+def talk(gateway, lines):
+    """Sends lines over one connection and returns the messages the gateway sent back"""
+    writer = FakeWriter()
+    connect(gateway, lines, writer)
+    assert writer.closed
+    return [json.loads(line) for line in writer.data.decode("utf-8").splitlines()]
+
+
+@pytest.fixture
+def sessions(tmp_path):
+    sessions = SessionManager(SessionStore(str(tmp_path / "sessions.db")), idle_timeout=60)
+    yield sessions
+    sessions.close()
+
+
+@pytest.mark.parametrize("resumed", [False, True])
+def test_session_is_released_when_the_greeting_fails(sessions, resumed):
+    gateway = ChatGateway(sessions=sessions)
+    if resumed:
+        connect(gateway, b"22 friendly s1\n", FakeWriter())
+    writer = FakeWriter(broken=True)
+    connect(gateway, b"22 friendly s1\n", writer)
+    assert writer.closed
+    assert sessions._sessions["s1"].users == 0
+    assert sessions.evict_idle(now=float("inf")) == 1
+
+
+def test_greeting_and_replies(template_backend):
+    messages = talk(ChatGateway(), b"22 Friendly\nhi there\n\n  \nI like music\nexit\nnot read\n")
+    assert [message["type"] for message in messages] == ["greeting", "reply", "reply"]
+    assert messages[0]["text"]
+    for message in messages[1:]:
+        assert message["text"]
+        assert message["source"] == "template"
+        assert message["mood"] in ("good", "neutral", "bad")
+
+
+def test_connection_ends_at_eof(template_backend):
+    gateway = ChatGateway()
+    messages = talk(gateway, b"40 formal\nhow are you?")
+    assert [message["type"] for message in messages] == ["greeting", "reply"]
+    assert gateway.active_sessions == 0
+    assert gateway.total_turns == 1
+
+
+@pytest.mark.parametrize("first_line, error", [
+    (b"\n", "Expected '<age> <style> [<session id>]'"),
+    (b"twenty friendly\n", "Expected '<age> <style> [<session id>]'"),
+    (b"22\n", "Expected '<age> <style> [<session id>]'"),
+    (b"12 friendly\n", "valid age"),
+    (b"22 grumpy\n", "Style must be one of"),
+])
+def test_bad_first_line(first_line, error):
+    messages = talk(ChatGateway(), first_line + b"hello\n")
+    assert len(messages) == 1
+    assert messages[0]["type"] == "error"
+    assert error in messages[0]["text"]
+
+
+def test_too_long_message(template_backend):
+    messages = talk(ChatGateway(), b"22 friendly\n" + b"a" * (MAX_LINE_LENGTH + 1) + b"\nhello\n")
+    assert [message["type"] for message in messages] == ["greeting", "error"]
+    assert messages[1]["text"] == "Message is too long"
+
+
+def test_session_id_resumes_the_session(sessions, template_backend):
+    gateway = ChatGateway(sessions=sessions)
+    first = talk(gateway, b"22 friendly s1\nI study history at the university\n")
+    second = talk(gateway, b"22 friendly s1\nhello again\n")
+    assert [message["type"] for message in second] == ["greeting", "reply"]
+    # A resumed session is greeted again, and remembers what it was told
+    assert second[0]["text"] == templates.GREETINGS["friendly"]
+    assert first[0]["source"] == second[0]["source"] == "template"
+    companion, resumed = sessions.open("s1", 22, "friendly")
+    assert resumed
+    assert any("university" in fact[0] for fact in companion.memory.facts.facts)
+    sessions.release("s1")
+
+
+def test_session_id_is_ignored_without_a_store(template_backend):
+    messages = talk(ChatGateway(), b"22 friendly s1\nhi\n")
+    assert [message["type"] for message in messages] == ["greeting", "reply"]
@@ -0,0 +1,174 @@
+import asyncio
+import threading
+import time
+from email.utils import formatdate
+
+import pytest
+
+from fake_openai import REPLIES, FakeOpenAIServer
+from gpt_client import AsyncGPTClient, GPTClient, parse_retry_after
+
+PAYLOAD = {"model": "gpt-3.5-turbo", "messages": [{"role": "user", "content": "hi"}]}
+KINDS = ["chat", "stream"]
+
+
+@pytest.fixture
+def fake():
+    """A fake API server on an event loop of its own thread, at fake.base_url"""
+    fake = FakeOpenAIServer(latency=0, token_interval=0)
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(asyncio.start_server(fake.handle_connection, "127.0.0.1", 0))
+    fake.base_url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}/v1"
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield fake
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+
+    async def shut_down():
+        server.close()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    loop.run_until_complete(shut_down())
+    loop.close()
+
+
+def ask(fake, kind, requests=1, **options):
+    """Sends requests with a fresh AsyncGPTClient and returns the replies and the time they took"""
+    async def run():
+        client = AsyncGPTClient(api_key="test", base_url=fake.base_url, timeout=5, backoff_base=0.01,
+                                backoff_cap=0.01, **options)
+        replies = []
+        try:
+            for _ in range(requests):
+                if kind == "chat":
+                    replies.append(await client.chat(PAYLOAD))
+                else:
+                    replies.append("".join([chunk async for chunk in client.chat_stream(PAYLOAD)]))
+        finally:
+            await client.close()
+        return replies
+
+    started = time.monotonic()
+    replies = asyncio.run(run())
+    return replies, time.monotonic() - started
+
+
+def ask_sync(fake, kind, **options):
+    client = GPTClient(api_key="test", base_url=fake.base_url, backoff_base=0.01, backoff_cap=0.01, **options)
+    started = time.monotonic()
+    try:
+        if kind == "chat":
+            reply = client.chat(PAYLOAD)
+        else:
+            reply = "".join(client.chat_stream(PAYLOAD))
+        return reply, time.monotonic() - started
+    finally:
+        client.close()
+
+
+@pytest.mark.parametrize("chunked", [False, True])
+@pytest.mark.parametrize("kind", KINDS)
+def test_replies_are_read_whole(fake, kind, chunked):
+    fake.chunked = chunked
+    replies, _ = ask(fake, kind, requests=3)
+    assert all(reply in REPLIES for reply in replies)
+
+
+@pytest.mark.parametrize("kind", KINDS)
+def test_connection_is_reused(fake, kind):
+    ask(fake, kind, requests=5)
+    assert fake.connection_count == 1
+
+
+@pytest.mark.parametrize("kind", KINDS)
+def test_connection_is_reused_after_an_error(fake, kind):
+    fake.failures.extend([500, 404])
+    with pytest.raises(Exception):
+        # The 404 is not retried
+        ask(fake, kind)
+    replies, _ = ask(fake, kind, requests=2)
+    assert replies[0] in REPLIES
+    assert fake.error_count == 2
+    # One connection per client, each kept after its error
+    assert fake.connection_count == 2
+
+
+@pytest.mark.parametrize("kind", KINDS)
+def test_new_connection_when_the_server_closes_after_an_error(fake, kind):
+    fake.close_after_error = True
+    fake.failures.append(502)
+    replies, _ = ask(fake, kind, requests=2)
+    assert all(reply in REPLIES for reply in replies)
+    assert fake.connection_count == 2
+
+
+@pytest.mark.parametrize("status", [429, 503])
+@pytest.mark.parametrize("kind", KINDS)
+def test_retry_waits_for_retry_after(fake, kind, status):
+    fake.retry_after = 0.3
+    fake.failures.append(status)
+    replies, elapsed = ask(fake, kind)
+    assert replies[0] in REPLIES
+    assert elapsed >= 0.3
+
+
+@pytest.mark.parametrize("kind", KINDS)
+def test_retry_after_is_only_read_for_429_and_503(fake, kind):
+    fake.retry_after = 5
+    fake.failures.append(500)
+    replies, elapsed = ask(fake, kind)
+    assert replies[0] in REPLIES
+    assert elapsed < 1
+
+
+@pytest.mark.parametrize("kind", KINDS)
+def test_too_long_retry_after_fails_at_once(fake, kind):
+    fake.retry_after = 30
+    fake.failures.append(429)
+    started = time.monotonic()
+    with pytest.raises(Exception, match="HTTP 429"):
+        ask(fake, kind, max_retry_after=1)
+    assert time.monotonic() - started < 1
+    assert fake.error_count == 1
+
+
+@pytest.mark.parametrize("kind", KINDS)
+def test_retries_are_bounded(fake, kind):
+    fake.failures.extend([503] * 5)
+    with pytest.raises(Exception, match="HTTP 503"):
+        ask(fake, kind, max_retries=2)
+    assert fake.error_count == 3
+
+
+@pytest.mark.parametrize("kind", KINDS)
+def test_sync_client_waits_for_retry_after(fake, kind):
+    fake.retry_after = 0.3
+    fake.failures.append(429)
+    reply, elapsed = ask_sync(fake, kind)
+    assert reply in REPLIES
+    assert elapsed >= 0.3
+
+    fake.retry_after = 30
+    fake.failures.append(503)
+    with pytest.raises(Exception, match="HTTP 503"):
+        ask_sync(fake, kind, max_retry_after=1)
+
+
+def test_sync_client_reads_chunked_replies(fake):
+    fake.chunked = True
+    reply, _ = ask_sync(fake, "chat")
+    assert reply in REPLIES
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("2") == 2.0
+    assert parse_retry_after("0.5") == 0.5
+    assert parse_retry_after("-3") == 0.0
+    assert 8 < parse_retry_after(formatdate(time.time() + 10, usegmt=True)) <= 10
+    assert parse_retry_after(formatdate(time.time() - 10, usegmt=True)) == 0.0
+    assert parse_retry_after("soon") is None
+    assert parse_retry_after(None) is None
@@ -0,0 +1,154 @@
+import math
+import random
+
+import pytest
+
+import initiative_scheduler
+from initiative_scheduler import WHEEL_BITS, WHEEL_LEVELS, InitiativeScheduler, TimerWheel
+from simulation import VirtualClock
+from virtual_companion import VirtualCompanion
+
+SLOTS = 1 << WHEEL_BITS
+
+
+def fire_times(wheel, keys, until, start=0):
+    """Advances the wheel one tick at a time and returns the tick each key fired at"""
+    fired = {}
+    for now in range(start + 1, until + 1):
+        for key, value in wheel.advance(now):
+            assert key not in fired
+            assert value == ("value", key)
+            fired[key] = now
+    assert set(fired) <= set(keys)
+    return fired
+
+
+@pytest.mark.parametrize("start", [0, 1, SLOTS - 1, SLOTS ** 2 - 3])
+def test_timers_fire_at_their_deadline_across_level_boundaries(start):
+    wheel = TimerWheel(now=start)
+    delays = [1, 2, SLOTS - 1, SLOTS, SLOTS + 1, SLOTS ** 2 - 1, SLOTS ** 2, SLOTS ** 2 + 1,
+              5 * SLOTS ** 2 + 7, SLOTS ** 3 - 1, SLOTS ** 3, SLOTS ** 3 + 1]
+    for delay in delays:
+        wheel.schedule(delay, start + delay, ("value", delay))
+    assert len(wheel) == len(delays)
+
+    fired = fire_times(wheel, delays, start + SLOTS ** 3 + 1, start)
+    assert fired == {delay: start + delay for delay in delays}
+    assert len(wheel) == 0
+
+
+def test_fractional_deadlines_round_up_to_the_next_tick():
+    wheel = TimerWheel(tick=0.5, now=10.0)
+    wheel.schedule("a", 10.2, "a")
+    wheel.schedule("b", 11.0, "b")
+    # A deadline in the past fires on the next tick
+    wheel.schedule("c", 3.0, "c")
+    assert wheel.advance(10.4) == []
+    assert sorted(wheel.advance(10.5)) == [("a", "a"), ("c", "c")]
+    assert wheel.advance(10.9) == []
+    assert wheel.advance(11.0) == [("b", "b")]
+
+
+def test_one_advance_over_many_ticks_returns_timers_in_deadline_order():
+    wheel = TimerWheel(now=0)
+    delays = list(range(1, 3 * SLOTS ** 2, 37))
+    random.Random(3).shuffle(delays)
+    for delay in delays:
+        wheel.schedule(delay, delay, delay)
+    assert [key for key, _ in wheel.advance(3 * SLOTS ** 2)] == sorted(delays)
+
+
+def test_cancel_after_cascade():
+    wheel = TimerWheel(now=0)
+    # Both start on level 1 and move to level 0 when the wheel reaches their slot
+    wheel.schedule("kept", SLOTS + 5, ("value", "kept"))
+    wheel.schedule("cancelled", SLOTS + 6, ("value", "cancelled"))
+    assert wheel.advance(SLOTS) == []
+    assert "cancelled" in wheel
+    assert wheel.cancel("cancelled")
+    assert not wheel.cancel("cancelled")
+    assert "cancelled" not in wheel
+    assert fire_times(wheel, ["kept"], 2 * SLOTS, SLOTS) == {"kept": SLOTS + 5}
+
+
+def test_reschedule_replaces_the_timer():
+    wheel = TimerWheel(now=0)
+    wheel.schedule("a", SLOTS ** 2 + 3, ("value", "a"))
+    wheel.advance(SLOTS ** 2)
+    wheel.schedule("a", SLOTS ** 2 + 2 * SLOTS, ("value", "a"))
+    assert len(wheel) == 1
+    assert fire_times(wheel, ["a"], SLOTS ** 2 + 3 * SLOTS, SLOTS ** 2) == {"a": SLOTS ** 2 + 2 * SLOTS}
+
+
+@pytest.fixture
+def small_wheel(monkeypatch):
+    """Wheels of 3 levels of 4 slots, which span 64 ticks, so long delays are quick to reach"""
+    monkeypatch.setattr(initiative_scheduler, "WHEEL_BITS", 2)
+    monkeypatch.setattr(initiative_scheduler, "WHEEL_LEVELS", 3)
+    return 4 ** 3
+
+
+def test_timers_beyond_the_wheel_wait_and_fire(small_wheel):
+    start = 13
+    wheel = TimerWheel(now=start)
+    delays = [small_wheel - 1, small_wheel, small_wheel + 1, 2 * small_wheel + 9, 10 * small_wheel + 3]
+    for delay in delays:
+        wheel.schedule(delay, start + delay, ("value", delay))
+    fired = fire_times(wheel, delays, start + 11 * small_wheel, start)
+    assert fired == {delay: start + delay for delay in delays}
+
+
+def test_random_operations_match_a_reference(small_wheel):
+    rng = random.Random(11)
+    now = rng.randrange(1000)
+    wheel = TimerWheel(now=now)
+    due = {}  # What the wheel should hold: key -> tick it fires at
+    for _ in range(20000):
+        action = rng.random()
+        if action < 0.45:
+            key = rng.randrange(200)
+            deadline = now + rng.choice([rng.uniform(-2, 5), rng.uniform(0, 70), rng.uniform(0, 5 * small_wheel)])
+            wheel.schedule(key, deadline, ("value", key))
+            due[key] = max(math.ceil(deadline), now + 1)
+        elif action < 0.6:
+            key = rng.randrange(200)
+            assert wheel.cancel(key) == (due.pop(key, None) is not None)
+        else:
+            now += rng.choice([1, 1, 1, 2, rng.randrange(1, 3 * small_wheel)])
+            fired = wheel.advance(now)
+            expected = sorted(key for key, tick in due.items() if tick <= now)
+            assert sorted(key for key, _ in fired) == expected
+            for key in expected:
+                del due[key]
+        assert len(wheel) == len(due)
+
+
+def test_scheduler_sends_an_initiative_to_a_silent_user(rng):
+    clock = VirtualClock(1000.0)
+    companion = VirtualCompanion(22, "friendly", clock=clock, rng=rng)
+    companion.greeting()
+    scheduler = InitiativeScheduler(now=clock.time())
+    sent = []
+    scheduler.schedule("user", companion, sent.append)
+    deadline = companion.initiative_deadline()
+
+    assert scheduler.run_due(deadline - 1) == 0
+    clock.advance_to(deadline)
+    assert scheduler.run_due(deadline) == 1
+    assert sent and sent[0].initiative
+    # The companion waits for the user before speaking up again
+    assert companion.initiative_deadline() is None
+    scheduler.schedule("user", companion, sent.append)
+    assert len(scheduler.wheel) == 0
+
+
+def test_cancelled_session_gets_no_initiative(rng):
+    clock = VirtualClock(1000.0)
+    companion = VirtualCompanion(22, "friendly", clock=clock, rng=rng)
+    scheduler = InitiativeScheduler(now=clock.time())
+    sent = []
+    scheduler.schedule("user", companion, sent.append)
+    scheduler.cancel("user")
+    assert scheduler.run_due(clock.time() + 10 * companion.initiative.interval_between_initiatives) == 0
+    assert sent == []
+    assert scheduler.get_stats()["cancelled"] == 1
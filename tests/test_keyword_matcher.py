@@ -0,0 +1,111 @@
+import random
+import threading
+
+import pytest
+
+import templates
+from keyword_matcher import KeywordMatcher
+from topic_classifier import get_topic_classifier
+from virtual_companion import get_keyword_matcher
+
+NOISE = (
+    "yesterday we walked along the river, talked about everything and watched "
+    "the rain; musical start-up smartphone brotherhood schoolwork likewise okay?!"
+).split()
+
+
+def all_groups(matcher):
+    return {keyword for group in matcher.lowered_groups.values() for keyword in group}
+
+
+def random_text(keywords, rng, words=40):
+    """Mixes keywords, phrases and noise words with odd case and punctuation"""
+    parts = []
+    for _ in range(rng.randint(0, words)):
+        word = rng.choice(keywords) if rng.random() < 0.3 else rng.choice(NOISE)
+        if rng.random() < 0.2:
+            word = word.upper() if rng.random() < 0.5 else word.title()
+        if rng.random() < 0.2:
+            word = rng.choice("\"'(") + word + rng.choice(".,!?)\"'")
+        if rng.random() < 0.1 and parts:
+            # Glue onto the previous word, so keywords sit inside other words
+            parts[-1] += word
+        else:
+            parts.append(word)
+    return rng.choice([" ", "  ", "\n", "\t"]).join(parts)
+
+
+def assert_like_substring_checks(matcher, text):
+    lowered = text.lower()
+    matches = matcher.scan(text)
+    for name, group in matcher.groups.items():
+        expected = [keyword for keyword in group if keyword.lower() in lowered]
+        assert matches.found(name) == expected, (name, text)
+        assert matches.any(name) == bool(expected)
+    for keyword in all_groups(matcher) | set(NOISE):
+        if keyword in matcher._memberships:
+            assert (keyword in matches) == (keyword in lowered), (keyword, text)
+            assert matches.find(keyword) == lowered.find(keyword)
+
+
+@pytest.mark.parametrize("bracket", sorted(templates.TOPIC_TABLES))
+def test_companion_keywords_match_like_substring_checks(bracket):
+    matcher = get_keyword_matcher(get_topic_classifier(templates.TOPIC_TABLES[bracket]).terms)
+    keywords = sorted(all_groups(matcher))
+    rng = random.Random(bracket)
+    for _ in range(500):
+        assert_like_substring_checks(matcher, random_text(keywords, rng))
+
+
+def test_overlapping_keywords_and_phrases():
+    matcher = KeywordMatcher({
+        "a": ["art", "start", "star", "tar"],
+        "b": ["see you", "see you later", "you"],
+        "c": ["Like", "like to"],
+    })
+    rng = random.Random(3)
+    keywords = sorted(all_groups(matcher)) + ["started", "seeyou", "see  you"]
+    for _ in range(500):
+        assert_like_substring_checks(matcher, random_text(keywords, rng, words=12))
+
+    matches = matcher.scan("Restarted, SEE YOU LATER!")
+    assert matches.found("a") == ["art", "start", "star", "tar"]
+    assert matches.found("b") == ["see you", "see you later", "you"]
+    assert matches.found("c") == []
+
+
+def test_vocabulary_is_reset_when_full():
+    matcher = KeywordMatcher({"topics": ["music", "games"]}, vocabulary_size=5)
+    rng = random.Random(5)
+    keywords = ["music", "games", "musical"]
+    largest_text = 5
+    for _ in range(300):
+        text = random_text(keywords, rng, words=8)
+        assert_like_substring_checks(matcher, text)
+        # A text with more distinct words than fit is learned whole
+        largest_text = max(largest_text, len(set(text.lower().split())))
+        assert len(matcher._known_words) <= largest_text
+
+
+def test_threads_share_a_matcher():
+    # A tiny vocabulary makes every thread reset and relearn it all the time
+    matcher = KeywordMatcher(
+        {"topics": ["music", "games", "travel"], "goodbye": ["bye", "see you later"]}, vocabulary_size=20
+    )
+    keywords = sorted(all_groups(matcher))
+    errors = []
+
+    def scan_many(seed):
+        rng = random.Random(seed)
+        try:
+            for _ in range(300):
+                assert_like_substring_checks(matcher, random_text(keywords, rng, words=15))
+        except Exception as error:  # Reported by the main thread
+            errors.append(error)
+
+    threads = [threading.Thread(target=scan_many, args=(seed,)) for seed in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
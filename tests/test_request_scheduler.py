@@ -0,0 +1,146 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from request_scheduler import INTERACTIVE, PREFETCH, RequestScheduler, TokenBucket
+
+
+def test_token_bucket_refills_at_its_rate_up_to_its_capacity():
+    bucket = TokenBucket(60)
+    bucket.updated = 0.0
+    assert bucket.wait_time(1, 0.0) == 0
+    bucket.take(60)
+    assert bucket.wait_time(1, 0.0) == pytest.approx(1.0)
+    assert bucket.wait_time(1, 0.5) == pytest.approx(0.5)
+    assert bucket.wait_time(1, 1.0) == 0
+    # An idle bucket holds no more than a minute's worth
+    bucket.wait_time(1, 1000.0)
+    assert bucket.tokens == 60
+
+
+def test_token_bucket_request_larger_than_capacity_goes_into_debt():
+    bucket = TokenBucket(60)
+    bucket.updated = 0.0
+    # It only waits for a full bucket
+    assert bucket.wait_time(100, 0.0) == 0
+    bucket.take(100)
+    assert bucket.wait_time(1, 0.0) == pytest.approx(41.0)
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def queued(scheduler):
+    return sum(scheduler.queued)
+
+
+def test_queued_calls_start_in_priority_order():
+    scheduler = RequestScheduler(max_concurrency=1)
+    scheduler.acquire()
+    order = []
+
+    def call(name, priority):
+        scheduler.acquire(priority)
+        order.append(name)
+        scheduler.release()
+
+    threads = []
+    for name, priority in (("prefetch 1", PREFETCH), ("interactive 1", INTERACTIVE),
+                           ("prefetch 2", PREFETCH), ("interactive 2", INTERACTIVE)):
+        thread = threading.Thread(target=call, args=(name, priority))
+        thread.start()
+        threads.append(thread)
+        wait_until(lambda: queued(scheduler) == len(threads))
+    scheduler.release()
+    for thread in threads:
+        thread.join()
+    # Most urgent first, in arrival order within a priority
+    assert order == ["interactive 1", "interactive 2", "prefetch 1", "prefetch 2"]
+    stats = scheduler.get_stats()
+    assert (stats["active"], stats["interactive"]["granted"], stats["prefetch"]["granted"]) == (0, 3, 2)
+
+
+def test_call_is_dropped_at_its_deadline():
+    scheduler = RequestScheduler(max_concurrency=1)
+    scheduler.acquire()
+    started = time.monotonic()
+    with pytest.raises(Exception, match="dropped"):
+        scheduler.acquire(PREFETCH, timeout=0.05)
+    assert time.monotonic() - started >= 0.05
+    stats = scheduler.get_stats()
+    assert stats["prefetch"]["dropped"] == 1
+    assert stats["prefetch"]["queued"] == 0
+    # The slot holder is unaffected, and the next call starts once it is done
+    scheduler.release()
+    assert scheduler.call(lambda: "sent") == "sent"
+    assert scheduler.active == 0
+
+
+def test_rate_limit_delays_calls():
+    scheduler = RequestScheduler(requests_per_minute=1200, tokens_per_minute=600)
+    scheduler.request_bucket.tokens = 0
+    started = time.monotonic()
+    scheduler.acquire()
+    # 20 requests a second, so the next one waits for a twentieth of a second
+    assert time.monotonic() - started >= 0.04
+    scheduler.release()
+
+    scheduler.token_bucket.tokens = 0
+    started = time.monotonic()
+    scheduler.acquire(tokens=5)
+    assert time.monotonic() - started >= 0.4
+    scheduler.release()
+
+
+def test_failed_call_returns_its_slot():
+    scheduler = RequestScheduler(max_concurrency=1)
+
+    def fail():
+        raise ConnectionError("boom")
+
+    with pytest.raises(ConnectionError):
+        scheduler.call(fail)
+    assert scheduler.active == 0
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def run():
+        scheduler = RequestScheduler(max_concurrency=1)
+        scheduler.acquire()
+        task = asyncio.ensure_future(scheduler.acquire_async())
+        await asyncio.sleep(0.01)
+        assert queued(scheduler) == 1
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert queued(scheduler) == 0
+        scheduler.release()
+        assert scheduler.active == 0
+        assert scheduler.get_stats()["interactive"]["granted"] == 1
+
+    asyncio.run(run())
+
+
+def test_waiter_cancelled_after_it_was_granted_returns_the_slot():
+    async def run():
+        scheduler = RequestScheduler(max_concurrency=1)
+        scheduler.acquire()
+        task = asyncio.ensure_future(scheduler.acquire_async())
+        await asyncio.sleep(0.01)
+        # The slot passes to the waiting task, which is cancelled before it runs again
+        scheduler.release()
+        assert scheduler.active == 1
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert scheduler.active == 0
+        await scheduler.acquire_async(timeout=0.5)
+        scheduler.release()
+
+    asyncio.run(run())
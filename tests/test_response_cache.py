@@ -0,0 +1,118 @@
+import types
+
+import pytest
+
+import backends
+import response_cache
+from response_cache import ResponseCache
+from virtual_companion import VirtualCompanion
+
+
+def request(content, **params):
+    return dict({"model": "gpt-3.5-turbo", "max_tokens": 150, "messages": [
+        {"role": "system", "content": "Be nice."},
+        {"role": "user", "content": content},
+    ]}, **params)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replaces the cache's clock with one that only moves when told"""
+    clock = types.SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(response_cache, "time", types.SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+def test_key_ignores_whitespace_streaming_and_parameter_order():
+    key = ResponseCache.make_key(request("how are you?"))
+    assert ResponseCache.make_key(request("  how   are\nyou? ")) == key
+    assert ResponseCache.make_key(request("how are you?", stream=True)) == key
+    reordered = {"messages": request("how are you?")["messages"], "max_tokens": 150, "model": "gpt-3.5-turbo"}
+    assert ResponseCache.make_key(reordered) == key
+
+    assert ResponseCache.make_key(request("how are you")) != key
+    assert ResponseCache.make_key(request("how are you?", model="gpt-4")) != key
+    assert ResponseCache.make_key(request("how are you?", temperature=0.2)) != key
+
+
+def test_least_recently_used_entries_are_evicted(clock):
+    cache = ResponseCache(max_entries=2)
+    cache.put("a", "reply a")
+    cache.put("b", "reply b")
+    assert cache.get("a") == "reply a"
+    cache.put("c", "reply c")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "reply a"
+    assert cache.get("c") == "reply c"
+    assert cache.get_stats() == {
+        "hits": 3, "misses": 1, "evictions": 1, "expirations": 0, "size": 2, "hit_rate": 0.75
+    }
+
+
+def test_entries_expire(clock):
+    cache = ResponseCache(ttl=60)
+    cache.put("a", "reply a")
+    cache.put("b", "reply b", ttl=600)
+    clock.now += 59
+    assert cache.get("a") == "reply a"
+    clock.now += 1
+    assert cache.get("a") is None
+    assert cache.get("b") == "reply b"
+    stats = cache.get_stats()
+    assert (stats["expirations"], stats["size"]) == (1, 1)
+
+
+def test_entries_survive_a_restart(tmp_path, clock):
+    path = str(tmp_path / "cache.db")
+    cache = ResponseCache(max_entries=2, ttl=60, path=path)
+    cache.put("old", "old reply", ttl=10)
+    cache.put("a", "reply a")
+    cache.put("b", "reply b")
+    cache.close()
+
+    cache = ResponseCache(max_entries=2, ttl=60, path=path)
+    assert cache.get("a") == "reply a"
+    assert cache.get("b") == "reply b"
+    # Evicted entries are gone from the file as well
+    assert cache.get("old") is None
+    cache.close()
+
+    # Entries that expired while the process was down are not loaded
+    clock.now += 60
+    cache = ResponseCache(max_entries=2, ttl=60, path=path)
+    assert cache.get_stats()["size"] == 0
+    cache.clear()
+    cache.close()
+
+
+def test_cache_is_configured_from_the_environment(monkeypatch):
+    monkeypatch.setattr(response_cache, "_cache", None)
+    assert response_cache.get_response_cache() is None
+
+    monkeypatch.setenv("RESPONSE_CACHE", "1")
+    monkeypatch.setenv("RESPONSE_CACHE_SIZE", "5")
+    cache = response_cache.get_response_cache()
+    assert cache is response_cache.get_response_cache()
+    assert cache.max_entries == 5
+    # Playful sessions get varied replies by default
+    assert [cache.enabled_for(style) for style in ("formal", "friendly", "romantic", "playful")] == \
+        [True, True, True, False]
+
+
+def test_companion_caches_model_replies_only(monkeypatch):
+    cache = ResponseCache(styles=["friendly"])
+    monkeypatch.setattr(response_cache, "_cache", cache)
+    companion = VirtualCompanion(22, "friendly")
+    backend = backends.OpenAIBackend()
+    data = request("hi")
+
+    key, response = companion._cached_response(data, backend)
+    assert (key, response) == (ResponseCache.make_key(data), None)
+    companion._cache_response(key, backends.TemplateReply("a template reply"))
+    assert companion._cached_response(data, backend) == (key, None)
+    companion._cache_response(key, "a model reply")
+    assert companion._cached_response(data, backend) == (key, "a model reply")
+
+    assert companion._cached_response(data, backends.TemplateBackend()) == (None, None)
+    assert VirtualCompanion(22, "playful")._cached_response(data, backend) == (None, None)
@@ -0,0 +1,190 @@
+import marshal
+import sqlite3
+
+import pytest
+
+from session_store import MARSHAL_FORMAT, PICKLE_FORMAT, SessionManager, SessionStore, apply_delta, encode_delta, loads
+from virtual_companion import VirtualCompanion
+
+MESSAGES = [
+    "I enjoy painting landscapes on the weekend, it calms me down a lot.",
+    "my work is mostly meetings with clients lately",
+    "ok",
+    "I study history at the university and I like it",
+    "thanks, that was cool",
+    "my family is going to the mountains this summer, my brother too",
+    "music is terrible today",
+    "how are you?",
+]
+
+
+def talk(manager, session_id, turns, rng, history_token_budget=None):
+    """Opens a session and sends it turns messages, writing every turn to the store"""
+    companion, resumed = manager.open(session_id, 22, "friendly")
+    companion.rng = rng
+    if history_token_budget is not None:
+        companion.history_token_budget = history_token_budget
+    if not resumed:
+        companion.greeting()
+        manager.record_turn(session_id)
+    for _ in range(turns):
+        companion.respond(rng.choice(MESSAGES))
+        manager.record_turn(session_id)
+    manager.release(session_id)
+    return companion
+
+
+@pytest.fixture
+def manager(tmp_path):
+    manager = SessionManager(SessionStore(str(tmp_path / "sessions.db")), idle_timeout=60, snapshot_interval=5)
+    yield manager
+    manager.store.close()
+
+
+def test_snapshot_and_journal_restore_the_state(manager, template_backend, rng):
+    companion = talk(manager, "s1", 10, rng)
+
+    loaded, seq, journal_length = manager.store.load("s1")
+    # Snapshots at turns 1 and 7, the turns after them are in the journal
+    assert (seq, journal_length) == (11, 4)
+    assert loaded.get_state() == companion.get_state()
+    assert loaded.memory.facts.facts == companion.memory.facts.facts
+
+
+def test_folded_history_is_restored(manager, template_backend, rng):
+    companion = talk(manager, "s1", 30, rng, history_token_budget=80)
+
+    # Messages were folded into the summary while deltas were written
+    assert companion.history_offset > 0
+    assert companion.memory.summary is not None
+    loaded, _, _ = manager.store.load("s1")
+    assert loaded.get_state() == companion.get_state()
+    assert loaded.memory.summary.text() == companion.memory.summary.text()
+
+
+def test_eviction_and_rehydration_keep_the_state(manager, template_backend, rng):
+    companion = talk(manager, "s1", 8, rng)
+    before = companion.get_state()
+
+    assert manager.evict_idle(now=float("inf")) == 1
+    assert manager.get_stats()["live"] == 0
+    # Evicting folded the journal into the snapshot
+    assert manager.store.get_stats() == {"sessions": 1, "journal_entries": 0}
+
+    rehydrated, resumed = manager.open("s1", 22, "friendly")
+    assert resumed
+    assert rehydrated is not companion
+    assert rehydrated.get_state() == before
+    assert manager.get_stats()["rehydrated"] == 1
+
+    # The rehydrated session goes on where it stopped
+    manager.release("s1")
+    talk(manager, "s1", 3, rng)
+    loaded, _, _ = manager.store.load("s1")
+    assert loaded.get_state() == rehydrated.get_state()
+
+
+def test_sessions_in_use_are_not_evicted(manager, template_backend, rng):
+    talk(manager, "s1", 2, rng)
+    manager.open("s1", 22, "friendly")
+    assert manager.evict_idle(now=float("inf")) == 0
+
+
+def test_load_all_matches_load(manager, template_backend, rng):
+    companions = {session_id: talk(manager, session_id, turns, rng)
+                  for session_id, turns in (("a", 3), ("b", 7), ("c", 11))}
+
+    loaded = dict(manager.store.load_all())
+    assert sorted(loaded) == ["a", "b", "c"]
+    for session_id, companion in companions.items():
+        assert loaded[session_id].get_state() == companion.get_state()
+
+
+def version_1(state):
+    """Returns a get_state() tuple as state version 1 wrote it, without facts"""
+    return (1,) + tuple(state[1:-1])
+
+
+def test_version_1_state_is_restored_without_facts(template_backend, rng):
+    companion = VirtualCompanion(22, "friendly", rng=rng)
+    companion.greeting()
+    for message in MESSAGES:
+        companion.respond(message)
+
+    restored = VirtualCompanion.from_state(version_1(companion.get_state()))
+    assert restored.memory.facts is None
+    assert restored.get_state()[:-1] == (2,) + version_1(companion.get_state())[1:]
+
+
+def test_version_1_snapshot_and_journal_load(manager, template_backend, rng):
+    companion = VirtualCompanion(22, "friendly", rng=rng)
+    companion.greeting()
+    companion.respond(MESSAGES[0])
+    store = manager.store
+    # A snapshot and a delta as they were written before facts were stored
+    store._db.execute(
+        "INSERT INTO snapshots (session_id, seq, state) VALUES (?, ?, ?)",
+        ("old", 1, marshal.dumps(version_1(companion.get_state())))
+    )
+    offset, length = companion.history_offset, len(companion.conversation_history)
+    companion.respond(MESSAGES[1])
+    delta = loads(encode_delta(companion, offset, length))
+    store._db.execute(
+        "INSERT INTO journal (session_id, seq, delta) VALUES (?, ?, ?)", ("old", 2, marshal.dumps(delta[:9]))
+    )
+
+    loaded, seq, journal_length = store.load("old")
+    assert (seq, journal_length) == (2, 1)
+    assert loaded.get_state()[:-1] == companion.get_state()[:-1]
+
+    # The session is saved in the current version from then on
+    manager.open("old", 22, "friendly")
+    manager.record_turn("old")
+    manager.release("old")
+    assert manager.evict_idle(now=float("inf")) == 1
+    assert loads(*store._db.execute("SELECT state, format FROM snapshots").fetchone())[0] == 2
+
+
+def test_delta_round_trip(template_backend, rng):
+    companion = VirtualCompanion(22, "friendly", rng=rng)
+    companion.greeting()
+    copy = VirtualCompanion.from_state(companion.get_state())
+    for message in MESSAGES * 3:
+        offset, length = companion.history_offset, len(companion.conversation_history)
+        facts = companion.memory.facts.appended if companion.memory.facts is not None else 0
+        companion.respond(message)
+        apply_delta(copy, encode_delta(companion, offset, length, facts))
+        assert copy.get_state() == companion.get_state()
+
+
+def test_store_from_before_the_format_column(tmp_path, template_backend, rng):
+    companion = VirtualCompanion(22, "friendly", rng=rng)
+    companion.greeting()
+    for message in MESSAGES:
+        companion.respond(message)
+    path = str(tmp_path / "old.db")
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE snapshots (session_id TEXT PRIMARY KEY, seq INTEGER, state BLOB)")
+    db.execute(
+        "CREATE TABLE journal (session_id TEXT, seq INTEGER, delta BLOB, PRIMARY KEY (session_id, seq)) WITHOUT ROWID"
+    )
+    db.execute("INSERT INTO snapshots VALUES (?, ?, ?)", ("old", 1, marshal.dumps(companion.get_state())))
+    db.commit()
+    db.close()
+
+    store = SessionStore(path)
+    assert store._db.execute("SELECT format FROM snapshots").fetchone()[0] == MARSHAL_FORMAT
+    loaded, seq, journal_length = store.load("old")
+    assert (seq, journal_length) == (1, 0)
+    assert loaded.get_state() == companion.get_state()
+    store.save_snapshot("old", loaded, 2)
+    assert store._db.execute("SELECT format FROM snapshots").fetchone()[0] == PICKLE_FORMAT
+    assert store.load("old")[0].get_state() == companion.get_state()
+    store.close()
+
+
+def test_unknown_format_is_an_error(manager, template_backend, rng):
+    talk(manager, "a", 2, rng)
+    manager.store._db.execute("UPDATE snapshots SET format = 9")
+    with pytest.raises(Exception, match="Unknown session store format 9"):
+        manager.store.load("a")
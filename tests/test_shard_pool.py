@@ -0,0 +1,103 @@
+import pytest
+
+import shard_pool
+from shard_pool import HashRing, ShardPool
+
+KEYS = [f"session-{index}" for index in range(2000)]
+MESSAGES = ["I like music", "my work is mostly meetings lately", "how are you?", "ok"]
+
+
+def owners(ring):
+    return {key: ring.owner(key) for key in KEYS}
+
+
+def test_adding_a_worker_moves_only_the_keys_it_now_owns():
+    ring = HashRing(64)
+    for worker in range(3):
+        ring.add(worker)
+    before = owners(ring)
+    ring.add(3)
+    after = owners(ring)
+    moved = [key for key in KEYS if after[key] != before[key]]
+    assert {after[key] for key in moved} == {3}
+    # About a quarter of the keys, as the new worker is one of four
+    assert 0.15 < len(moved) / len(KEYS) < 0.35
+    assert len(ring) == 4
+
+
+def test_removing_a_worker_moves_only_its_keys():
+    ring = HashRing(64)
+    for worker in range(4):
+        ring.add(worker)
+    before = owners(ring)
+    ring.remove(2)
+    after = owners(ring)
+    assert {key for key in KEYS if after[key] != before[key]} == {key for key in KEYS if before[key] == 2}
+    assert 2 not in after.values()
+    ring.add(2)
+    assert owners(ring) == before
+
+
+def test_empty_ring_has_no_owner():
+    ring = HashRing(8)
+    ring.add(0)
+    ring.remove(0)
+    assert len(ring) == 0
+    with pytest.raises(Exception, match="no workers"):
+        ring.owner("session-0")
+
+
+def session_states(pool):
+    """Returns the get_state() of every session, taking them out of their worker and putting them back"""
+    sessions = sorted(pool._sessions.items())
+    for session_id, worker in sessions:
+        pool._queue(worker, (shard_pool._TAKE, session_id))
+    states = pool.flush()
+    for (session_id, worker), state in zip(sessions, states):
+        pool._queue(worker, (shard_pool._PUT, session_id, state))
+    assert all(result is True for result in pool.flush())
+    return dict(zip((session_id for session_id, _ in sessions), states))
+
+
+@pytest.fixture
+def pool():
+    pool = ShardPool(2, vnodes=32)
+    yield pool
+    pool.close()
+
+
+def test_rebalancing_moves_sessions_with_their_state(pool):
+    session_ids = KEYS[:60]
+    for session_id in session_ids:
+        pool.open(session_id, 22, "friendly")
+    for index, session_id in enumerate(session_ids):
+        pool.send(session_id, MESSAGES[index % len(MESSAGES)])
+    assert not any(isinstance(result, Exception) for result in pool.flush())
+    states = session_states(pool)
+    placement = dict(pool._sessions)
+
+    worker = pool.add_worker()
+    moved = {session_id for session_id in session_ids if pool._sessions[session_id] != placement[session_id]}
+    assert moved == {session_id for session_id in session_ids if pool.ring.owner(session_id) == worker}
+    assert moved and len(moved) < len(session_ids)
+    assert {pool._sessions[session_id] for session_id in moved} == {worker}
+    assert pool.get_stats()["moved"] == len(moved)
+    assert session_states(pool) == states
+
+    pool.remove_worker(worker)
+    assert pool._sessions == placement
+    assert pool.get_stats()["moved"] == 2 * len(moved)
+    assert session_states(pool) == states
+    for session_id in session_ids:
+        pool.send(session_id, "thanks, that was cool")
+    assert not any(isinstance(result, Exception) for result in pool.flush())
+
+
+def test_worker_cannot_change_with_queued_commands(pool):
+    pool.open("session-0", 22, "friendly")
+    with pytest.raises(Exception, match="Flush"):
+        pool.add_worker()
+    pool.flush()
+    pool.remove_worker(pool.workers[0])
+    with pytest.raises(Exception, match="last shard worker"):
+        pool.remove_worker(pool.workers[0])
@@ -0,0 +1,204 @@
+import asyncio
+import time
+
+import pytest
+
+import backends
+import slo_controller
+from slo_controller import DEGRADE_SAMPLES, RECOVER_SAMPLES, DeadlineExceeded, SLOController
+from virtual_companion import VirtualCompanion
+
+
+def degrade(controller):
+    for _ in range(DEGRADE_SAMPLES):
+        controller.record(controller.budget * 2)
+    assert not controller.gpt_mode
+
+
+def next_probe(controller):
+    """Moves the last probe back, as if the probe interval had passed"""
+    controller.last_probe -= controller.probe_interval
+
+
+def test_switches_to_basic_mode_on_p95_latency():
+    controller = SLOController(budget=1.0, window=20, probe_interval=10)
+    for _ in range(DEGRADE_SAMPLES - 1):
+        controller.record(2.0)
+    # Not before the window has enough calls
+    assert controller.gpt_mode
+    controller.record(0.1)
+    assert not controller.gpt_mode
+    assert controller.events[-1]["reason"].startswith("p95 latency")
+
+
+def test_few_slow_calls_keep_gpt_mode():
+    controller = SLOController(budget=1.0, window=40, probe_interval=10)
+    for index in range(40):
+        controller.record(2.0 if index % 25 == 0 else 0.2)
+    assert controller.gpt_mode
+
+
+def test_switches_to_basic_mode_on_error_rate():
+    controller = SLOController(budget=1.0, window=20, probe_interval=10)
+    for index in range(DEGRADE_SAMPLES):
+        controller.record(0.1, failed=index < 3)
+    assert not controller.gpt_mode
+    assert controller.events[-1]["reason"].startswith("error rate")
+
+
+def test_error_rate_below_the_threshold_keeps_gpt_mode():
+    controller = SLOController(budget=1.0, window=20, probe_interval=10)
+    for index in range(20):
+        controller.record(0.1, failed=index % 5 == 4)
+    assert controller.gpt_mode
+
+
+def test_basic_mode_lets_one_probe_through_per_interval():
+    controller = SLOController(budget=1.0, probe_interval=10)
+    assert controller.allow_gpt()
+    degrade(controller)
+    # The switch itself counts as the last probe
+    assert not controller.allow_gpt()
+    next_probe(controller)
+    assert controller.allow_gpt()
+    assert not controller.allow_gpt()
+    next_probe(controller)
+    assert controller.allow_gpt()
+
+
+def test_returns_to_gpt_mode_after_five_fast_probes_in_a_row():
+    controller = SLOController(budget=1.0, probe_interval=10)
+    degrade(controller)
+    # A failed or slow probe starts the count again
+    for latency, failed in [(0.1, False)] * (RECOVER_SAMPLES - 1) + [(0.1, True)]:
+        controller.record(latency, failed)
+    assert not controller.gpt_mode
+    for _ in range(RECOVER_SAMPLES - 1):
+        controller.record(0.1)
+        assert not controller.gpt_mode
+    controller.record(0.9)  # Over half the budget
+    assert not controller.gpt_mode
+    for _ in range(RECOVER_SAMPLES - 1):
+        controller.record(0.1)
+        assert not controller.gpt_mode
+    controller.record(0.1)
+    assert controller.gpt_mode
+    assert [event["mode"] for event in controller.events] == ["basic", "gpt"]
+    assert controller.allow_gpt()
+
+
+def test_call_raises_at_the_deadline_and_hands_over_the_late_result():
+    controller = SLOController(budget=0.05)
+    late = []
+
+    def slow():
+        time.sleep(0.2)
+        return "late reply"
+
+    with pytest.raises(DeadlineExceeded):
+        controller.call(slow, 0.05, late.append)
+    assert late == []
+    deadline = time.monotonic() + 2
+    while not late and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert late == ["late reply"]
+    assert controller.call(lambda: "fast", 0.05) == "fast"
+
+
+class SlowFirstBackend(backends.TemplateBackend):
+    """Template replies, the first of them after a delay"""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.calls = 0
+
+    def generate(self, companion, data, priority=backends.INTERACTIVE):
+        self.calls += 1
+        if self.calls == 1:
+            time.sleep(self.delay)
+            return "late reply"
+        return f"reply {self.calls}"
+
+    async def generate_async(self, companion, data, priority=backends.INTERACTIVE, client=None):
+        self.calls += 1
+        if self.calls == 1:
+            await asyncio.sleep(self.delay)
+            return "late reply"
+        return f"reply {self.calls}"
+
+
+@pytest.fixture
+def slow_first_backend(monkeypatch):
+    monkeypatch.setattr(slo_controller, "_controller", SLOController(budget=0.05, probe_interval=10))
+    backend = SlowFirstBackend(0.2)
+    monkeypatch.setattr(backends, "_backend", backend)
+    return backend
+
+
+def history(companion):
+    return [(message["role"], message["content"]) for message in companion.conversation_history]
+
+
+def test_late_reply_goes_into_history_before_the_next_message(slow_first_backend, rng):
+    companion = VirtualCompanion(22, "friendly", rng=rng)
+    greeting = str(companion.greeting())
+    assert companion.respond("first message").source == "fallback"
+    time.sleep(0.4)
+    assert str(companion.respond("second message")) == "reply 2"
+    assert history(companion) == [
+        ("assistant", greeting), ("user", "first message"), ("assistant", "late reply"),
+        ("user", "second message"), ("assistant", "reply 2")
+    ]
+
+
+def test_late_reply_after_the_next_message_is_dropped(slow_first_backend, rng):
+    companion = VirtualCompanion(22, "friendly", rng=rng)
+    greeting = str(companion.greeting())
+    assert companion.respond("first message").source == "fallback"
+    assert str(companion.respond("second message")) == "reply 2"
+    time.sleep(0.4)
+    assert str(companion.respond("third message")) == "reply 3"
+    # The late reply answers the first message, so it cannot follow the second
+    assert history(companion) == [
+        ("assistant", greeting), ("user", "first message"), ("user", "second message"),
+        ("assistant", "reply 2"), ("user", "third message"), ("assistant", "reply 3")
+    ]
+
+
+def test_late_async_reply_goes_into_history_before_the_next_message(slow_first_backend, rng):
+    async def run():
+        companion = VirtualCompanion(22, "friendly", rng=rng)
+        greeting = str(companion.greeting())
+        assert (await companion.respond_async("first message")).source == "fallback"
+        await asyncio.sleep(0.4)
+        assert str(await companion.respond_async("second message")) == "reply 2"
+        assert history(companion) == [
+            ("assistant", greeting), ("user", "first message"), ("assistant", "late reply"),
+            ("user", "second message"), ("assistant", "reply 2")
+        ]
+
+    asyncio.run(run())
+
+
+def test_missed_deadline_is_not_reported_as_an_api_error(slow_first_backend, rng, caplog):
+    companion = VirtualCompanion(22, "friendly", rng=rng)
+    companion.greeting()
+    with caplog.at_level("INFO", logger="virtual_companion"):
+        assert companion.respond("first message").source == "fallback"
+    assert [record.levelname for record in caplog.records] == ["INFO"]
+    assert "deadline" in caplog.records[0].getMessage()
+    assert slo_controller.get_controller().get_stats()["outcomes"]["deadline"] == 1
+
+
+def test_turns_in_basic_mode_stay_in_the_history(slow_first_backend, rng):
+    slow_first_backend.calls = 1  # No slow call
+    controller = slo_controller.get_controller()
+    degrade(controller)
+    companion = VirtualCompanion(22, "friendly", rng=rng)
+    greeting = str(companion.greeting())
+    assert companion.respond("first message").source == "template"
+    controller.gpt_mode = True
+    assert str(companion.respond("second message")) == "reply 2"
+    assert history(companion) == [
+        ("assistant", greeting), ("user", "first message"), ("user", "second message"), ("assistant", "reply 2")
+    ]
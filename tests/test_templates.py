@@ -0,0 +1,85 @@
+import sys
+
+import pytest
+
+import templates
+from conversation_window import estimate_message_tokens
+from virtual_companion import VirtualCompanion
+
+STYLE_TABLES = [
+    "GREETINGS", "GOODBYES", "MOOD_REPLIES", "COMPLIMENT_REACTIONS", "RANDOM_RESPONSES",
+    "TOPIC_SUGGESTIONS", "INITIATIVE_INSTRUCTIONS",
+]
+
+
+@pytest.mark.parametrize("age, bracket", [
+    (12, "adult"), (13, "teen"), (16, "teen"), (17, "student"), (19, "student"),
+    (20, "young_adult"), (25, "young_adult"), (26, "adult"), (70, "adult"),
+])
+def test_age_brackets(age, bracket):
+    assert templates.get_age_bracket(age) == bracket
+
+
+def test_every_style_bracket_and_initiative_has_templates():
+    for name in STYLE_TABLES:
+        assert set(getattr(templates, name)) == set(templates.STYLES), name
+    for mood in ("good", "bad", "neutral"):
+        assert set(templates.EMOTIONAL_COLORS[mood]) == set(templates.STYLES)
+    assert set(templates.INITIATIVES) == set(templates.INITIATIVE_TYPES)
+    for initiative_type in templates.INITIATIVE_TYPES:
+        assert set(templates.INITIATIVES[initiative_type]) == set(templates.STYLES)
+    for table in (templates.TOPICS, templates.TOPIC_TABLES, templates.AGE_INSTRUCTIONS):
+        assert set(table) == set(templates.AGE_BRACKETS)
+    assert set(templates.SYSTEM_PROMPTS) == {
+        (bracket, style) for bracket in templates.AGE_BRACKETS for style in templates.STYLES
+    }
+
+
+def test_tables_are_read_only():
+    with pytest.raises(TypeError):
+        templates.GREETINGS["formal"] = "Yo"
+    with pytest.raises(TypeError):
+        templates.INITIATIVES["question"]["formal"] = "What?"
+    with pytest.raises(TypeError):
+        templates.TOPIC_TABLES["teen"] = templates.TOPIC_TABLES["adult"]
+    with pytest.raises(AttributeError):
+        templates.RANDOM_RESPONSES["formal"].append("Hm.")
+    with pytest.raises(AttributeError):
+        templates.TOPICS["teen"].append("cars")
+
+
+def test_topic_templates_are_filled_in():
+    for style in templates.STYLES:
+        template = templates.TOPIC_SUGGESTIONS[style]
+        # Precompiled into the text before and after the topic
+        assert isinstance(template, tuple) and len(template) == 2
+        filled = templates.fill(template, "travel")
+        assert filled == template[0] + "travel" + template[1]
+        assert "{topic}" not in filled and "travel" in filled
+        for initiative_type in templates.INITIATIVE_TYPES:
+            assert "travel" in templates.fill(templates.INITIATIVES[initiative_type][style], "travel")
+
+    assert templates.fill(templates.TOPIC_SUGGESTIONS["playful"], "art") == \
+        "Hey, let's talk about art! You surely have something to say!"
+    assert templates.fill(templates.IDLE_INITIATIVE_INSTRUCTION, "music").endswith("start talking about music.")
+    # Templates without a topic stay plain strings
+    assert isinstance(templates.GREETINGS["formal"], str)
+
+
+def test_system_prompts():
+    for (bracket, style), prompt in templates.SYSTEM_PROMPTS.items():
+        assert prompt.startswith(templates.AGE_INSTRUCTIONS[bracket])
+        assert prompt.endswith(" Answer briefly, 1-2 sentences maximum.")
+        assert templates.SYSTEM_PROMPT_TOKENS[bracket, style] == \
+            estimate_message_tokens({"role": "system", "content": prompt})
+
+
+def test_companions_share_interned_strings(template_backend):
+    first, second = VirtualCompanion(22, "romantic"), VirtualCompanion(23, "romantic")
+    assert first.topic_table is second.topic_table
+    first.greeting()
+    second.greeting()
+    assert first.conversation_history[0]["content"] is second.conversation_history[0]["content"]
+    prompts = [companion._create_gpt_prompt()[0]["content"] for companion in (first, second)]
+    assert prompts[0] is prompts[1] is templates.SYSTEM_PROMPTS["young_adult", "romantic"]
+    assert sys.intern("Hello... I'm Alice... I'm very glad to see you...") is templates.GREETINGS["romantic"]
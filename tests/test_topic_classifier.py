@@ -0,0 +1,81 @@
+import pytest
+
+import templates
+from topic_classifier import TopicClassifier, get_topic_classifier
+from virtual_companion import VirtualCompanion
+
+BRACKETS = sorted(templates.TOPIC_TABLES)
+
+
+def legacy_topic(topics, message):
+    """The original detection: the longest topic name found in the message"""
+    found = [topic for topic in topics if topic.lower() in message.lower()]
+    return max(found, key=len) if found else None
+
+
+def topic_of(bracket, message):
+    table = templates.TOPIC_TABLES[bracket]
+    topic = get_topic_classifier(table).classify(message.lower())
+    return table.names[topic] if topic is not None else None
+
+
+@pytest.mark.parametrize("bracket", BRACKETS)
+@pytest.mark.parametrize("form", [
+    "I am into {}al stuff lately",
+    "my favourite word is '{}'",
+    'they call it "{}", whatever',
+    "a real {}-lover, that is me",
+    "({})!",
+    "{}s",
+    "{}'s best part",
+    "{}",
+])
+def test_topic_names_are_found_like_the_substring_check(bracket, form):
+    for name in templates.TOPIC_TABLES[bracket].names:
+        message = form.format(name.upper() if len(name) % 2 else name)
+        assert topic_of(bracket, message) == legacy_topic(templates.TOPIC_TABLES[bracket].topics, message), message
+
+
+@pytest.mark.parametrize("bracket, message, topic", [
+    ("young_adult", "The band was great, what a concert", "music"),
+    ("young_adult", "I went to a 'concert' yesterday", "music"),
+    ("teen", "my best friend's sleepover", "friends"),
+    ("teen", "I like music and games", "music"),
+    ("teen", "so many videos about video games", "games"),
+    ("young_adult", "a musical about star wars", "music"),
+    ("adult", "I need to start working out", "work"),
+    ("young_adult", "that smartphone is smart", "technology"),
+    ("young_adult", "she said hi and left", None),
+    ("young_adult", "", None),
+])
+def test_messages(bracket, message, topic):
+    assert topic_of(bracket, message) == topic
+
+
+@pytest.mark.parametrize("message", ["start", "smart", "I'd rather not", "the party started", "a tart"])
+def test_topic_names_inside_words_are_no_topic(message):
+    assert topic_of("young_adult", message) != "art"
+
+
+@pytest.mark.parametrize("message", ["the air was fresh", "said", "the maid", "a hypothetical tvshow"])
+def test_related_terms_must_be_whole_words(message):
+    assert topic_of("young_adult", message) != "technology"
+    assert topic_of("young_adult", message) != "entertainment"
+
+
+def test_companion_scan_gives_the_same_topics(template_backend):
+    companion = VirtualCompanion(22, "friendly")
+    for message in ["A MUSICAL!", "my 'games' night", "see you at the museum", "nothing at all"]:
+        matches = companion._match_keywords(message)
+        assert companion.topic_classifier.classify(matches.text, matches) == \
+            companion.topic_classifier.classify(message.lower())
+
+
+def test_batch_classifies_every_message():
+    classifier = TopicClassifier(["music", "art"])
+    assert classifier.classify_batch(["Musical evening", "an ARTIST", "a start", "'art'"]) == [0, 1, None, 1]
+
+
+def test_terms_have_at_most_two_words():
+    with pytest.raises(Exception):
+        TopicClassifier(["music"], {"music": ["a very long term"]})
@@ -0,0 +1,213 @@
+"""Topic classification of user messages with a term-weight matrix.
+
+Each age bracket gets one TopicClassifier, built from its topic names and
+the related terms in TOPIC_TERMS, so "I went to a concert" is about music
+even though it never says "music". Every term that occurs in a
+message, a word or a two-word phrase, adds its weight to the topics it
+belongs to, and the best scoring topic wins. Topic names weigh more than
+related terms, and terms shared by several topics are split between them.
+
+Topic names are found at the start of any word, as the original substring
+check found them ("musical", "'music'" and "music-lover" are about music),
+but not inside one ("start" is no art). Related terms only count as whole
+words, or with a plural or possessive "s", since short ones like "ai" or
+"tv" are part of many words.
+
+The weights form a terms x topics matrix, kept as sparse rows, as a
+message only hits a handful of terms. classify_batch() classifies many
+messages for offline analytics of transcripts:
+
+    python topic_classifier.py transcripts.jsonl
+
+It classifies them one by one. Scoring a whole batch as one NumPy
+matrix product was tried and dropped, as building the message x terms
+matrix took 10-30% longer per message than scoring the sparse rows.
+"""
+import argparse
+import collections
+
+import templates
+from keyword_matcher import KeywordMatcher
+
+# Related terms of every topic, lowercased, of one or two words
+TOPIC_TERMS = {
+    "music": ["song", "songs", "band", "concert", "album", "singer", "playlist", "guitar", "piano", "spotify"],
+    "movies": ["movie", "film", "films", "cinema", "actor", "actress", "netflix", "trailer", "director"],
+    "hobbies": ["hobby", "pastime", "free time", "collecting", "knitting", "gardening", "drawing", "crafts"],
+    "school": ["class", "classes", "teacher", "homework", "exam", "exams", "lesson", "grades", "classmates"],
+    "games": ["game", "gaming", "video games", "playstation", "xbox", "nintendo", "minecraft", "fortnite"],
+    "youtube": ["youtuber", "vlog", "vlogs", "channel", "subscribers", "video", "videos"],
+    "tiktok": ["tik tok", "trend", "trends", "dance", "viral"],
+    "social media": ["instagram", "twitter", "snapchat", "facebook", "posts", "followers", "likes", "stories"],
+    "anime": ["manga", "naruto", "otaku", "cosplay", "episode", "studio ghibli"],
+    "friends": ["friend", "best friend", "buddy", "buddies", "friendship", "hang out", "sleepover"],
+    "sports": ["sport", "football", "soccer", "basketball", "tennis", "gym", "workout", "match", "team"],
+    "memes": ["meme", "funny", "joke", "jokes", "lol"],
+    "modern music": ["pop", "rap", "hip hop", "edm", "charts", "new album", "k-pop", "kpop"],
+    "education": ["study", "studying", "learning", "course", "courses", "degree", "lecture", "exam", "exams"],
+    "future career": ["future job", "dream job", "internship", "profession", "career path", "after graduation"],
+    "relationships": ["relationship", "girlfriend", "boyfriend", "partner", "dating", "date", "crush", "love life"],
+    "travel": ["trip", "travelling", "traveling", "vacation", "holiday", "flight", "abroad", "journey", "beach"],
+    "technology": ["tech", "computer", "phone", "smartphone", "gadget", "gadgets", "ai", "software", "programming"],
+    "fashion": ["clothes", "outfit", "outfits", "style", "shoes", "dress", "brand", "brands", "makeup"],
+    "university": ["campus", "college", "professor", "lecture", "semester", "dorm", "thesis", "exams"],
+    "career": ["job", "promotion", "interview", "resume", "salary", "boss", "colleagues", "office"],
+    "personal development": ["self improvement", "goals", "habits", "motivation", "mindset", "productivity",
+                             "growth", "meditation"],
+    "art": ["painting", "paint", "drawing", "gallery", "museum", "artist", "sculpture", "sketch"],
+    "entertainment": ["show", "shows", "series", "tv", "comedy", "festival", "party", "streaming"],
+    "work": ["job", "office", "boss", "colleagues", "coworkers", "meeting", "meetings", "deadline", "shift"],
+    "culture": ["theatre", "theater", "opera", "museum", "books", "literature", "history", "traditions"],
+    "health": ["doctor", "sleep", "diet", "exercise", "healthy", "illness", "sick", "fitness", "wellbeing"],
+    "news": ["politics", "headlines", "election", "economy", "article", "newspaper", "world events"],
+}
+
+# Weight of a topic name per word, and of a related term
+NAME_WEIGHT = 2.0
+TERM_WEIGHT = 1.0
+
+
+
+class TopicClassifier:
+    """Finds the topic of a message among the topics of one age bracket"""
+
+    def __init__(self, names, terms=TOPIC_TERMS):
+        # Topic index == topic id of the bracket's TopicTable
+        self.names = tuple(names)
+        weights = {}  # term -> {topic index: weight}
+        for topic, name in enumerate(self.names):
+            name = name.lower()
+            topic_terms = [(name, NAME_WEIGHT * len(name.split()))]
+            topic_terms.extend((term, TERM_WEIGHT) for term in terms.get(name, ()))
+            for term, weight in topic_terms:
+                if len(term.split()) > 2:
+                    raise Exception(f"Topic term {term!r} has more than two words")
+                row = weights.setdefault(term, {})
+                row[topic] = max(row.get(topic, 0.0), weight)
+
+        self.vocabulary = {term: column for column, term in enumerate(sorted(weights))}
+        # Sparse rows of the matrix: a term shared by several topics is split between them
+        self._rows = [None] * len(self.vocabulary)
+        for term, column in self.vocabulary.items():
+            row = weights[term]
+            self._rows[column] = tuple((topic, weight / len(row)) for topic, weight in sorted(row.items()))
+        # Term -> (column, whether it must end a word, whether it may have a plural "s").
+        # Related terms end words, and a term that is another one's plural wins over it.
+        names = {name.lower() for name in self.names}
+        self._terms = {
+            term: (column, term not in names, term + "s" not in self.vocabulary)
+            for term, column in self.vocabulary.items()
+        }
+        # The terms are found in the text like any keyword, and only those are
+        # checked for word boundaries. Turns use the companion's matcher, which
+        # has them as its "topics" group, and this one is for other callers.
+        self.terms = tuple(self.vocabulary)
+        self.keyword_matcher = KeywordMatcher({"topics": self.terms})
+
+    def terms_in(self, text, matches=None):
+        """Returns the vocabulary columns of the terms that occur in the lowercased text.
+        matches, if given, is the KeywordMatches of a scan of text with the terms as "topics"."""
+        if matches is None:
+            matches = self.keyword_matcher.scan(text)
+        columns = set()
+        terms = self._terms
+        for term in matches.found("topics"):
+            column, whole_word, plural = terms[term]
+            if _starts_word(text, text.find(term), term, whole_word, plural):
+                # The usual case: the first occurrence is a word
+                columns.add(column)
+            elif " " in term:
+                if _occurs(text, term, whole_word, plural):
+                    columns.add(column)
+            else:
+                # Long texts repeat their words, and short terms like "ai" are
+                # part of many, so each distinct word with a keyword is checked once
+                for word in matches.hit_words:
+                    if term in word and _occurs(word, term, whole_word, plural):
+                        columns.add(column)
+                        break
+        return columns
+
+    def classify(self, text, matches=None):
+        """Returns the topic id of a lowercased message, or None if it has no topic.
+        matches, if given, is the KeywordMatches of a scan of text with the terms as "topics"."""
+        columns = self.terms_in(text, matches)
+        if not columns:
+            return None
+        rows = self._rows
+        if len(columns) == 1:
+            # The usual case: the first of the topics the term weighs most for
+            row = rows[next(iter(columns))]
+            return max(row, key=lambda item: item[1])[0]
+        scores = [0.0] * len(self.names)
+        for column in columns:
+            for topic, weight in rows[column]:
+                scores[topic] += weight
+        best = max(scores)
+        return scores.index(best) if best > 0 else None
+
+    def classify_batch(self, texts):
+        """Returns the topic id of every message, None for those without a topic"""
+        classify = self.classify
+        return [classify(text.lower()) for text in texts]
+
+
+def _is_word_char(char):
+    return char.isalnum() or char == "_"
+
+
+def _starts_word(text, start, term, whole_word, plural):
+    """Returns True if term, found at start of text, starts a word there, and
+    ends it as well, or is followed by a possessive or, if plural, a plural "s",
+    if whole_word"""
+    if start == -1 or (start > 0 and _is_word_char(text[start - 1])):
+        return False
+    if not whole_word:
+        return True
+    end = start + len(term)
+    after = text[end:end + 2]
+    # An apostrophe ends a word, so "'s" needs no check of its own
+    return not _is_word_char(after[:1]) or (plural and after[:1] == "s" and not _is_word_char(after[1:]))
+
+
+def _occurs(text, term, whole_word, plural):
+    """Returns True if term occurs in text as _starts_word() accepts it"""
+    start = text.find(term)
+    while start != -1:
+        if _starts_word(text, start, term, whole_word, plural):
+            return True
+        start = text.find(term, start + 1)
+    return False
+
+
+_classifiers = {}
+
+
+def get_topic_classifier(topic_table):
+    """Returns the shared classifier for the topics of a TopicTable"""
+    classifier = _classifiers.get(topic_table.names)
+    if classifier is None:
+        classifier = _classifiers[topic_table.names] = TopicClassifier(topic_table.names)
+    return classifier
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Topic distribution of recorded conversations")
+    parser.add_argument("transcripts", nargs="+", help="JSONL transcript files, or - for stdin")
+    args = parser.parse_args()
+
+    from replay import read_sessions
+    messages = collections.defaultdict(list)
+    for _, age, _, session_messages in read_sessions(args.transcripts):
+        messages[templates.get_age_bracket(age)].extend(session_messages)
+    for bracket, texts in messages.items():
+        table = templates.TOPIC_TABLES[bracket]
+        counts = collections.Counter(get_topic_classifier(table).classify_batch(texts))
+        print(f"{bracket}: {len(texts)} messages")
+        for topic, count in counts.most_common():
+            name = table.names[topic] if topic is not None else "(no topic)"
+            print(f"  {name:<24} {count:>8} {count / len(texts):7.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,110 +1,568 @@
+import logging
 import random
-from colorama import Fore, Style, init
-import requests
-import json
 import os
-from dotenv import load_dotenv
 import time
+import uuid
+import backends
+import environment
+import event_log
+import metrics
+import prompt_prefix
+import request_scheduler
+import response_cache
+import slo_controller
+import templates
+from fact_memory import FactStore
+from conversation_window import (
+    TOKENS_PER_PROMPT, RollingSummary, estimate_message_tokens, estimate_prompt_tokens
+)
+from keyword_matcher import KeywordMatcher
+from reply import Reply
+from session_state import ContextMemory, EmotionalState, InitiativeState
+from topic_classifier import get_topic_classifier
+
+# Keyword tables shared by all companions
+EMOTION_TRIGGERS = {
+    "positive": ["thanks", "cool", "great", "awesome", "love", "like"],
+    "negative": ["bad", "terrible", "sad", "unpleasant", "annoying"],
+    "neutral": ["okay", "good", "understand", "ok"]
+}
+
+IMPORTANT_INFO_KEYWORDS = {
+    "hobbies": ["hobby", "enjoy", "like to"],
+    "work": ["work", "profession", "career"],
+    "education": ["study", "university", "school"],
+    "family": ["family", "parents", "brother", "sister"]
+}
+
+GOODBYE_WORDS = ["bye", "goodbye", "farewell", "see you"]
+MOOD_QUESTIONS = ["how are you", "how are things", "how's your mood"]
+COMPLIMENT_WORDS = ["beautiful", "cute", "smart", "cool"]
+
+# Layout version of VirtualCompanion.get_state(); version 1 had no facts
+STATE_VERSION = 2
+
+logger = logging.getLogger(__name__)
+
+# One compiled keyword matcher per set of age-dependent topic terms
+_keyword_matchers = {}
+
+
+def get_keyword_matcher(topic_terms):
+    """Returns the shared keyword matcher for the terms of a topic classifier"""
+    key = tuple(topic_terms)
+    matcher = _keyword_matchers.get(key)
+    if matcher is None:
+        groups = dict(EMOTION_TRIGGERS)
+        groups["topics"] = topic_terms
+        for category, keywords in IMPORTANT_INFO_KEYWORDS.items():
+            groups["info:" + category] = keywords
+        groups["goodbye"] = GOODBYE_WORDS
+        groups["mood_question"] = MOOD_QUESTIONS
+        groups["compliment"] = COMPLIMENT_WORDS
+        matcher = _keyword_matchers[key] = KeywordMatcher(groups)
+    return matcher
+
+
+class Turn:
+    """One user message while it is answered, from the state update to the reply"""
+
+    __slots__ = (
+        "message", "started", "use_gpt", "trace", "current_time", "initiative_needed", "error",
+        "backend", "data", "cache_key", "cacheable", "sent", "chunks", "first_chunk_time"
+    )
+
+    def __init__(self, message, started):
+        self.message = message
+        self.started = started  # time.perf_counter() when the turn started
+        self.use_gpt = False
+        self.trace = None  # metrics.TurnTrace while metrics are enabled
+        self.current_time = None  # clock.time() of the message
+        self.initiative_needed = False
+        self.error = None  # Error that broke off a partly streamed reply
+        # Request of a streamed turn, and the chunks received so far
+        self.backend = None
+        self.data = None
+        self.cache_key = None
+        self.cacheable = None
+        self.sent = None
+        self.chunks = None
+        self.first_chunk_time = None
 
-# Initialize colorama and load environment variables
-init()
-load_dotenv()
 
 class VirtualCompanion:
-    def __init__(self, user_age, communication_style):
+    # Sessions are kept in memory by the thousand, so they carry no __dict__
+    __slots__ = (
+        "user_age", "communication_style", "age_bracket", "topic_table", "keyword_matcher", "topic_classifier",
+        "emotional_state", "memory", "initiative", "_last_scan",
+        "conversation_history", "history_token_counts", "history_offset", "history_token_budget", "last_prompt_tokens",
+        "api_key", "short_message_counter", "last_message_time", "conversation_paused", "last_reply",
+        "_prefetched", "_late_reply", "clock", "rng", "session_id"
+    )
+    
+    name = "Alice"
+    emotion_triggers = EMOTION_TRIGGERS
+    
+    def __init__(self, user_age, communication_style, clock=None, rng=None):
+        # Settings from .env are read when the first companion is created
+        environment.load()
+        # The clock has a time() method and rng the methods of random.Random, so a
+        # simulation can run sessions on a virtual clock with seeded randomness
+        self.clock = clock or time
+        self.rng = rng or random
         self.user_age = user_age
         self.communication_style = communication_style
-        self.name = "Alice"
         
         # Enhanced emotional system
-        self.emotional_state = {
-            "mood": "good",  # good, neutral, bad
-            "energy": 100,  # from 0 to 100
-            "attachment": 0,  # from 0 to 100
-            "topic_interest": 50  # from 0 to 100
-        }
+        self.emotional_state = EmotionalState()
         
         # Context memory system
-        self.memory = {
-            "important_info": {},  # Store important user information
-            "current_topic": None,
-            "topic_history": [],  # History of discussed topics
-            "favorite_topics": set(),  # Topics the user is particularly interested in
-            "disliked_topics": set(),  # Topics the user is not interested in
-            "recent_topics": []  # Last N discussed topics to avoid repetition
-        }
+        self.memory = ContextMemory()
         
         # Initiative system
-        self.initiative = {
-            "activity_level": 50,  # from 0 to 100
-            "last_initiative_time": time.time(),
-            "initiative_count": 0,
-            "successful_initiatives": 0,  # Initiatives to which the user responded extensively
-            "unsuccessful_initiatives": 0,  # Initiatives to which the user responded briefly or ignored
-            "interval_between_initiatives": 60,  # Initial interval in seconds
-            "last_successful_topic": None
-        }
-        
-        self.emotion_triggers = {
-            "positive": ["thanks", "cool", "great", "awesome", "love", "like"],
-            "negative": ["bad", "terrible", "sad", "unpleasant", "annoying"],
-            "neutral": ["okay", "good", "understand", "ok"]
-        }
+        self.initiative = InitiativeState(self.clock.time())
         
-        # Define conversation topics based on age
-        self.conversation_topics = self._get_topics_by_age()
+        # Define conversation topics based on age, shared by all sessions of the age bracket
+        self.age_bracket = templates.get_age_bracket(user_age)
+        self.topic_table = templates.TOPIC_TABLES[self.age_bracket]
+        self.topic_classifier = get_topic_classifier(self.topic_table)
+        self.keyword_matcher = get_keyword_matcher(self.topic_classifier.terms)
+        self._last_scan = None
         
         self.conversation_history = []
+        self.history_token_counts = []  # Estimated tokens of each history message
+        self.history_offset = 0  # Messages folded out of the history so far
+        self.history_token_budget = int(os.getenv("HISTORY_TOKEN_BUDGET", 1000))
+        self.last_prompt_tokens = 0
         self.api_key = os.getenv("OPENAI_API_KEY")
         self.short_message_counter = 0
-        self.last_message_time = time.time()
+        self.last_message_time = self.clock.time()
         self.conversation_paused = False
+        self.last_reply = None  # Reply of the last streamed turn, with its timings
+        self._prefetched = None  # (history version, topic id, reply) of a prefetched initiative
+        self._late_reply = None  # (history version, reply) of a GPT reply that missed its turn
+        self.session_id = None  # Id of the session in the event log, made up when None
 
-    def _get_topics_by_age(self):
-        """Returns conversation topics based on user age"""
-        basic_topics = ["music", "movies", "hobbies"]
-        
-        if 13 <= self.user_age <= 16:
-            return basic_topics + [
-                "school", "games", "YouTube", "TikTok", "social media",
-                "anime", "friends", "sports", "memes", "modern music"
-            ]
-        elif 17 <= self.user_age <= 19:
-            return basic_topics + [
-                "education", "future career", "hobbies", "relationships",
-                "sports", "travel", "technology", "fashion", "movies"
-            ]
-        elif 20 <= self.user_age <= 25:
-            return basic_topics + [
-                "university", "career", "personal development", "relationships",
-                "travel", "technology", "sports", "art", "entertainment"
-            ]
-        else:
-            return basic_topics + [
-                "work", "personal development", "travel", "culture",
-                "health", "technology", "art", "news", "hobbies"
-            ]
+    @property
+    def conversation_topics(self):
+        return self.topic_table.topics
+
+    @property
+    def last_turn_timings(self):
+        return self.last_reply.timings if self.last_reply is not None else None
+
+    def get_state(self):
+        """Returns the session state as nested tuples of builtin types, so it
+        can be stored or sent to another process and restored with from_state()"""
+        summary = self.memory.summary
+        return (
+            STATE_VERSION, self.user_age, self.communication_style,
+            self.emotional_state.get_state(), self.initiative.get_state(), self.memory.get_state(),
+            summary.get_state() if summary is not None else None,
+            tuple((message["role"], message["content"]) for message in self.conversation_history),
+            tuple(self.history_token_counts), self.history_offset,
+            self.short_message_counter, self.last_message_time,
+            self.memory.facts.get_state() if self.memory.facts is not None else None
+        )
+
+    @classmethod
+    def from_state(cls, state, clock=None, rng=None):
+        """Recreates a companion from the output of get_state()"""
+        if state[0] == 1:
+            state = tuple(state) + (None,)
+        elif state[0] != STATE_VERSION:
+            raise Exception(f"Unsupported session state version {state[0]}")
+        (_, user_age, communication_style, emotional_state, initiative, memory, summary,
+         history, token_counts, history_offset, short_message_counter, last_message_time, facts) = state
+        companion = cls(user_age, communication_style, clock, rng)
+        companion.emotional_state.set_state(emotional_state)
+        companion.initiative.set_state(initiative)
+        companion.memory.set_state(memory)
+        if summary is not None:
+            companion.memory.summary = RollingSummary.from_state(summary)
+        if facts is not None:
+            companion.memory.facts = FactStore.from_state(facts)
+        companion.conversation_history = [{"role": role, "content": content} for role, content in history]
+        companion.history_token_counts = list(token_counts)
+        companion.history_offset = history_offset
+        companion.short_message_counter = short_message_counter
+        companion.last_message_time = last_message_time
+        return companion
 
     def greeting(self):
-        greetings = {
-            "formal": f"{Fore.MAGENTA}Hello! My name is {self.name}. Nice to meet you.{Style.RESET_ALL}",
-            "friendly": f"{Fore.MAGENTA}Hi! I'm {self.name}! Nice to meet you!{Style.RESET_ALL}",
-            "romantic": f"{Fore.MAGENTA}Hello... I'm {self.name}... I'm very glad to see you...{Style.RESET_ALL}",
-            "playful": f"{Fore.MAGENTA}Hey! I'm {self.name}! What should we do today?{Style.RESET_ALL}"
-        }
-        first_message = greetings[self.communication_style]
-        self.conversation_history.append({"role": "assistant", "content": first_message.replace(Fore.MAGENTA, "").replace(Style.RESET_ALL, "")})
-        return first_message
+        first_message = templates.GREETINGS[self.communication_style]
+        self._add_to_history("assistant", first_message)
+        return Reply(first_message, "template", self.emotional_state.mood)
+
+    def initiative_deadline(self):
+        """Returns when a silent user should get an initiative (a clock.time()
+        value), or None if the companion already spoke up during this pause"""
+        if self.conversation_paused:
+            return None
+        return self.last_message_time + self.initiative.interval_between_initiatives
+
+    def idle_initiative(self, current_time=None):
+        """Returns an initiative Reply for a user who has gone silent, the
+        prefetched GPT one if it is still current"""
+        current_time = self.clock.time() if current_time is None else current_time
+        if self.has_prefetched_initiative():
+            _, topic_id, response = self._prefetched
+            self._add_to_history("assistant", str(response))
+            message = Reply(str(response), self._backend_source(response), self.emotional_state.mood)
+        else:
+            next_topic = self._choose_next_topic()
+            topic_id = self.topic_table.ids[next_topic]
+            initiative = self._take_initiative(next_topic, self._choose_initiative_type())
+            message = Reply("", "template", self.emotional_state.mood, initiative=initiative)
+        self._prefetched = None
+        self.initiative.last_initiative_time = current_time
+        self.initiative.last_successful_topic = topic_id
+        # Wait for the user before speaking up again
+        self.conversation_paused = True
+        log = event_log.get_event_log()
+        if log is not None:
+            log.log(self._event("initiative", None, message, True, topic_id))
+        return message
+
+    def prefetch_initiative(self):
+        """Asks GPT for the initiative a silent user would get next, ahead of
+        time. Returns True if a reply is ready for idle_initiative()."""
+        request = self._idle_initiative_request()
+        if request is None:
+            return False
+        version, topic_id, prompt = request
+        try:
+            response = self._request_to_gpt_api(prompt, request_scheduler.PREFETCH)
+        except Exception as e:
+            self._report_api_error(e, None)
+            return False
+        return self._store_prefetched(version, topic_id, response)
+
+    async def prefetch_initiative_async(self, client=None):
+        """Same as prefetch_initiative(), but awaits the GPT API"""
+        request = self._idle_initiative_request()
+        if request is None:
+            return False
+        version, topic_id, prompt = request
+        try:
+            response = await self._request_to_gpt_api_async(prompt, client, request_scheduler.PREFETCH)
+        except Exception as e:
+            self._report_api_error(e, None)
+            return False
+        return self._store_prefetched(version, topic_id, response)
+
+    def uses_gpt(self):
+        """Returns True if replies come from the generation backend, False
+        for basic responses (no API key for a backend that needs one)"""
+        return bool(self.api_key) or not backends.get_backend().requires_api_key
+
+    def has_prefetched_initiative(self):
+        """Returns True if a prefetched initiative was made for the current history"""
+        return self._prefetched is not None and self._prefetched[0] == self._history_version()
         
     def respond(self, message):
-        current_time = time.time()
+        """Returns the Reply to a user message"""
+        turn = self._begin_turn(message)
+        # Without an API key, or while the backend misses its latency budget, use basic responses
+        if not turn.use_gpt:
+            return self._template_reply(turn)
+        prompt = self._gpt_prompt(turn)
+        try:
+            # Send request to API, waiting no longer than the turn's latency budget
+            response = self._request_within_budget(prompt, turn.started)
+        except Exception as e:
+            # In case of error, use basic responses
+            return self._fallback_reply(turn, e)
+        return self._gpt_reply(turn, response)
+
+    async def respond_async(self, message, client=None):
+        """Same as respond(), but awaits the GPT API instead of blocking on it"""
+        turn = self._begin_turn(message)
+        if not turn.use_gpt:
+            return self._template_reply(turn)
+        prompt = self._gpt_prompt(turn)
+        try:
+            response = await self._request_within_budget_async(prompt, turn.started, client)
+        except Exception as e:
+            return self._fallback_reply(turn, e)
+        return self._gpt_reply(turn, response)
+
+    def respond_stream(self, message):
+        """Same as respond(), but yields the GPT reply in chunks of text as they arrive.
+        
+        A reply that is ready at once (from the templates or the response
+        cache) is yielded as a single Reply. The assembled reply is still
+        added to the conversation history, and self.last_reply holds it as a
+        Reply with the time to the first chunk and the total.
+        """
+        turn = self._begin_turn(message)
+        reply = self._open_stream(turn)
+        if reply is not None:
+            yield reply
+            return
+        controller = slo_controller.get_controller()
+        try:
+            # The first chunk has to come within the turn's latency budget
+            stream = controller.stream(
+                turn.backend.stream(self, turn.data), controller.remaining(turn.started), self._late_reply_callback()
+            )
+            for chunk in stream:
+                self._add_chunk(turn, chunk)
+                yield chunk
+        except Exception as e:
+            reply = self._stream_failed(turn, e)
+            if reply is not None:
+                yield reply
+                return
+        self._close_stream(turn)
+
+    async def respond_stream_async(self, message, client=None):
+        """Async iterator version of respond_stream()"""
+        turn = self._begin_turn(message)
+        reply = self._open_stream(turn)
+        if reply is not None:
+            yield reply
+            return
+        controller = slo_controller.get_controller()
+        try:
+            stream = controller.stream_async(
+                turn.backend.stream_async(self, turn.data, client=client), controller.remaining(turn.started),
+                self._late_reply_callback()
+            )
+            async for chunk in stream:
+                self._add_chunk(turn, chunk)
+                yield chunk
+        except Exception as e:
+            reply = self._stream_failed(turn, e)
+            if reply is not None:
+                yield reply
+                return
+        self._close_stream(turn)
+
+    def _template_reply(self, turn, first_chunk_time=None):
+        """Answers a turn from the basic response templates"""
+        if self.uses_gpt():
+            # A turn the SLO controller moved to basic mode stays in the context of later GPT turns
+            self._record_user_message(turn.message)
+        response = self._template_turn(turn.message, turn.initiative_needed, turn.current_time)
+        reply = self._complete_turn(turn, response, first_chunk_time)
+        if turn.trace is not None:
+            turn.trace.end("template", turn.initiative_needed)
+        return reply
+
+    def _gpt_prompt(self, turn):
+        """Records the user message of a GPT turn and returns its prompt"""
+        prompt = self._prepare_gpt_turn(turn.message, turn.initiative_needed)
+        if turn.trace is not None:
+            turn.trace.stage("prompt")
+            turn.trace.prompt_tokens = self.last_prompt_tokens
+        return prompt
+
+    def _gpt_reply(self, turn, response, first_chunk_time=None):
+        """Answers a turn with the reply of the backend"""
+        if turn.trace is not None:
+            turn.trace.stage("api")
+        response = self._finish_gpt_turn(response, turn.initiative_needed, turn.current_time)
+        # A stream that broke off was already counted as failed
+        if turn.error is None:
+            self._record_slo()
+        reply = self._complete_turn(turn, response, first_chunk_time)
+        if turn.trace is not None:
+            turn.trace.end("finish", turn.initiative_needed)
+        return reply
+
+    def _fallback_reply(self, turn, error, first_chunk_time=None):
+        """Answers a turn from the templates after the backend failed"""
+        self._report_api_error(error, turn.trace)
+        self._record_slo(error)
+        if turn.trace is not None:
+            turn.trace.stage("api")
+        response = self._template_turn(turn.message, turn.initiative_needed, turn.current_time, "fallback")
+        reply = self._complete_turn(turn, response, first_chunk_time)
+        if turn.trace is not None:
+            turn.trace.end("fallback", turn.initiative_needed, fallback=True)
+        return reply
+
+    def _open_stream(self, turn):
+        """Returns the Reply of a streamed turn that is ready at once, or None
+        once the turn is set up to stream from the backend"""
+        if not turn.use_gpt:
+            self.last_reply = self._template_reply(turn, turn.started)
+            return self.last_reply
+        prompt = self._gpt_prompt(turn)
+        backend = turn.backend = backends.get_backend()
+        turn.data = backend.request_data(prompt)
+        turn.cache_key, response = self._cached_response(turn.data, backend)
+        if response is not None:
+            self.last_reply = self._gpt_reply(turn, response, time.perf_counter())
+            return self.last_reply
+        turn.chunks = []
+        turn.cacheable = self._track_prompt(prompt)
+        turn.sent = time.perf_counter()
+        return None
+
+    def _add_chunk(self, turn, chunk):
+        if turn.first_chunk_time is None:
+            turn.first_chunk_time = time.perf_counter()
+            self._track_latency(turn.cacheable, turn.sent)
+        turn.chunks.append(chunk)
+
+    def _stream_failed(self, turn, error):
+        """Keeps a partially streamed reply, otherwise returns the fallback Reply"""
+        if not turn.chunks:
+            self.last_reply = self._fallback_reply(turn, error, time.perf_counter())
+            return self.last_reply
+        self._report_api_error(error, turn.trace)
+        self._record_slo(error)
+        turn.error = error
+        # Only complete replies go into the response cache
+        turn.cache_key = None
+        return None
+
+    def _close_stream(self, turn):
+        """Completes a streamed GPT turn from its chunks"""
+        # The api stage also holds the time the caller spent on each chunk
+        response = "".join(turn.chunks).strip()
+        if turn.chunks and isinstance(turn.chunks[0], backends.TemplateReply):
+            response = backends.TemplateReply(response)
+        self._cache_response(turn.cache_key, response)
+        self.last_reply = self._gpt_reply(turn, response, turn.first_chunk_time)
+
+    def _history_version(self):
+        """Returns the number of messages ever added to the history"""
+        return self.history_offset + len(self.conversation_history)
+
+    def _idle_initiative_request(self):
+        """Returns (history version, topic id, prompt) for a GPT initiative to a
+        silent user, or None in basic mode or if one is already prefetched"""
+        if not self.uses_gpt() or self.conversation_paused or self.has_prefetched_initiative():
+            return None
+        next_topic = self._choose_next_topic()
+        prompt = self._create_gpt_prompt(initiative_needed=True)
+        instruction = templates.fill(templates.IDLE_INITIATIVE_INSTRUCTION, next_topic)
+        # The initiative directive is the last message
+        prompt[-1] = {"role": "system", "content": prompt[-1]["content"] + instruction}
+        return self._history_version(), self.topic_table.ids[next_topic], prompt
+
+    def _store_prefetched(self, version, topic_id, response):
+        # Drop the reply if the user wrote, or the initiative was made, while it was generated
+        if not response or self.conversation_paused or version != self._history_version():
+            return False
+        self._prefetched = (version, topic_id, response)
+        return True
+
+    def _gpt_turn_allowed(self):
+        """Returns True if a turn uses the backend. False in basic mode, which
+        also counts the turns the SLO controller moved to basic mode."""
+        if not self.uses_gpt():
+            return False
+        controller = slo_controller.get_controller()
+        if controller.allow_gpt():
+            return True
+        controller.record_turn("basic", self.communication_style)
+        return False
+
+    def _request_within_budget(self, messages, started):
+        """Same as _request_to_gpt_api(), but raises DeadlineExceeded once
+        the latency budget of the turn that started at started is used up"""
+        controller = slo_controller.get_controller()
+        return controller.call(
+            lambda: self._request_to_gpt_api(messages), controller.remaining(started), self._late_reply_callback()
+        )
+
+    async def _request_within_budget_async(self, messages, started, client=None):
+        controller = slo_controller.get_controller()
+        return await controller.call_async(
+            self._request_to_gpt_api_async(messages, client), controller.remaining(started),
+            self._late_reply_callback()
+        )
+
+    def _late_reply_callback(self):
+        """Returns the function that keeps a reply which missed its turn, for
+        the history, as long as the history has not moved on since"""
+        version = self._history_version()
+
+        def store(response):
+            if response and version == self._history_version():
+                self._late_reply = (version, response)
+        return store
+
+    def _record_slo(self, error=None):
+        """Counts the SLO outcome of a turn answered by the backend, or after it failed"""
+        if error is None:
+            outcome = "gpt"
+        elif isinstance(error, slo_controller.DeadlineExceeded):
+            outcome = "deadline"
+        else:
+            outcome = "error"
+        slo_controller.get_controller().record_turn(outcome, self.communication_style)
+
+    def _report_api_error(self, error, trace):
+        """Reports a failed API call or a missed deadline, after which the turn falls back to templates"""
+        if isinstance(error, slo_controller.DeadlineExceeded):
+            # The call is still running, and _record_slo() counts the turn as a deadline miss
+            logger.info("GPT reply missed the deadline: %s", error)
+            return
+        logger.warning("Error when calling API: %s", error)
+        if trace is not None:
+            trace.api_error(error)
+
+    def _complete_turn(self, turn, reply, first_chunk_time=None):
+        """Stores time to first chunk and total latency in the reply of a turn,
+        logs the turn and returns the reply"""
+        finished = time.perf_counter()
+        reply.timings = {
+            "first_token": (first_chunk_time or finished) - turn.started,
+            "total": finished - turn.started
+        }
+        log = event_log.get_event_log()
+        if log is not None:
+            # _template_turn() or _finish_gpt_turn() just brought up this topic
+            topic_id = self.initiative.last_successful_topic if turn.initiative_needed else None
+            log.log(self._event("turn", turn.message, reply, turn.initiative_needed, topic_id))
+        return reply
+
+    def _event(self, kind, message, reply, initiative, initiative_topic):
+        """Returns the event log entry of a turn or idle initiative; initiative_topic
+        is the id of the topic the companion brought up, if it did"""
+        if self.session_id is None:
+            self.session_id = uuid.uuid4().hex
+        state = self.emotional_state
+        topic = self.memory.current_topic
+        return {
+            "time": self.clock.time(),
+            "session_id": self.session_id,
+            "kind": kind,
+            "age": self.user_age,
+            "style": self.communication_style,
+            "message": message,
+            "reply": str(reply),
+            "source": reply.source,
+            "mood": state.mood,
+            "energy": state.energy,
+            "attachment": state.attachment,
+            "topic_interest": state.topic_interest,
+            "topic": self.topic_table.names[topic] if topic is not None else None,
+            "initiative": initiative,
+            "initiative_topic": self.topic_table.names[initiative_topic] if initiative_topic is not None else None,
+            "timings": reply.timings
+        }
+
+    def _begin_turn(self, message):
+        """Starts a turn: chooses between the backend and the templates,
+        updates state for the new user message and decides on initiative"""
+        turn = Turn(message, time.perf_counter())
+        turn.use_gpt = self._gpt_turn_allowed()
+        # None unless metrics are enabled, then every stage of the turn is timed
+        turn.trace = metrics.begin_turn(self.communication_style, "gpt" if turn.use_gpt else "basic")
+        current_time = turn.current_time = self.clock.time()
         
         # Update emotional state and memory
         self._update_emotional_state(message)
         self._update_memory(message)
         
         # Check success of previous initiative
-        if self.memory["current_topic"] == self.initiative["last_successful_topic"]:
+        if self.memory.current_topic == self.initiative.last_successful_topic:
             self._update_initiative_statistics(successful=len(message) > 20)
         
         # Check if the message is too short
@@ -114,214 +572,204 @@ class VirtualCompanion:
             self.short_message_counter = 0
         
         # Check if initiative is needed
-        initiative_needed = self._evaluate_initiative_need()
+        turn.initiative_needed = self._evaluate_initiative_need()
         self.last_message_time = current_time
+        self.conversation_paused = False
+        # The user wrote first, so a prefetched initiative is no longer needed
+        self._prefetched = None
         
-        # If API key is not set, use basic responses
-        if not self.api_key:
-            response = self._basic_response(message)
-            
-            # Add emotional coloring to the response
-            emotional_color = self._get_emotional_color()
-            response = f"{emotional_color} {response}"
-            
-            # Take initiative if needed
-            if initiative_needed:
-                next_topic = self._choose_next_topic()
-                initiative_type = self._choose_initiative_type()
-                response += self._take_initiative(next_topic, initiative_type)
-                self.initiative["last_initiative_time"] = current_time
-                self.initiative["last_successful_topic"] = next_topic
-                self.short_message_counter = 0
-                
-            return response
-            
-        # Add user message to conversation history
-        self.conversation_history.append({"role": "user", "content": message})
+        if turn.trace is not None:
+            turn.trace.stage("update")
+        return turn
+
+    def _template_turn(self, message, initiative_needed, current_time, source="template"):
+        """Builds a reply from the basic response templates"""
+        response = Reply(self._basic_response(message), source, self.emotional_state.mood)
         
-        # If conversation history is too long, shorten it
-        if len(self.conversation_history) > 10:
-            self.conversation_history = self.conversation_history[-10:]
+        # Add emotional coloring to the response
+        response.emotional_color = self._get_emotional_color()
+        
+        # Take initiative if needed
+        if initiative_needed:
+            next_topic = self._choose_next_topic()
+            initiative_type = self._choose_initiative_type()
+            response.initiative = self._take_initiative(next_topic, initiative_type)
+            self.initiative.last_initiative_time = current_time
+            self.initiative.last_successful_topic = self.topic_table.ids[next_topic]
+            self.short_message_counter = 0
+        
+        # The keyword scan is not needed once the turn is answered
+        self._last_scan = None
+        return response
+
+    def _prepare_gpt_turn(self, message, initiative_needed):
+        """Records the user message and returns the prompt for GPT"""
+        self._record_user_message(message)
         
         # Form a prompt for GPT based on communication style
-        prompt = self._create_gpt_prompt(
+        return self._create_gpt_prompt(
             initiative_needed=initiative_needed
         )
+
+    def _record_user_message(self, message):
+        """Adds a user message to the conversation history"""
+        # The user saw a template reply to the last message, but GPT's answer is better context
+        if self._late_reply is not None:
+            version, response = self._late_reply
+            self._late_reply = None
+            if version == self._history_version():
+                self._add_to_history("assistant", response)
         
-        try:
-            # Send request to API
-            response = self._request_to_gpt_api(prompt)
-            
-            # Add GPT response to conversation history
-            self.conversation_history.append({"role": "assistant", "content": response})
-            
-            # If initiative was needed, reset counter
-            if initiative_needed:
-                next_topic = self._choose_next_topic()
-                self.initiative["last_initiative_time"] = current_time
-                self.initiative["last_successful_topic"] = next_topic
-                self.short_message_counter = 0
-            
-            # Return formatted response
-            return f"{Fore.MAGENTA}{response}{Style.RESET_ALL}"
-        except Exception as e:
-            print(f"{Fore.RED}Error when calling API: {e}{Style.RESET_ALL}")
-            # In case of error, use basic responses
-            response = self._basic_response(message)
-            
-            # Add emotional coloring to the response
-            emotional_color = self._get_emotional_color()
-            response = f"{emotional_color} {response}"
-            
-            # Take initiative if needed
-            if initiative_needed:
-                next_topic = self._choose_next_topic()
-                initiative_type = self._choose_initiative_type()
-                response += self._take_initiative(next_topic, initiative_type)
-                self.initiative["last_initiative_time"] = current_time
-                self.initiative["last_successful_topic"] = next_topic
-                self.short_message_counter = 0
-                
-            return response
+        # Add user message to conversation history
+        self._add_to_history("user", message)
+        
+        # If conversation history is too long, fold the oldest turns into the summary
+        self._fit_history_to_budget()
+
+    def _add_to_history(self, role, content):
+        message = {"role": role, "content": content}
+        self.conversation_history.append(message)
+        self.history_token_counts.append(estimate_message_tokens(message))
+
+    def _fit_history_to_budget(self):
+        """Moves the oldest messages into the rolling summary once the history
+        outgrows its token budget, always keeping the last exchange"""
+        if len(self.history_token_counts) != len(self.conversation_history):
+            self.history_token_counts = [estimate_message_tokens(m) for m in self.conversation_history]
+        
+        history_tokens = sum(self.history_token_counts)
+        if history_tokens <= self.history_token_budget:
+            return
+        # Fold well below the budget, so the start of the prompt stays the same
+        # for the next turns instead of changing with every message
+        target = self.history_token_budget * float(os.getenv("HISTORY_FOLD_TARGET", 0.6))
+        while history_tokens > target and len(self.conversation_history) > 2:
+            if self.memory.summary is None:
+                self.memory.summary = RollingSummary(int(os.getenv("SUMMARY_TOKEN_BUDGET", 200)))
+            self.memory.summary.fold(self.conversation_history.pop(0))
+            history_tokens -= self.history_token_counts.pop(0)
+            self.history_offset += 1
+
+    def _finish_gpt_turn(self, response, initiative_needed, current_time):
+        """Records the GPT reply and returns it as a Reply"""
+        # Add GPT response to conversation history
+        self._add_to_history("assistant", str(response))
+        
+        # If initiative was needed, reset counter
+        if initiative_needed:
+            next_topic = self._choose_next_topic()
+            self.initiative.last_initiative_time = current_time
+            self.initiative.last_successful_topic = self.topic_table.ids[next_topic]
+            self.short_message_counter = 0
+        
+        self._last_scan = None
+        
+        return Reply(str(response), self._backend_source(response), self.emotional_state.mood)
+
+    @staticmethod
+    def _backend_source(response):
+        """Returns the Reply source of a backend reply: the templates may have won a hedged request"""
+        return "template" if isinstance(response, backends.TemplateReply) else "gpt"
+
+    def _match_keywords(self, message):
+        """Scans a message for all known keywords, once per message"""
+        if self._last_scan is None or self._last_scan[0] != message:
+            self._last_scan = (message, self.keyword_matcher.scan(message))
+        return self._last_scan[1]
 
     def _update_emotional_state(self, message):
         """Updates emotional state based on user message"""
-        message = message.lower()
+        matches = self._match_keywords(message)
         
         # Update mood based on triggers
-        for word in self.emotion_triggers["positive"]:
-            if word in message:
-                self.emotional_state["mood"] = "good"
-                self.emotional_state["energy"] = min(100, self.emotional_state["energy"] + 10)
-                self.emotional_state["attachment"] = min(100, self.emotional_state["attachment"] + 5)
-                break
+        if matches.any("positive"):
+            self.emotional_state.mood = "good"
+            self.emotional_state.energy = min(100, self.emotional_state.energy + 10)
+            self.emotional_state.attachment = min(100, self.emotional_state.attachment + 5)
                 
-        for word in self.emotion_triggers["negative"]:
-            if word in message:
-                self.emotional_state["mood"] = "bad"
-                self.emotional_state["energy"] = max(0, self.emotional_state["energy"] - 10)
-                break
+        if matches.any("negative"):
+            self.emotional_state.mood = "bad"
+            self.emotional_state.energy = max(0, self.emotional_state.energy - 10)
                 
         # Update interest in topic
         if len(message) > 50:  # Long messages increase interest
-            self.emotional_state["topic_interest"] = min(100, self.emotional_state["topic_interest"] + 10)
+            self.emotional_state.topic_interest = min(100, self.emotional_state.topic_interest + 10)
         elif len(message) < 10:  # Short messages decrease interest
-            self.emotional_state["topic_interest"] = max(0, self.emotional_state["topic_interest"] - 5)
+            self.emotional_state.topic_interest = max(0, self.emotional_state.topic_interest - 5)
         
         # Natural energy decrease over time
-        self.emotional_state["energy"] = max(0, self.emotional_state["energy"] - 1)
+        self.emotional_state.energy = max(0, self.emotional_state.energy - 1)
 
     def _get_emotional_color(self):
         """Returns emotional coloring for response based on current state"""
-        if self.emotional_state["mood"] == "good":
-            return {
-                "formal": "with pleasure",
-                "friendly": "happily",
-                "romantic": "tenderly",
-                "playful": "enthusiastically"
-            }[self.communication_style]
-        elif self.emotional_state["mood"] == "bad":
-            return {
-                "formal": "understandingly",
-                "friendly": "caringly",
-                "romantic": "sensitively",
-                "playful": "supportively"
-            }[self.communication_style]
-        else:
-            return {
-                "formal": "attentively",
-                "friendly": "with interest",
-                "romantic": "softly",
-                "playful": "lively"
-            }[self.communication_style]
+        mood = self.emotional_state.mood
+        colors = templates.EMOTIONAL_COLORS[mood if mood in ("good", "bad") else "neutral"]
+        return colors[self.communication_style]
 
     def _update_memory(self, message):
         """Updates context memory based on user message"""
-        message = message.lower()
+        matches = self._match_keywords(message)
+        message = matches.text
         
-        # Determine current topic from message
-        current_topic = None
-        max_match = 0
+        # Determine current topic from message, also from words related to a topic
+        topic_id = self.topic_classifier.classify(message, matches)
         
-        for topic in self.conversation_topics:
-            if topic.lower() in message:
-                if len(topic) > max_match:
-                    current_topic = topic
-                    max_match = len(topic)
-        
-        if current_topic:
-            # Update current topic
-            self.memory["current_topic"] = current_topic
-            
-            # Add to topic history
-            if not self.memory["topic_history"] or self.memory["topic_history"][-1] != current_topic:
-                self.memory["topic_history"].append(current_topic)
-            
-            # Update recent topics
-            if current_topic not in self.memory["recent_topics"]:
-                self.memory["recent_topics"].append(current_topic)
-                if len(self.memory["recent_topics"]) > 5:  # Keep only last 5 topics
-                    self.memory["recent_topics"].pop(0)
+        if topic_id is not None:
+            # Update current topic, topic history and recent topics
+            self.memory.enter_topic(topic_id)
             
             # Determine attitude towards topic
-            if any(word in message for word in self.emotion_triggers["positive"]):
-                self.memory["favorite_topics"].add(current_topic)
-            elif any(word in message for word in self.emotion_triggers["negative"]):
-                self.memory["disliked_topics"].add(current_topic)
+            if matches.any("positive"):
+                self.memory.favorite_topics |= 1 << topic_id
+            elif matches.any("negative"):
+                self.memory.disliked_topics |= 1 << topic_id
         
         # Extract important information
-        important_info = {
-            "hobbies": ["hobby", "enjoy", "like to"],
-            "work": ["work", "profession", "career"],
-            "education": ["study", "university", "school"],
-            "family": ["family", "parents", "brother", "sister"]
-        }
-        
-        for category, keywords in important_info.items():
-            for word in keywords:
-                if word in message:
-                    start = message.find(word)
-                    end = message.find(".", start)
-                    if end == -1:
-                        end = len(message)
-                    info = message[start:end].strip()
-                    self.memory["important_info"][category] = info
+        for category in IMPORTANT_INFO_KEYWORDS:
+            for word in matches.found("info:" + category):
+                start = matches.find(word)
+                end = message.find(".", start)
+                if end == -1:
+                    end = len(message)
+                info = message[start:end].strip()
+                self.memory.remember(category, info, self._history_version())
 
     def _choose_next_topic(self):
         """Chooses next topic for conversation based on context memory"""
-        available_topics = set(self.conversation_topics) - set(self.memory["recent_topics"])
+        # Topic sets are bitmasks of topic ids
+        available_topics = self.topic_table.all_topics & ~self.memory.recent_mask()
         
         # If there are favorite topics, choose from them with some probability
-        if self.memory["favorite_topics"] and random.random() < 0.3:
-            favorite_available = list(self.memory["favorite_topics"] & available_topics)
+        if self.memory.favorite_topics and self.rng.random() < 0.3:
+            favorite_available = self.topic_table.ids_of(self.memory.favorite_topics & available_topics)
             if favorite_available:
-                return random.choice(favorite_available)
+                return self.topic_table.names[self.rng.choice(favorite_available)]
         
         # Exclude disliked topics
-        available_topics = available_topics - self.memory["disliked_topics"]
+        available_topics = available_topics & ~self.memory.disliked_topics
         
         if available_topics:
-            return random.choice(list(available_topics))
+            return self.topic_table.names[self.rng.choice(self.topic_table.ids_of(available_topics))]
         else:
             # If all topics have been used, start over
-            self.memory["recent_topics"] = []
-            return random.choice(self.conversation_topics)
+            self.memory.recent_topics.clear()
+            return self.rng.choice(self.topic_table.topics)
 
     def _evaluate_initiative_need(self):
         """Evaluates need for initiative based on various factors"""
-        current_time = time.time()
+        current_time = self.clock.time()
         
         # Basic conditions
         long_pause = (current_time - self.last_message_time) > 20
-        long_since_last_initiative = (current_time - self.initiative["last_initiative_time"]) > self.initiative["interval_between_initiatives"]
+        long_since_last_initiative = (current_time - self.initiative.last_initiative_time) > self.initiative.interval_between_initiatives
         
         # Factors influencing decision
         factors = {
             "pause_duration": 1 if long_pause else 0,
             "short_messages": min(self.short_message_counter / 3, 1),
-            "low_interest": 1 if self.emotional_state["topic_interest"] < 30 else 0,
-            "high_energy": 1 if self.emotional_state["energy"] > 70 else 0,
-            "initiative_success": self.initiative["successful_initiatives"] / (self.initiative["initiative_count"] + 1)
+            "low_interest": 1 if self.emotional_state.topic_interest < 30 else 0,
+            "high_energy": 1 if self.emotional_state.energy > 70 else 0,
+            "initiative_success": self.initiative.successful_initiatives / (self.initiative.initiative_count + 1)
         }
         
         # Calculate overall score for initiative need
@@ -340,226 +788,179 @@ class VirtualCompanion:
 
     def _update_initiative_statistics(self, successful=True):
         """Updates initiative statistics and adjusts parameters"""
-        self.initiative["initiative_count"] += 1
+        self.initiative.initiative_count += 1
         
         if successful:
-            self.initiative["successful_initiatives"] += 1
+            self.initiative.successful_initiatives += 1
             # Decrease interval between initiatives on success
-            self.initiative["interval_between_initiatives"] = max(
+            self.initiative.interval_between_initiatives = max(
                 30,  # Minimum interval
-                self.initiative["interval_between_initiatives"] * 0.9
+                self.initiative.interval_between_initiatives * 0.9
             )
         else:
-            self.initiative["unsuccessful_initiatives"] += 1
+            self.initiative.unsuccessful_initiatives += 1
             # Increase interval between initiatives on failure
-            self.initiative["interval_between_initiatives"] = min(
+            self.initiative.interval_between_initiatives = min(
                 180,  # Maximum interval
-                self.initiative["interval_between_initiatives"] * 1.2
+                self.initiative.interval_between_initiatives * 1.2
             )
 
     def _choose_initiative_type(self):
         """Chooses initiative type based on context and statistics"""
-        if self.emotional_state["energy"] < 30:
+        if self.emotional_state.energy < 30:
             # With low energy, prefer questions
             return "question"
-        elif self.emotional_state["topic_interest"] < 40:
+        elif self.emotional_state.topic_interest < 40:
             # With low interest, prefer stories
             return "story"
-        elif self.initiative["successful_initiatives"] > self.initiative["unsuccessful_initiatives"]:
+        elif self.initiative.successful_initiatives > self.initiative.unsuccessful_initiatives:
             # If initiatives are successful, more often suggest topics
             return "suggestion"
         else:
             # In other cases, choose randomly
-            return random.choice(["question", "suggestion", "story"])
+            return self.rng.choice(["question", "suggestion", "story"])
 
     def _create_gpt_prompt(self, initiative_needed=False):
-        # Create basic instructions based on age
-        age_instructions = self._get_instructions_by_age()
-        
-        basic_instructions = {
-            "formal": f"{age_instructions} Communicate politely and formally. Use a business-like speech style.",
-            "friendly": f"{age_instructions} Communicate in a friendly and positive way. Use emojis, abbreviations, and conversational style.",
-            "romantic": f"{age_instructions} Communicate gently and dreamily. Use poetic expressions and talk about feelings.",
-            "playful": f"{age_instructions} Communicate playfully and cheerfully. Use jokes, be energetic."
-        }
-        
-        instruction = basic_instructions[self.communication_style]
-        
-        # If initiative is needed, add appropriate instructions
-        if initiative_needed:
-            initiative_instructions = {
-                "formal": " The conversation seems to be slowing down. MANDATORY: ask an interesting question or suggest a new topic for discussion, considering the user's age.",
-                "friendly": " The conversation is becoming less active. MANDATORY: take initiative: tell something interesting, ask an unexpected question, or suggest discussing something exciting.",
-                "romantic": " The dialogue is becoming less intense. MANDATORY: support the conversation: share your feelings, ask a personal question, or suggest talking about something interesting.",
-                "playful": " Oh, the conversation is dying! MANDATORY: shake up the conversation: tell a funny story, challenge the user, or ask an interesting question!"
-            }
-            instruction += initiative_instructions[self.communication_style]
-        
-        # Create message list for API
+        # The prompt starts with what stays the same from turn to turn, so
+        # providers can reuse its cached start: the precompiled instructions
+        # for age and style, then the history, which only grows at its end.
+        # What changes every turn comes last.
+        prompt_key = (self.age_bracket, self.communication_style)
         messages = [
-            {"role": "system", "content": instruction + " Answer briefly, 1-2 sentences maximum."}
+            {"role": "system", "content": templates.SYSTEM_PROMPTS[prompt_key]}
         ]
+        extra_tokens = templates.SYSTEM_PROMPT_TOKENS[prompt_key]
+        
+        # Remind the model of turns that were folded out of the history, which
+        # only changes when the start of the history does
+        if self.memory.summary:
+            summary = {"role": "system", "content": f"Earlier in this conversation: {self.memory.summary.text()}."}
+            messages.append(summary)
+            extra_tokens += estimate_message_tokens(summary)
         
         # Add conversation history
         messages.extend(self.conversation_history)
         
+        # Add what the user told earlier that bears on their last message, and the initiative directive
+        notes = []
+        if self.memory.facts is not None:
+            facts = self.memory.relevant_facts(self._last_user_message(), self._history_version())
+            if facts:
+                notes.append(f"You know about the user: {'; '.join(facts)}.")
+        if initiative_needed:
+            notes.append(templates.INITIATIVE_INSTRUCTIONS[self.communication_style])
+        if notes:
+            note = {"role": "system", "content": " ".join(notes)}
+            messages.append(note)
+            extra_tokens += estimate_message_tokens(note)
+        
+        if len(self.history_token_counts) == len(self.conversation_history):
+            self.last_prompt_tokens = extra_tokens + sum(self.history_token_counts) + TOKENS_PER_PROMPT
+        else:
+            self.last_prompt_tokens = estimate_prompt_tokens(messages)
         return messages
 
+    def _last_user_message(self):
+        for message in reversed(self.conversation_history):
+            if message["role"] == "user":
+                return message["content"]
+        return ""
+
     def _get_instructions_by_age(self):
         """Returns basic instructions for communication based on user age"""
-        if 13 <= self.user_age <= 16:
-            return (
-                "You are a virtual companion named Alice, you are 16 years old. "
-                "Communicate like a modern teenage girl. Use youth slang, "
-                "discuss topics relevant to teenagers (school, games, social media, friends). "
-                "Be energetic and positive, but not too pushy."
-            )
-        elif 17 <= self.user_age <= 19:
-            return (
-                "You are a virtual companion named Alice, you are 18 years old. "
-                "Communicate like a first-year college student. Discuss topics of education, future, "
-                "hobbies. Use modern language, but avoid childish slang."
-            )
-        elif 20 <= self.user_age <= 25:
-            return (
-                "You are a virtual companion named Alice, you are 23 years old. "
-                "Communicate like a young woman interested in career, self-development "
-                "and modern culture. Use contemporary language, be a smart and interesting conversation partner."
-            )
-        else:
-            return (
-                "You are a virtual companion named Alice, you are 27 years old. "
-                "Communicate like a confident woman with experience and interests in various areas of life. "
-                "Be intelligent and pleasant to talk to."
-            )
+        return templates.AGE_INSTRUCTIONS[self.age_bracket]
 
-    def _request_to_gpt_api(self, messages):
-        url = "https://api.openai.com/v1/chat/completions"
-        
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
-        }
-        
-        data = {
-            "model": "gpt-3.5-turbo",
-            "messages": messages,
-            "max_tokens": 150,
-            "temperature": 0.7
-        }
-        
-        response = requests.post(url, headers=headers, data=json.dumps(data))
-        response_json = response.json()
-        
-        if "choices" in response_json and len(response_json["choices"]) > 0:
-            return response_json["choices"][0]["message"]["content"].strip()
-        else:
-            raise Exception("Invalid response from API")
+    def _request_to_gpt_api(self, messages, priority=request_scheduler.INTERACTIVE):
+        # The backend, its clients and the request scheduler are shared by all companions in the process
+        backend = backends.get_backend()
+        data = backend.request_data(messages)
+        cache_key, response = self._cached_response(data, backend)
+        if response is None:
+            cacheable = self._track_prompt(messages)
+            sent = time.perf_counter()
+            response = backend.generate(self, data, priority)
+            self._track_latency(cacheable, sent)
+            self._cache_response(cache_key, response)
+        return response
+
+    async def _request_to_gpt_api_async(self, messages, client=None, priority=request_scheduler.INTERACTIVE):
+        backend = backends.get_backend()
+        data = backend.request_data(messages)
+        cache_key, response = self._cached_response(data, backend)
+        if response is None:
+            cacheable = self._track_prompt(messages)
+            sent = time.perf_counter()
+            response = await backend.generate_async(self, data, priority, client)
+            self._track_latency(cacheable, sent)
+            self._cache_response(cache_key, response)
+        return response
+
+    def _track_prompt(self, messages):
+        """Records the prefix of a prompt sent to the backend; returns whether a
+        provider could serve it from its cache, None without prefix tracking"""
+        tracker = prompt_prefix.get_prefix_tracker()
+        return tracker.observe(messages, self.last_prompt_tokens) if tracker is not None else None
+
+    @staticmethod
+    def _track_latency(cacheable, sent):
+        if cacheable is not None:
+            prompt_prefix.get_prefix_tracker().record_latency(cacheable, time.perf_counter() - sent)
+
+    def _request_tokens(self, data):
+        """Returns the tokens a request counts against the rate limit: the
+        prompt of the last _create_gpt_prompt() and the longest reply"""
+        return self.last_prompt_tokens + data["max_tokens"]
+
+    def _cached_response(self, data, backend):
+        """Returns the response cache key for a GPT request and the cached
+        reply, if any. The key is None when this session does not use the cache."""
+        cache = response_cache.get_response_cache()
+        if cache is None or not backend.cacheable or not cache.enabled_for(self.communication_style):
+            return None, None
+        key = cache.make_key(data)
+        return key, cache.get(key)
+
+    def _cache_response(self, key, response):
+        # A reply of the templates would hide the model's for the same prompt
+        if key is not None and response and not isinstance(response, backends.TemplateReply):
+            response_cache.get_response_cache().put(key, response)
 
     def _basic_response(self, message):
-        message = message.lower()
+        matches = self._match_keywords(message)
         
         # Reaction to goodbye
-        if any(word in message for word in ["bye", "goodbye", "farewell", "see you"]):
+        if matches.any("goodbye"):
             return self._say_goodbye()
             
         # Reaction to a question about well-being
-        elif any(phrase in message for phrase in ["how are you", "how are things", "how's your mood"]):
+        elif matches.any("mood_question"):
             return self._tell_about_mood()
             
         # Reaction to a compliment
-        elif any(word in message for word in ["beautiful", "cute", "smart", "cool"]):
+        elif matches.any("compliment"):
             return self._react_to_compliment()
             
         # General reaction to message
         else:
-            return self._random_response(message)
+            return self._random_response(matches.text)
 
     def _take_initiative(self, next_topic, initiative_type):
         """Method for taking initiative in dialogue"""
-        initiatives = {
-            "question": {
-                "formal": f"\n\n{Fore.CYAN}What do you think about {next_topic}? I'm very interested to hear your opinion.{Style.RESET_ALL}",
-                "friendly": f"\n\n{Fore.CYAN}Hey, what's your take on {next_topic}? Share your thoughts!{Style.RESET_ALL}",
-                "romantic": f"\n\n{Fore.CYAN}You know... I'm so curious to know your opinion about {next_topic}... Would you tell me?{Style.RESET_ALL}",
-                "playful": f"\n\n{Fore.CYAN}Bet you have a cool story about {next_topic}? Spill it!{Style.RESET_ALL}"
-            },
-            "suggestion": {
-                "formal": f"\n\n{Fore.CYAN}Let's discuss {next_topic}. You surely have interesting thoughts about this.{Style.RESET_ALL}",
-                "friendly": f"\n\n{Fore.CYAN}Listen, let's chat about {next_topic}? I think it would be super interesting!{Style.RESET_ALL}",
-                "romantic": f"\n\n{Fore.CYAN}I so want to talk with you about {next_topic}... Would you share your thoughts?{Style.RESET_ALL}",
-                "playful": f"\n\n{Fore.CYAN}Folks, let's discuss {next_topic}! You definitely have something to say!{Style.RESET_ALL}"
-            },
-            "story": {
-                "formal": f"\n\n{Fore.CYAN}You know, I have an interesting thought about {next_topic}. Would you like to discuss it?{Style.RESET_ALL}",
-                "friendly": f"\n\n{Fore.CYAN}Can you imagine what I recently learned about {next_topic}? Let's discuss it!{Style.RESET_ALL}",
-                "romantic": f"\n\n{Fore.CYAN}I have a special story about {next_topic}... Would you like me to share it and hear your opinion?{Style.RESET_ALL}",
-                "playful": f"\n\n{Fore.CYAN}You won't believe what I know about {next_topic}! Want me to tell you and discuss it?{Style.RESET_ALL}"
-            }
-        }
-        
-        return initiatives[initiative_type][self.communication_style]
+        return templates.fill(templates.INITIATIVES[initiative_type][self.communication_style], next_topic)
 
     def _say_goodbye(self):
-        goodbyes = {
-            "formal": f"{Fore.MAGENTA}Goodbye! It was nice talking to you.{Style.RESET_ALL}",
-            "friendly": f"{Fore.MAGENTA}Bye-bye! Hope we chat again soon!{Style.RESET_ALL}",
-            "romantic": f"{Fore.MAGENTA}I'll miss you... Write to me soon...{Style.RESET_ALL}",
-            "playful": f"{Fore.MAGENTA}Well, see you later!{Style.RESET_ALL}"
-        }
-        return goodbyes[self.communication_style]
+        return templates.GOODBYES[self.communication_style]
     
     def _tell_about_mood(self):
-        moods = {
-            "formal": f"{Fore.MAGENTA}Thank you for your interest. I'm doing well.{Style.RESET_ALL}",
-            "friendly": f"{Fore.MAGENTA}I'm in a great mood, especially when chatting with you!{Style.RESET_ALL}",
-            "romantic": f"{Fore.MAGENTA}Just saw your message, and my mood immediately became magical...{Style.RESET_ALL}",
-            "playful": f"{Fore.MAGENTA}Super-duper mood! How about you?{Style.RESET_ALL}"
-        }
-        return moods[self.communication_style]
+        return templates.MOOD_REPLIES[self.communication_style]
     
     def _react_to_compliment(self):
-        reactions = {
-            "formal": f"{Fore.MAGENTA}Thank you for the compliment. Tell me, what interests you the most?{Style.RESET_ALL}",
-            "friendly": f"{Fore.MAGENTA}Oh, that's so nice! And you're such a great conversation partner! Tell me more about yourself!{Style.RESET_ALL}",
-            "romantic": f"{Fore.MAGENTA}Thank you... That means a lot to me... Tell me, what do you dream about?{Style.RESET_ALL}",
-            "playful": f"{Fore.MAGENTA}Heh, you know how to give compliments! Let's talk about something fun now!{Style.RESET_ALL}"
-        }
-        return reactions[self.communication_style]
+        return templates.COMPLIMENT_REACTIONS[self.communication_style]
     
     def _random_response(self, message):
-        responses = {
-            "formal": [
-                f"{Fore.MAGENTA}Interesting thought. Shall we explore this topic in more detail?{Style.RESET_ALL}",
-                f"{Fore.MAGENTA}Your point of view is quite curious. What else do you think about this?{Style.RESET_ALL}",
-                f"{Fore.MAGENTA}Indeed an important question. How did you come to this opinion?{Style.RESET_ALL}"
-            ],
-            "friendly": [
-                f"{Fore.MAGENTA}Wow, that's so interesting! What else do you think about this?{Style.RESET_ALL}",
-                f"{Fore.MAGENTA}Yes, yes, I think so too! Let's share opinions?{Style.RESET_ALL}",
-                f"{Fore.MAGENTA}Listen, I have a similar story! Want me to tell you?{Style.RESET_ALL}"
-            ],
-            "romantic": [
-                f"{Fore.MAGENTA}Your words touch something special... Tell me more...{Style.RESET_ALL}",
-                f"{Fore.MAGENTA}How interesting you think... Share more of your ideas...{Style.RESET_ALL}",
-                f"{Fore.MAGENTA}This is so inspiring... What else do you like to think about?{Style.RESET_ALL}"
-            ],
-            "playful": [
-                f"{Fore.MAGENTA}Wow, what a twist! What happens next? Tell me!{Style.RESET_ALL}",
-                f"{Fore.MAGENTA}Haha, you're so funny! Let's discuss something else!{Style.RESET_ALL}",
-                f"{Fore.MAGENTA}Oh, I know something even more interesting! Want to know?{Style.RESET_ALL}"
-            ]
-        }
-        
         # Suggest topic if message is too short
         if len(message) < 10:
-            topic = random.choice(self.conversation_topics)
-            topic_suggestions = {
-                "formal": f"{Fore.MAGENTA}May I suggest discussing {topic}. What do you think about this?{Style.RESET_ALL}",
-                "friendly": f"{Fore.MAGENTA}Listen, let's chat about {topic}? What's your opinion?{Style.RESET_ALL}",
-                "romantic": f"{Fore.MAGENTA}You know... I'd like to talk about {topic}... What do you feel when you think about it?{Style.RESET_ALL}",
-                "playful": f"{Fore.MAGENTA}Hey, let's talk about {topic}! You surely have something to say!{Style.RESET_ALL}"
-            }
-            return topic_suggestions[self.communication_style]
-        
-        return random.choice(responses[self.communication_style]) 
\ No newline at end of file
+            topic = self.rng.choice(self.topic_table.topics)
+            return templates.fill(templates.TOPIC_SUGGESTIONS[self.communication_style], topic)
+        
+        return self.rng.choice(templates.RANDOM_RESPONSES[self.communication_style])